@@ -1,11 +1,15 @@
-#!/usr/bin/env python
-
-from __future__ import print_function
+#!/usr/bin/env python3
 
 import sys
 import argparse
-import re
 import csv
+import numpy as np
+
+from iostat_parser import parse_iostat_cached, iter_iostat, RD_PER_SEC, RD_MB_SEC, RD_LAT_MS, WR_PER_SEC, WR_MB_SEC, WR_LAT_MS, QU_SZ
+from iostat_parser import PARSER_VERSION as IOSTAT_PARSER_VERSION
+from parse_cache import cached_parse
+from hdr_histogram import HdrHistogram, histograms_to_arrays, histograms_from_arrays, merge_histograms, \
+    save_histograms, load_histograms
 
 
 def bug(msg):
@@ -13,37 +17,69 @@ def bug(msg):
     assert False
 
 
-# 10/12/20 19:51:43
-HEADER = re.compile(r'^(\d+/\d+/\d+\s+\d+:\d+:\d+)')
-
-
-# Device            r/s     w/s     rkB/s     wkB/s   rrqm/s   wrqm/s  %rrqm  %wrqm r_await w_await aqu-sz rareq-sz wareq-sz  svctm  %util
-# vda              0.00    2.00      0.00      8.00     0.00     0.00   0.00   0.00    0.00    0.50   0.00     0.00     4.00   0.00   0.00
-IOSTAT = re.compile(r'([\w-]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+[\d.]+\s+[\d.]+\s+[\d.]+\s+[\d.]+\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)')
+# Metrics, in the order they appear in the csv
+ALL_METRICS = (RD_PER_SEC, RD_MB_SEC, RD_LAT_MS,
+               WR_PER_SEC, WR_MB_SEC, WR_LAT_MS,
+               QU_SZ)
 
-RD_PER_SEC = "rd_per_sec"
-RD_MB_SEC = "rd_mb_sec"
-RD_LAT_MS = "rd_lat_ms"
+# Bump when the summary histograms change, to invalidate cached ones
+SUMMARY_VERSION = 1
 
-WR_PER_SEC = "wr_per_sec"
-WR_MB_SEC = "wr_mb_sec"
-WR_LAT_MS = "wr_lat_ms"
+# Percentiles of the summary
+PERCENTILES = (50, 95, 99, 99.9)
 
-QU_SZ = 'qu_sz'
 
-ALL_METRICS = (RD_PER_SEC, RD_MB_SEC, RD_LAT_MS,
-               WR_PER_SEC, WR_MB_SEC, WR_LAT_MS,
-               QU_SZ)
+def parse_summary(opts):
+    # histogram of every metric of every block device; unless the samples are limited, the log is
+    # parsed a chunk at a time, so that the memory does not depend on its length
+    histograms = {(blkdev, metric): HdrHistogram() for blkdev in opts.blkdevs for metric in ALL_METRICS}
+    if opts.max_samples > 0:
+        stores = [parse_iostat_cached(opts, 'analyze_iostat', dtype=np.float64)]
+    else:
+        stores = iter_iostat(opts, dtype=np.float64)
+    for store in stores:
+        for (blkdev, metric), hist in histograms.items():
+            hist.record(store.column(blkdev, metric))
+    return histograms
+
+
+def parse_summary_cached(opts):
+    params = {'iostat_parser_version': IOSTAT_PARSER_VERSION, 'blkdevs': opts.blkdevs, 'dont_cut_first_line': opts.dont_cut_first_line,
+              'max_samples': opts.max_samples, 'samples_from_end': opts.samples_from_end}
+    return cached_parse(opts.infile, 'analyze_iostat_summary', SUMMARY_VERSION, params,
+                        lambda: parse_summary(opts), histograms_to_arrays, histograms_from_arrays,
+                        enabled=not opts.no_cache)
+
+
+def print_summary(histograms, blkdevs, metrics):
+    row_fmt = '{:<16} {:<12} {:>10} {:>10} {:>10} {:>10}' + ' {:>10}' * len(PERCENTILES) + ' {:>10}'
+    print(row_fmt.format('device', 'metric', 'samples', 'mean', 'stddev', 'min',
+                         *['p{}'.format(percentile) for percentile in PERCENTILES], 'max'))
+    for blkdev in blkdevs:
+        for metric in ALL_METRICS:
+            hist = histograms.get((blkdev, metric))
+            if metric not in metrics or hist is None:
+                continue
+            values = [hist.mean, hist.stddev(), hist.min] + [hist.percentile(percentile) for percentile in PERCENTILES] + [hist.max]
+            print(row_fmt.format(blkdev, metric, hist.count, *['-' if val != val else '{:.2f}'.format(val) for val in values]))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='')
-    parser.add_argument('--infile', required=True)
+    parser.add_argument('--infile')
     parser.add_argument('--metrics', default=RD_PER_SEC + ',' + RD_MB_SEC + ',' + RD_LAT_MS + ',' + WR_PER_SEC + ',' + WR_MB_SEC + ',' + WR_LAT_MS)
     parser.add_argument('--max-samples', type=int, default=0)
     parser.add_argument('--samples-from-end', action='store_true')
     parser.add_argument('--dont-cut-first-line', action='store_true')
-    parser.add_argument('blkdevs', nargs='+')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or write the parsed samples cache')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='number of parsing processes, default is the number of CPUs')
+    parser.add_argument('--summary', action='store_true',
+                        help='print percentiles, mean and stddev of every metric of every block device instead of writing the csv')
+    parser.add_argument('--save-summary', help='save the summary histograms to this file, to merge them later with --merge-summary')
+    parser.add_argument('--merge-summary', nargs='+', default=[],
+                        help='summary files of other logs or hosts, saved with --save-summary, to merge into the summary; '
+                             'without --infile, only they are summarized')
+    parser.add_argument('blkdevs', nargs='*', help='block devices; when only merging summaries, the default is all of them')
 
     opts = parser.parse_args()
     metrics = set(opts.metrics.split(','))
@@ -52,117 +88,53 @@ if __name__ == '__main__':
     for metric in metrics:
         if metric not in ALL_METRICS:
             bug('Unknown metric: {}'.format(metric))
-
-    samples = []
-
-    curr_header = None
-    curr_sample = {}
-
-    with open(opts.infile, 'r') as fin:
-        for line in fin:
-            m = HEADER.match(line)
-            if m is not None:
-                if curr_header is not None:
-                    samples.append((curr_header, curr_sample))
-                curr_header = m.group(1)
-                curr_sample = {}
-                continue
-
-            m = IOSTAT.match(line)
-            if m is not None:
-                if curr_header is None:
-                    bug('Did not see a timestamp header before line:\n{}'.format(line))
-
-                blkdev = m.group(1)
-                if blkdev not in opts.blkdevs:
-                    continue
-
-                curr_sample[blkdev] = {RD_PER_SEC: float(m.group(2)), WR_PER_SEC: float(m.group(3)),
-                                       # we actually store KB/sec here
-                                       RD_MB_SEC: float(m.group(4)), WR_MB_SEC: float(m.group(5)),
-                                       RD_LAT_MS: float(m.group(6)), WR_LAT_MS: float(m.group(7)),
-                                       QU_SZ: float(m.group(8))}
-
-    if curr_header is not None:
-        samples.append((curr_header, curr_sample))
-
-    print('Total {} samples'.format(len(samples)))
-
-    # First line in iostat output contains bogus values, cut it
-    cut_first_line = not opts.dont_cut_first_line
-    if cut_first_line:
-        print('Cutting first line of iostat output')
-        samples = samples[1:]
-
-    # Limit to max_samples
-    if opts.max_samples > 0:
-        print('Limiting to {} samples{}'.format(opts.max_samples, ' (from end)' if opts.samples_from_end else ''))
-        if opts.samples_from_end:
-            samples = samples[len(samples) - opts.max_samples:]
-        else:
-            samples = samples[:opts.max_samples]
+    if opts.merge_summary or opts.save_summary:
+        opts.summary = True
+    if opts.infile is None and not opts.merge_summary:
+        bug('No input file specified')
+    if opts.infile is not None and not opts.blkdevs:
+        bug('No block devices specified')
+
+    if opts.summary:
+        histograms = parse_summary_cached(opts) if opts.infile is not None else {}
+        for fname in opts.merge_summary:
+            print('Merging summary {}...'.format(fname))
+            merge_histograms(histograms, load_histograms(fname))
+        if opts.save_summary:
+            save_histograms(opts.save_summary, histograms)
+
+        blkdevs = opts.blkdevs
+        if not blkdevs:
+            blkdevs = []
+            for blkdev, _ in histograms:
+                if blkdev not in blkdevs:
+                    blkdevs.append(blkdev)
+        print_summary(histograms, blkdevs, metrics)
+        sys.exit(0)
+
+    # csv values are printed with 2 decimal digits, keep full precision
+    store = parse_iostat_cached(opts, 'analyze_iostat', dtype=np.float64)
 
     # Produce results
     with open(opts.infile + '.csv', 'w') as csvf:
         csv_writer = csv.writer(csvf)
 
+        # (blkdev index, metric index) for each csv column, after the timestamp
+        columns = []
         row = ['timestamp']
         for blkdev in opts.blkdevs:
-            if RD_PER_SEC in metrics:
-                row.append('{}_{}'.format(blkdev, RD_PER_SEC))
-            if RD_MB_SEC in metrics:
-                row.append('{}_{}'.format(blkdev, RD_MB_SEC))
-            if RD_LAT_MS in metrics:
-                row.append('{}_{}'.format(blkdev, RD_LAT_MS))
-            if WR_PER_SEC in metrics:
-                row.append('{}_{}'.format(blkdev, WR_PER_SEC))
-            if WR_MB_SEC in metrics:
-                row.append('{}_{}'.format(blkdev, WR_MB_SEC))
-            if WR_LAT_MS in metrics:
-                row.append('{}_{}'.format(blkdev, WR_LAT_MS))
-            if QU_SZ in metrics:
-                row.append('{}_{}'.format(blkdev, QU_SZ))
+            for metric in ALL_METRICS:
+                if metric in metrics:
+                    row.append('{}_{}'.format(blkdev, metric))
+                    columns.append((store.entity_idx[blkdev], store.metric_idx[metric]))
         csv_writer.writerow(row)
 
-        num_samples = 0
-        for curr_header, curr_sample in samples:
+        values = store.values
+        for sample_idx, curr_header in enumerate(store.labels):
+            sample_values = values[sample_idx]
             row = [curr_header]
-            for blkdev in opts.blkdevs:
-                blkdev_stats = curr_sample.get(blkdev)
-                if RD_PER_SEC in metrics:
-                    if blkdev_stats is None:
-                        row.append('-')
-                    else:
-                        row.append('{:.2f}'.format(blkdev_stats[RD_PER_SEC]))
-                if RD_MB_SEC in metrics:
-                    if blkdev_stats is None:
-                        row.append('-')
-                    else:
-                        row.append('{:.2f}'.format(blkdev_stats[RD_MB_SEC] / 1024))
-                if RD_LAT_MS in metrics:
-                    if blkdev_stats is None:
-                        row.append('-')
-                    else:
-                        row.append('{:.2f}'.format(blkdev_stats[RD_LAT_MS]))
-                if WR_PER_SEC in metrics:
-                    if blkdev_stats is None:
-                        row.append('-')
-                    else:
-                        row.append('{:.2f}'.format(blkdev_stats[WR_PER_SEC]))
-                if WR_MB_SEC in metrics:
-                    if blkdev_stats is None:
-                        row.append('-')
-                    else:
-                        row.append('{:.2f}'.format(blkdev_stats[WR_MB_SEC] / 1024))
-                if WR_LAT_MS in metrics:
-                    if blkdev_stats is None:
-                        row.append('-')
-                    else:
-                        row.append('{:.2f}'.format(blkdev_stats[WR_LAT_MS]))
-                if QU_SZ in metrics:
-                    if blkdev_stats is None:
-                        row.append('-')
-                    else:
-                        row.append('{:.2f}'.format(blkdev_stats[QU_SZ]))
+            for blkdev_idx, metric_idx in columns:
+                val = sample_values[blkdev_idx, metric_idx]
+                # NaN means the block device was not reported in this sample
+                row.append('-' if val != val else '{:.2f}'.format(val))
             csv_writer.writerow(row)
-            num_samples += 1
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import datetime
+import time
+
+from log_timestamps import iostat_ts, syslog_ts, date_cmd_ts, TimeOfDayClock
+
+
+# Compares parsing of our log timestamp layouts with log_timestamps against datetime.strptime.
+# Timestamps are one second apart, like in a log, so that the date part repeats.
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def gen_timestamps(fmt, nr):
+    start = datetime.datetime(2020, 10, 22, 10, 49, 59, 999984)
+    return [(start + datetime.timedelta(seconds=idx)).strftime(fmt) for idx in range(nr)]
+
+
+def strptime_epoch_ns(fmt):
+    def parse(ts):
+        return (datetime.datetime.strptime(ts, fmt) - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+    return parse
+
+
+# (name, layout to generate, strptime layout, fast parser factory)
+LAYOUTS = (
+    ('iostat', '%m/%d/%y %H:%M:%S', '%m/%d/%y %H:%M:%S', lambda: iostat_ts),
+    ('mpstat', '%H:%M:%S', '%H:%M:%S', TimeOfDayClock),
+    ('syslog', '%b %d %H:%M:%S.%f', '%b %d %H:%M:%S.%f', lambda: syslog_ts),
+    ('date', '%a %b %d %H:%M:%S UTC %Y', '%a %b %d %H:%M:%S UTC %Y', lambda: date_cmd_ts),
+)
+
+
+def run(parse, timestamps):
+    start = time.perf_counter()
+    for ts in timestamps:
+        parse(ts)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the log timestamp parsing')
+    parser.add_argument('-n', '--nr-timestamps', type=int, default=200000)
+    opts = parser.parse_args()
+
+    for name, gen_fmt, strptime_fmt, fast_factory in LAYOUTS:
+        timestamps = gen_timestamps(gen_fmt, opts.nr_timestamps)
+
+        # both parsers have to agree, except for mpstat, which strptime puts on 1900-01-01
+        if name != 'mpstat':
+            slow = strptime_epoch_ns(strptime_fmt)
+            fast = fast_factory()
+            year = 1900 if name == 'syslog' else None
+            for ts in timestamps[:1000]:
+                expected = slow(ts)
+                got = fast(ts) if year is None else fast(ts, year)
+                if expected != got:
+                    print('MISMATCH {}: {} strptime {} fast {}'.format(name, ts, expected, got), file=sys.stderr)
+                    sys.exit(1)
+
+        slow_sec = run(strptime_epoch_ns(strptime_fmt), timestamps)
+        fast_sec = run(fast_factory(), timestamps)
+        print('{:<7} {:>8} timestamps  strptime {:>6.3f} sec  fast {:>6.3f} sec  speedup {:.1f}x'.format(
+            name, len(timestamps), slow_sec, fast_sec, slow_sec / fast_sec))
@@ -1,6 +1,4 @@
-#!/usr/bin/env python
-
-from __future__ import print_function
+#!/usr/bin/env python3
 
 import sys
 import time
@@ -9,6 +7,11 @@ import argparse
 import re
 import csv
 import subprocess
+import math
+import json
+import concurrent.futures
+import threading
+import selectors
 
 
 def end(exit_rc):
@@ -20,27 +23,59 @@ def error(msg):
     end(1)
 
 
-def run_cmd(cmd):
+def run_cmd(cmd, on_stdout_line=None):
+    # Reads stdout and stderr as the command writes them. Stdout lines go to on_stdout_line if given, else they are
+    # returned with the stderr ones; on_stdout_line returns False to kill the command.
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    while p.poll() is None:
-        time.sleep(0.1)
-
-    stdout, stderr = p.communicate()
-
-    return p.returncode, stdout.splitlines(), stderr.splitlines()
-
-
-def run_cmd_success(cmd):
-    rc, stdout, stderr = run_cmd(cmd)
-    if rc != 0:
-        error('Command failed:\n{}\nstdout:\n{}\nstderr:\n{}'.format(cmd, stdout, stderr))
-    return stdout, stderr
+    lines = {p.stdout: [], p.stderr: []}
+    partial = {p.stdout: b'', p.stderr: b''}
+    killed = False
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(p.stdout, selectors.EVENT_READ)
+        selector.register(p.stderr, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                pipe = key.fileobj
+                data = os.read(key.fd, 65536)
+                if data:
+                    new_lines = (partial[pipe] + data).split(b'\n')
+                    partial[pipe] = new_lines.pop()
+                else:
+                    # end of the output
+                    selector.unregister(pipe)
+                    new_lines = [partial[pipe]] if partial[pipe] else []
+                for line in new_lines:
+                    line = line.decode(errors='replace')
+                    if pipe is p.stderr or on_stdout_line is None:
+                        lines[pipe].append(line)
+                    elif not killed and on_stdout_line(line) is False:
+                        p.kill()
+                        killed = True
+
+    p.wait()
+    p.stdout.close()
+    p.stderr.close()
+
+    return p.returncode, lines[p.stdout], lines[p.stderr]
 
 ############################################################################
 
 IO_SIZES_STR = ('512', '1k', '2k', '4k', '8k', '16k', '32k', '64k', '128k', '256k', '512k', '1024k')
-IO_SIZES_BYTES = (512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
 QUEUE_SIZES = (1, 16, 32, 256)
+# Queue depths which the saturation search walks through, unless given
+SATURATION_QUEUE_SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# 4k, 1m etc.
+SIZE_RE = re.compile(r'^(\d+)([kmg]?)$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+
+
+def size_bytes(size_str):
+    m = SIZE_RE.match(size_str)
+    if m is None:
+        error('Invalid IO size {}'.format(size_str))
+    return int(m.group(1)) * SIZE_UNITS[m.group(2).lower()]
 
 ############################################################################
 
@@ -53,14 +88,52 @@ BW_RE = re.compile(r'^\s+bw \(\s*(K|M)iB/s\): .+, avg=([0-9\.]+),')
 
 IOPS_RE = re.compile(r'^\s+iops\s*: .+, avg=([0-9\.]+),')
 
+# Output files of a cell: run_fio_loop writes json+, older runs have the text output
+JSON_EXT = '.json'
+TEXT_EXT = '.fio'
+# <IO size>_<queue depth>, like 4k_16.json
+CELL_FNAME_RE = re.compile(r'^(\d+[kmg]?)_(\d+)(?:{}|{})$'.format(re.escape(JSON_EXT), re.escape(TEXT_EXT)), re.IGNORECASE)
+
+DIRECTIONS = ('read', 'write')
+
+# Values parsed for a direction of a cell, formatted for the csv; the text output has only the first three
+LAT_MS = 'lat_ms'
+BW_KBSEC = 'bw_kbsec'
+IOPS = 'iops'
+CLAT_PERCENTILES = (50, 99, 99.9, 99.99)
+CLAT_PERCENTILE_KEYS = tuple('clat_p{}_ms'.format(percentile) for percentile in CLAT_PERCENTILES)
+USR_CPU = 'usr_cpu'
+SYS_CPU = 'sys_cpu'
+# telemetry of the cell, when collected: means over the cell of the device %util and await of the direction,
+# and of the CPU usage, iowait and usage of the busiest CPU
+DEV_UTIL = 'dev_util'
+DEV_AWAIT = 'dev_await_ms'
+CPU_USAGE = 'cpu_usage'
+CPU_IOWAIT = 'cpu_iowait'
+CPU_BUSIEST = 'cpu_busiest'
+# whether fio's steady state criterion was met ('yes'/'no'), None when the run did not look for it
+SS_ATTAINED = 'ss_attained'
+RUNTIME_SEC = 'runtime_sec'
+# list of (clat ns, count)
+CLAT_HIST = 'clat_hist'
+
+# (value, csv column) of the rd_/wr_ csv files, after the IO size and the queue depth
+CSV_VALUES = ((LAT_MS, 'latency (ms)'), (BW_KBSEC, 'bw (kb/sec)'), (IOPS, 'IOPs')) + \
+             tuple((key, 'clat p{} (ms)'.format(percentile)) for percentile, key in zip(CLAT_PERCENTILES, CLAT_PERCENTILE_KEYS)) + \
+             ((USR_CPU, 'usr cpu %'), (SYS_CPU, 'sys cpu %'), (SS_ATTAINED, 'steady state'), (RUNTIME_SEC, 'runtime (s)'),
+              (DEV_UTIL, 'dev util %'), (DEV_AWAIT, 'dev await (ms)'), (CPU_USAGE, 'cpu %'), (CPU_IOWAIT, 'cpu iowait %'),
+              (CPU_BUSIEST, 'busiest cpu %'))
+
+NSEC_PER_MSEC = 1000 * 1000
+
 
 def parse_fio_output_file(fpath):
     if not os.path.isfile(fpath):
         error('{} does not exist'.format(fpath))
     print('Parsing {}'.format(fpath))
 
-    res = {'read': {'lat_ms': None, 'bw_kbsec': None, 'iops': None},
-           'write': {'lat_ms': None, 'bw_kbsec': None, 'iops': None}
+    res = {'read': {LAT_MS: None, BW_KBSEC: None, IOPS: None},
+           'write': {LAT_MS: None, BW_KBSEC: None, IOPS: None}
           }
     section = None
 
@@ -113,57 +186,296 @@ def parse_fio_output_file(fpath):
                 iops = '{:.0f}'.format(float(iops_str))
                 res[section]['iops'] = iops
 
-    read_lat =   res['read']['lat_ms']
-    read_bw =    res['read']['bw_kbsec']
-    read_iops =  res['read']['iops']
-    write_lat =  res['write']['lat_ms']
-    write_bw =   res['write']['bw_kbsec']
-    write_iops = res['write']['iops']
-    ok_read = (read_lat is None and read_bw is None and read_iops is None) or\
-              (read_lat is not None and read_bw is not None and read_iops is not None)
-    ok_write = (write_lat is None and write_bw is None and write_iops is None) or\
-               (write_lat is not None and write_bw is not None and write_iops is not None)
-    if not (ok_read and ok_write):
-        error('{}: partial data seen:\n{}'.format(fpath, res))
-
-    return read_lat, read_bw, read_iops, write_lat, write_bw, write_iops
+    for direction in DIRECTIONS:
+        nr_values = sum(1 for val in res[direction].values() if val is not None)
+        if nr_values not in (0, len(res[direction])):
+            error('{}: partial data seen:\n{}'.format(fpath, res))
+        if nr_values == 0:
+            res[direction] = None
+
+    return res
+
+
+def parse_fio_json_file(fpath):
+    # Parses the json+ output, which has the clat percentiles, the CPU usage and the clat histogram as well
+    if not os.path.isfile(fpath):
+        error('{} does not exist'.format(fpath))
+    print('Parsing {}'.format(fpath))
+
+    with open(fpath, 'r') as fio_fin:
+        text = fio_fin.read()
+    # fio may print warnings before the json
+    try:
+        fio_json = json.loads(text[text.find('{'):])
+    except ValueError as e:
+        error('{}: not a fio json output: {}'.format(fpath, e))
+    jobs = fio_json.get('jobs')
+    if not jobs or len(jobs) != 1:
+        error('{}: expected a single (group reported) job, got {}'.format(fpath, len(jobs) if jobs else 0))
+    job = jobs[0]
+    steadystate = job.get('steadystate')
+    ss_attained = None if steadystate is None else ('yes' if steadystate.get('attained') else 'no')
+    runtime_sec = job.get('elapsed')
+
+    res = {}
+    for direction in DIRECTIONS:
+        stats = job.get(direction)
+        if stats is None or stats.get('total_ios', stats.get('io_bytes', 0)) == 0:
+            res[direction] = None
+            continue
+        clat = stats['clat_ns']
+        percentiles = clat.get('percentile', {})
+        values = {LAT_MS: '{:.3f}'.format(stats['lat_ns']['mean'] / NSEC_PER_MSEC),
+                  BW_KBSEC: '{:.3f}'.format(stats['bw']),
+                  IOPS: '{:.0f}'.format(stats['iops']),
+                  USR_CPU: '{:.2f}'.format(job['usr_cpu']),
+                  SYS_CPU: '{:.2f}'.format(job['sys_cpu']),
+                  SS_ATTAINED: ss_attained,
+                  RUNTIME_SEC: runtime_sec,
+                  CLAT_HIST: sorted((int(lat_ns), count) for lat_ns, count in clat.get('bins', {}).items())}
+        for percentile, key in zip(CLAT_PERCENTILES, CLAT_PERCENTILE_KEYS):
+            lat_ns = percentiles.get('{:f}'.format(percentile))
+            values[key] = None if lat_ns is None else '{:.3f}'.format(lat_ns / NSEC_PER_MSEC)
+        res[direction] = values
+
+    return res
+
+
+def iostat_devices(fpath):
+    # the devices of the first report of an iostat output
+    devices = []
+    with open(fpath, 'r') as fin:
+        for line in fin:
+            if devices or line.startswith('Device'):
+                fields = line.split()
+                if not fields:
+                    break
+                devices.append(fields[0])
+    return devices[1:]
+
+
+def iostat_summary(fpath):
+    # {metric: mean over the samples and the devices} of the iostat output of a cell
+    # the parsers need numpy, import them only when there is telemetry to summarize
+    import numpy as np
+    from iostat_parser import parse_iostat, IostatFormatError, UTIL, RD_LAT_MS, WR_LAT_MS
+
+    devices = iostat_devices(fpath)
+    if not devices:
+        return {}
+    try:
+        store = parse_iostat(argparse.Namespace(infile=fpath, blkdevs=devices, dont_cut_first_line=False, max_samples=0,
+                                                samples_from_end=False, jobs=1), dtype=np.float64, verbose=False)
+    except IostatFormatError as e:
+        # the telemetry columns of the cell stay empty
+        print('WARNING: {}: {}'.format(fpath, e), file=sys.stderr)
+        return {}
+    summary = {}
+    for metric in (UTIL, RD_LAT_MS, WR_LAT_MS):
+        values = store.values[:, :, store.metric_idx[metric]]
+        if not np.isnan(values).all():
+            summary[metric] = '{:.2f}'.format(np.nanmean(values))
+    return summary
+
+
+def mpstat_summary(fpath):
+    # {value: mean over the samples} of the mpstat -P ALL output of a cell
+    import numpy as np
+    import plot_mpstat
+
+    store = plot_mpstat.parse_mpstat(argparse.Namespace(infile=fpath), verbose=False)
+    if len(store) == 0 or 'all' not in store.entity_idx:
+        return {}
+    usage = 100 - store.values[:, :, store.metric_idx[plot_mpstat.IDLE]]
+    all_idx = store.entity_idx['all']
+    summary = {CPU_USAGE: '{:.2f}'.format(np.nanmean(usage[:, all_idx])),
+               CPU_IOWAIT: '{:.2f}'.format(np.nanmean(store.values[:, all_idx, store.metric_idx[plot_mpstat.IOWAIT]]))}
+    cpu_idxs = [idx for cpu, idx in store.entity_idx.items() if cpu != 'all']
+    if cpu_idxs:
+        summary[CPU_BUSIEST] = '{:.2f}'.format(np.nanmax(np.nanmean(usage[:, cpu_idxs], axis=0)))
+    return summary
+
+
+def add_telemetry(cell_fpath_base, res):
+    # adds the summaries of the telemetry collected with the cell, if any, to its values
+    summary = {}
+    if os.path.isfile(cell_fpath_base + '.iostat'):
+        from iostat_parser import UTIL, RD_LAT_MS, WR_LAT_MS
+        iostat = iostat_summary(cell_fpath_base + '.iostat')
+        summary = {DEV_UTIL: iostat.get(UTIL), 'read': iostat.get(RD_LAT_MS), 'write': iostat.get(WR_LAT_MS)}
+    if os.path.isfile(cell_fpath_base + '.mpstat'):
+        summary.update(mpstat_summary(cell_fpath_base + '.mpstat'))
+    if not summary:
+        return
+    for direction in DIRECTIONS:
+        if res[direction] is not None:
+            res[direction].update({DEV_UTIL: summary.get(DEV_UTIL), DEV_AWAIT: summary.get(direction),
+                                   CPU_USAGE: summary.get(CPU_USAGE), CPU_IOWAIT: summary.get(CPU_IOWAIT),
+                                   CPU_BUSIEST: summary.get(CPU_BUSIEST)})
+
+
+def parse_cell_file(fpath):
+    if fpath.endswith(JSON_EXT):
+        res = parse_fio_json_file(fpath)
+    else:
+        res = parse_fio_output_file(fpath)
+    add_telemetry(os.path.splitext(fpath)[0], res)
+    return res
+
+
+def parse_run(dpath, jobs):
+    # {(IO size bytes, queue depth): {direction: values or None}} of the cells of a run_fio_loop output directory,
+    # whichever cells it has; the cell files are parsed concurrently
+    if not os.path.isdir(dpath):
+        error('{} does not exist'.format(dpath))
+    cell_fpaths = {}
+    for fname in sorted(os.listdir(dpath)):
+        m = CELL_FNAME_RE.match(fname)
+        if m is None:
+            continue
+        cell = (size_bytes(m.group(1)), int(m.group(2)))
+        # the json+ output if the run has it
+        if cell not in cell_fpaths or fname.endswith(JSON_EXT):
+            cell_fpaths[cell] = os.path.join(dpath, fname)
+    if not cell_fpaths:
+        error('{}: no fio results'.format(dpath))
+    cells = sorted(cell_fpaths)
+    fpaths = [cell_fpaths[cell] for cell in cells]
+
+    jobs = min(jobs if jobs > 0 else os.cpu_count(), len(fpaths))
+    if jobs <= 1:
+        return dict(zip(cells, [parse_cell_file(fpath) for fpath in fpaths]))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(cells, executor.map(parse_cell_file, fpaths)))
 
 ############################################################################
 
 
-def open_csv_file(fpath, is_read):
+def open_csv_file(fpath, prefix, header):
     head, tail = os.path.split(fpath)
-    fpath = os.path.join(head, '{}_{}'.format('rd' if is_read else 'wr', tail))
+    fpath = os.path.join(head, '{}_{}'.format(prefix, tail))
 
-    csvf = open(fpath, 'wb', 0)
+    csvf = open(fpath, 'w', newline='')
     csv_writer = csv.writer(csvf)
-    csv_writer.writerow(('IO size (bytes)', 'queue depth', 'latency (ms)', 'bw (kb/sec)', 'IOPs'))
+    csv_writer.writerow(header)
     return csvf, csv_writer
 
 
+def runs_to_csv(outfile, runs):
+    # runs: list of (device, cells of parse_run()); with a device, the rows start with a device column
+    for direction, prefix in zip(DIRECTIONS, ('rd', 'wr')):
+        csvf = None
+        hist_csvf = None
+        for device, cells in runs:
+            device_header = () if device is None else ('device',)
+            device_column = () if device is None else (device,)
+            for io_size_bytes, queue_size in sorted(cells):
+                values = cells[(io_size_bytes, queue_size)][direction]
+                if values is None:
+                    continue
+                if csvf is None:
+                    csvf, csv_writer = open_csv_file(outfile, prefix, device_header + ('IO size (bytes)', 'queue depth') +
+                                                     tuple(column for _, column in CSV_VALUES))
+                # values missing from the text output are empty
+                csv_writer.writerow(device_column + (io_size_bytes, queue_size) + tuple(values.get(key) for key, _ in CSV_VALUES))
+
+                if values.get(CLAT_HIST):
+                    if hist_csvf is None:
+                        hist_csvf, hist_csv_writer = open_csv_file(outfile, prefix + '_hist', device_header +
+                                                                   ('IO size (bytes)', 'queue depth', 'clat (ns)', 'count'))
+                    for lat_ns, count in values[CLAT_HIST]:
+                        hist_csv_writer.writerow(device_column + (io_size_bytes, queue_size, lat_ns, count))
+
+        if csvf is not None:
+            csvf.close()
+        if hist_csvf is not None:
+            hist_csvf.close()
+
+
 def dir_to_csv(opts):
-    read_csvf = None
-    read_csv_writer = None
-    write_csvf = None
-    write_csv_writer = None
-
-    for io_size_str, io_size_bytes in zip(IO_SIZES_STR, IO_SIZES_BYTES):
-        for queue_size in QUEUE_SIZES:
-            fio_fpath = os.path.join(opts.dir, '{}_{}.fio'.format(io_size_str, queue_size))
-            read_lat, read_bw, read_iops, write_lat, write_bw, write_iops = parse_fio_output_file(fio_fpath)
-            if read_lat is not None:
-                if read_csvf is None:
-                    read_csvf, read_csv_writer = open_csv_file(opts.outfile, True)
-                read_csv_writer.writerow((io_size_bytes, queue_size, read_lat, read_bw, read_iops))
-            if write_lat is not None:
-                if write_csvf is None:
-                    write_csvf, write_csv_writer = open_csv_file(opts.outfile, False)
-                write_csv_writer.writerow((io_size_bytes, queue_size, write_lat, write_bw, write_iops))
-
-    if read_csvf is not None:
-        read_csvf.close()
-    if write_csvf is not None:
-        write_csvf.close()
+    runs_to_csv(opts.outfile, [(None, parse_run(opts.dir, opts.jobs))])
+
+############################################################################
+
+
+# Exit code of compare when a cell regressed, to tell it apart from a failure to compare
+REGRESSION_RC = 2
+
+# (metric, whether higher is better); the percentiles are compared when both runs have them
+COMPARE_METRICS = ((LAT_MS, False), (BW_KBSEC, True), (IOPS, True)) + tuple((key, False) for key in CLAT_PERCENTILE_KEYS)
+
+
+def mean_and_rel_var(values):
+    # mean of the repeated runs of a cell and the variance of the mean relative to it, 0 for a single run
+    mean = sum(values) / len(values)
+    if len(values) < 2 or mean == 0:
+        return mean, 0.0
+    var = sum((val - mean) ** 2 for val in values) / (len(values) - 1)
+    return mean, var / len(values) / (mean * mean)
+
+
+def compare_cell(opts, base_values, cand_values, higher_is_better):
+    # Returns (baseline mean, candidate mean, delta %, threshold %, regressed); delta is None if the baseline is 0.
+    # The noise of the cell is the standard error of the relative difference of the means, estimated from the
+    # repeated runs; a cell regressed if it got worse by more than noise_sigmas of it and at least threshold_pct.
+    base_mean, base_rel_var = mean_and_rel_var(base_values)
+    cand_mean, cand_rel_var = mean_and_rel_var(cand_values)
+    threshold = max(opts.threshold_pct, opts.noise_sigmas * math.sqrt(base_rel_var + cand_rel_var) * 100)
+    if base_mean == 0:
+        return base_mean, cand_mean, None, threshold, False
+    delta = (cand_mean - base_mean) / base_mean * 100
+    worse = -delta if higher_is_better else delta
+    return base_mean, cand_mean, delta, threshold, worse > threshold
+
+
+def compare(opts):
+    base_runs = [parse_run(dpath, opts.jobs) for dpath in opts.baseline]
+    cand_runs = [parse_run(dpath, opts.jobs) for dpath in opts.candidate]
+
+    header = ('direction', 'IO size (bytes)', 'queue depth', 'metric', 'baseline', 'candidate', 'delta %', 'threshold %', 'status')
+    rows = []
+    nr_regressed = 0
+    # cells which all the runs have
+    for cell in sorted(set.intersection(*[set(run) for run in base_runs + cand_runs])):
+        io_size_bytes, queue_size = cell
+        for direction in DIRECTIONS:
+            if any(run[cell][direction] is None for run in base_runs + cand_runs):
+                continue
+            for metric, higher_is_better in COMPARE_METRICS:
+                base_values = [run[cell][direction].get(metric) for run in base_runs]
+                cand_values = [run[cell][direction].get(metric) for run in cand_runs]
+                if None in base_values or None in cand_values:
+                    continue
+                base_mean, cand_mean, delta, threshold, regressed = compare_cell(
+                    opts, [float(val) for val in base_values], [float(val) for val in cand_values], higher_is_better)
+                if regressed:
+                    nr_regressed += 1
+                    status = 'REGRESSED'
+                elif delta is not None and (delta if higher_is_better else -delta) > threshold:
+                    status = 'improved'
+                else:
+                    status = ''
+                rows.append((direction, io_size_bytes, queue_size, metric, '{:.3f}'.format(base_mean), '{:.3f}'.format(cand_mean),
+                             '-' if delta is None else '{:+.2f}'.format(delta), '{:.2f}'.format(threshold), status))
+
+    if not rows:
+        error('The runs have no cells in common')
+
+    row_fmt = '{:<6} {:>15} {:>11} {:<15} {:>12} {:>12} {:>8} {:>11} {}'
+    print(row_fmt.format(*header))
+    for row in rows:
+        print(row_fmt.format(*row))
+
+    if opts.outfile is not None:
+        with open(opts.outfile, 'w', newline='') as csvf:
+            csv_writer = csv.writer(csvf)
+            csv_writer.writerow(header)
+            csv_writer.writerows(rows)
+
+    if nr_regressed > 0:
+        print('{} out of {} compared values regressed'.format(nr_regressed, len(rows)))
+        end(REGRESSION_RC)
+    print('No regressions in {} compared values'.format(len(rows)))
 
 ############################################################################
 
@@ -171,45 +483,403 @@ def dir_to_csv(opts):
 MIXED_RWS = ('rw', 'readwrite', 'randrw')
 
 
+# iops|iops_slope|bw|bw_slope:<limit>[%], as fio's --steadystate takes it
+STEADY_STATE_RE = re.compile(r'^(iops|iops_slope|bw|bw_slope):[0-9.]+%?$')
+
+# Every directory of cell results has a journal of the cells which fio finished, a json line per cell
+JOURNAL = 'journal.jsonl'
+
+# Telemetry collectors which --collectors starts around every cell, their output goes to <cell>.<collector>
+COLLECTORS = ('iostat', 'mpstat', 'top')
+
+# Per-interval time series of a cell with --status-interval, like 4k_16.intervals.csv
+INTERVALS_EXT = '.intervals.csv'
+# columns of every direction in it
+INTERVAL_COLUMNS = ('IOPs', 'bw (kb/sec)', 'latency (ms)')
+
+# Keys of a sweep file, a json object like {"io_sizes": ["4k", "64k", "1m"], "queue_depths": [1, 8, 32]}
+SWEEP_IO_SIZES = 'io_sizes'
+SWEEP_QUEUE_DEPTHS = 'queue_depths'
+
+# The IO sizes, their saturation queue depth and IOPS, with --saturation-search, in every directory of cell results
+SATURATION_CSV = 'saturation.csv'
+
+# csv files of a run on several devices, in the output directory, with the rd_/wr_ prefixes
+COMBINED_CSV = 'combined.csv'
+AGGREGATE_CSV = 'aggregate.csv'
+
+
+def fio_cmd(opts, io_size_str, io_size_bytes, queue_size, bdevs, fio_out_fpath):
+    # a job per block device; with several, group reporting gives their aggregate
+    cmd = ['fio']
+    if opts.status_interval > 0:
+        # the status reports are read from stdout, the last one is the result
+        cmd.append('--status-interval={}'.format(opts.status_interval))
+    else:
+        cmd.append('--output={}'.format(fio_out_fpath))
+    cmd += ['--output-format=json+',
+           '--rw={}'.format(opts.io_pattern),
+           '--bs={}'.format(io_size_bytes),
+           '--numjobs=1',
+           '--iodepth={}'.format(queue_size),
+           '--runtime={}'.format(opts.runtime),
+           '--time_based',
+           '--size=100%',
+           '--loops=1',
+           '--ioengine=libaio',
+           '--direct=1',
+           '--invalidate=1',
+           '--fsync_on_close=1',
+           '--randrepeat=1',
+           '--norandommap',
+           '--group_reporting',
+           '--exitall']
+    if opts.io_pattern in MIXED_RWS:
+        cmd.append('--rwmixread={}'.format(opts.readpct))
+    if opts.steady_state is not None:
+        # fio ends the job once the criterion holds over the last window, but not before the minimal runtime;
+        # with a job per device, group reporting applies it to all of them together
+        cmd.extend(['--steadystate={}'.format(opts.steady_state),
+                    '--steadystate_duration={}'.format(opts.ss_window),
+                    '--steadystate_ramp_time={}'.format(max(0, opts.ss_min_runtime - opts.ss_window))])
+    for bdev in bdevs:
+        cmd.append('--name={}_{}'.format(io_size_str, queue_size))
+        cmd.append('--filename={}'.format(bdev))
+    return cmd
+
+
+class FioStatus(object):
+    """Follows the json status reports which fio prints every --status-interval, and once more when it ends.
+
+    The reports are cumulative: every interval gets the difference between a report and the one before it,
+    written as a row of the cell's intervals csv and printed as a line.
+    """
+
+    def __init__(self, opts, desc, csv_writer):
+        self.opts = opts
+        self.desc = desc
+        self.csv_writer = csv_writer
+        csv_writer.writerow(('elapsed (s)',) + tuple('{} {}'.format(direction, column)
+                                                    for direction in DIRECTIONS for column in INTERVAL_COLUMNS))
+        # lines of the report being read
+        self.lines = []
+        self.last_report = None
+        # job runtime (ms) and {direction: (ios, bytes, total latency ns)} of the last report
+        self.prev = (0, {direction: (0, 0, 0.0) for direction in DIRECTIONS})
+        self.nr_stalled = 0
+        # set when the cell is killed
+        self.abort_reason = None
+
+    def add_line(self, line):
+        # returns False to kill fio
+        if not self.lines and not line.startswith('{'):
+            # not in a report
+            return True
+        self.lines.append(line)
+        # a report ends with its closing brace at the start of a line
+        if not line.startswith('}'):
+            return True
+        text = '\n'.join(self.lines) + '\n'
+        self.lines = []
+        try:
+            report = json.loads(text)
+        except ValueError:
+            return True
+        self.last_report = text
+        return self.add_report(report)
+
+    def add_report(self, report):
+        jobs = report.get('jobs')
+        if not jobs:
+            return True
+        job = jobs[0]
+        runtime_ms = job.get('job_runtime', job.get('elapsed', 0) * 1000)
+        curr = {}
+        for direction in DIRECTIONS:
+            stats = job.get(direction, {})
+            ios = stats.get('total_ios', 0)
+            lat_ns = stats.get('lat_ns', {})
+            curr[direction] = (ios, stats.get('io_bytes', 0), lat_ns.get('mean', 0.0) * lat_ns.get('N', ios))
+
+        prev = self.prev
+        self.prev = (runtime_ms, curr)
+        if runtime_ms <= prev[0]:
+            return True
+
+        interval_sec = (runtime_ms - prev[0]) / 1000.0
+        row = ['{:.1f}'.format(runtime_ms / 1000.0)]
+        parts = []
+        total_ios = 0
+        for direction in DIRECTIONS:
+            ios = curr[direction][0] - prev[1][direction][0]
+            total_ios += ios
+            if curr[direction][0] == 0:
+                # the direction is not in the run
+                row += [''] * len(INTERVAL_COLUMNS)
+                continue
+            iops = ios / interval_sec
+            bw_kbsec = (curr[direction][1] - prev[1][direction][1]) / 1024.0 / interval_sec
+            lat_ms = (curr[direction][2] - prev[1][direction][2]) / ios / NSEC_PER_MSEC if ios > 0 else 0.0
+            row += ['{:.0f}'.format(iops), '{:.3f}'.format(bw_kbsec), '{:.3f}'.format(lat_ms)]
+            parts.append('{} {:.0f} IOPS {:.1f} MB/s {:.3f} ms'.format(direction, iops, bw_kbsec / 1024, lat_ms))
+        self.csv_writer.writerow(row)
+        print('{} {:.0f}s: {}'.format(self.desc, runtime_ms / 1000.0, ', '.join(parts) if parts else 'no IO'))
+
+        self.nr_stalled = self.nr_stalled + 1 if total_ios == 0 else 0
+        if 0 < self.opts.stall_intervals <= self.nr_stalled:
+            self.abort_reason = 'no IO completed in {} intervals, aborted'.format(self.nr_stalled)
+            print('{}: {}'.format(self.desc, self.abort_reason))
+            return False
+        return True
+
+
+def fio_params(cmd):
+    # what the journal keeps of a fio command: all of it but the output path, which depends on how outdir is given
+    return [arg for arg in cmd[1:] if not arg.startswith('--output=')]
+
+
+def read_journal(outdir):
+    # {cell name: its last journal entry}
+    journal = {}
+    fpath = os.path.join(outdir, JOURNAL)
+    if not os.path.isfile(fpath):
+        return journal
+    with open(fpath, 'r') as fin:
+        for line in fin:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run may be cut
+                continue
+            journal[entry['cell']] = entry
+    return journal
+
+
+def append_journal(outdir, entry):
+    # the entry is on disk before the next cell starts
+    with open(os.path.join(outdir, JOURNAL), 'a') as fout:
+        fout.write(json.dumps(entry, sort_keys=True) + '\n')
+        fout.flush()
+        os.fsync(fout.fileno())
+
+
+def run_cell(opts, bdevs, outdir, journal, io_size_str, io_size_bytes, queue_size):
+    # Runs a cell unless the journal has it as finished successfully (with --resume), returns its output file
+    cell = '{}_{}'.format(io_size_str, queue_size)
+    fio_out_fpath = os.path.join(outdir, cell + JSON_EXT)
+    cmd = fio_cmd(opts, io_size_str, io_size_bytes, queue_size, bdevs, fio_out_fpath)
+    params = fio_params(cmd)
+
+    entry = journal.get(cell)
+    if entry is not None and entry['rc'] == 0 and os.path.isfile(fio_out_fpath):
+        if entry['params'] != params:
+            error('{}: cell {} was run with different parameters:\n{}'.format(outdir, cell, ' '.join(entry['params'])))
+        print('{}: IO size {}, queue depth {}: done already'.format(', '.join(bdevs), io_size_str, queue_size))
+        return fio_out_fpath
+    if os.path.exists(fio_out_fpath):
+        # left by an interrupted or failed run
+        os.unlink(fio_out_fpath)
+
+    print('{}: IO size {}, queue depth {}'.format(', '.join(bdevs), io_size_str, queue_size))
+    start = time.time()
+    collectors = start_collectors(opts, bdevs, outdir, cell)
+    try:
+        rc, stdout, stderr, status = run_fio(opts, cmd, bdevs, outdir, cell, fio_out_fpath)
+    finally:
+        stop_collectors(collectors)
+    if status is not None and status.abort_reason is not None:
+        stderr.append(status.abort_reason)
+    append_journal(outdir, {'cell': cell, 'io_size': io_size_bytes, 'queue_depth': queue_size, 'bdevs': bdevs,
+                            'params': params, 'rc': rc, 'start': start, 'end': time.time()})
+    if rc != 0:
+        error('Command failed:\n{}\nstdout:\n{}\nstderr:\n{}'.format(cmd, stdout, stderr))
+    return fio_out_fpath
+
+
+def run_fio(opts, cmd, bdevs, outdir, cell, fio_out_fpath):
+    # returns rc, stdout, stderr and the FioStatus of the run, if it was followed
+    if opts.status_interval > 0:
+        with open(os.path.join(outdir, cell + INTERVALS_EXT), 'w', newline='') as csvf:
+            status = FioStatus(opts, '{} {}'.format(', '.join(bdevs), cell), csv.writer(csvf))
+            rc, stdout, stderr = run_cmd(cmd, status.add_line)
+        if rc == 0:
+            if status.last_report is None:
+                rc = 1
+                stderr.append('no status report seen')
+            else:
+                with open(fio_out_fpath, 'w') as fout:
+                    fout.write(status.last_report)
+        return rc, stdout, stderr, status
+    rc, stdout, stderr = run_cmd(cmd)
+    return rc, stdout, stderr, None
+
+
+def collector_cmd(name, interval, bdevs):
+    if name == 'iostat':
+        # iostat names the devices by their kernel names, like dm-3 for /dev/mapper/vol
+        return ['iostat', '-d', '-x', '-t', str(interval)] + [os.path.basename(os.path.realpath(bdev)) for bdev in bdevs]
+    if name == 'mpstat':
+        return ['mpstat', '-P', 'ALL', str(interval)]
+    return ['top', '-b', '-d', str(interval)]
+
+
+def start_collectors(opts, bdevs, outdir, cell):
+    # returns [(process, output file)]
+    collectors = []
+    # the timestamps have to be in the layout which the parsers expect
+    env = dict(os.environ, LC_ALL='C')
+    for name in opts.collectors:
+        fout = open(os.path.join(outdir, '{}.{}'.format(cell, name)), 'w')
+        try:
+            p = subprocess.Popen(collector_cmd(name, opts.collect_interval, bdevs), stdout=fout, stderr=subprocess.STDOUT, env=env)
+        except OSError as e:
+            fout.close()
+            stop_collectors(collectors)
+            error('Cannot start {}: {}'.format(name, e))
+        collectors.append((p, fout))
+    return collectors
+
+
+def stop_collectors(collectors):
+    for p, _ in collectors:
+        p.terminate()
+    for p, fout in collectors:
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+        fout.close()
+
+
+def cell_iops(res):
+    # read and write IOPS of a parsed cell together
+    return sum(float(res[direction][IOPS]) for direction in DIRECTIONS if res[direction] is not None)
+
+
+def run_matrix(opts, bdevs, outdir, stop=None):
+    # Runs the cells of the sweep, one after the other, on all of bdevs at once; stops before the next cell once
+    # stop is set. With --resume, the cells which the journal has as finished successfully are skipped, the rest
+    # are rerun. With --saturation-search, the queue depths of an IO size are walked up only while the IOPS grow.
+    os.makedirs(outdir, exist_ok=opts.resume)
+    journal = read_journal(outdir)
+    # (IO size bytes, queue depth, IOPS, saturated) of every IO size
+    knees = []
+    for io_size_str, io_size_bytes in opts.sweep_io_sizes:
+        knee = None
+        for queue_size in opts.sweep_queue_depths:
+            if stop is not None and stop.is_set():
+                return
+            fio_out_fpath = run_cell(opts, bdevs, outdir, journal, io_size_str, io_size_bytes, queue_size)
+            if not opts.saturation_search:
+                continue
+
+            iops = cell_iops(parse_fio_json_file(fio_out_fpath))
+            if knee is not None and iops < knee[2] * (1 + opts.min_gain_pct / 100.0):
+                knee = (io_size_bytes, knee[1], knee[2], 'yes')
+                print('{}: IO size {} saturates at queue depth {}, {:.0f} IOPS'.format(
+                    ', '.join(bdevs), io_size_str, knee[1], knee[2]))
+                break
+            knee = (io_size_bytes, queue_size, iops, 'no')
+        if knee is not None:
+            knees.append(knee)
+
+    if opts.saturation_search:
+        with open(os.path.join(outdir, SATURATION_CSV), 'w', newline='') as csvf:
+            csv_writer = csv.writer(csvf)
+            csv_writer.writerow(('IO size (bytes)', 'queue depth', 'IOPs', 'saturated'))
+            for io_size_bytes, queue_size, iops, saturated in knees:
+                csv_writer.writerow((io_size_bytes, queue_size, '{:.0f}'.format(iops), saturated))
+
+
+def read_sweep(opts):
+    # Sets opts.sweep_io_sizes, list of (IO size as given, bytes), and opts.sweep_queue_depths from the sweep
+    # file and the command line, which overrides the file
+    sweep = {}
+    if opts.sweep is not None:
+        try:
+            with open(opts.sweep, 'r') as fin:
+                sweep = json.load(fin)
+        except (OSError, ValueError) as e:
+            error('Cannot read sweep file {}: {}'.format(opts.sweep, e))
+    if opts.io_sizes is not None:
+        sweep[SWEEP_IO_SIZES] = opts.io_sizes.split(',')
+    if opts.queue_depths is not None:
+        sweep[SWEEP_QUEUE_DEPTHS] = opts.queue_depths.split(',')
+
+    io_sizes = [str(io_size) for io_size in sweep.get(SWEEP_IO_SIZES, IO_SIZES_STR)]
+    default_queue_depths = SATURATION_QUEUE_SIZES if opts.saturation_search else QUEUE_SIZES
+    try:
+        queue_depths = [int(queue_size) for queue_size in sweep.get(SWEEP_QUEUE_DEPTHS, default_queue_depths)]
+    except ValueError as e:
+        error('Invalid queue depth: {}'.format(e))
+    if not io_sizes or not queue_depths or min(queue_depths) < 1:
+        error('The sweep needs IO sizes and positive queue depths')
+    opts.sweep_io_sizes = [(io_size, size_bytes(io_size)) for io_size in io_sizes]
+    if len(set(io_size_bytes for _, io_size_bytes in opts.sweep_io_sizes)) != len(io_sizes) or \
+       len(set(queue_depths)) != len(queue_depths):
+        error('The sweep has repeated IO sizes or queue depths')
+    # the saturation search goes up the queue depths
+    opts.sweep_queue_depths = sorted(queue_depths) if opts.saturation_search else queue_depths
+
+
 def run_fio_loop(opts):
     # create the output directory for the run
-    if os.path.exists(opts.outdir):
-        error('{} already exists'.format(opts.outdir))
-    os.makedirs(opts.outdir)
+    if os.path.exists(opts.outdir) and not opts.resume:
+        error('{} already exists, --resume continues its run'.format(opts.outdir))
 
     if opts.io_pattern in MIXED_RWS:
         if not (opts.readpct > 0 and opts.readpct < 100):
             error('For mixed IO patterns, readpct must be in (0,100)')
 
-    for io_size_str, io_size_bytes in zip(IO_SIZES_STR, IO_SIZES_BYTES):
-        for queue_size in QUEUE_SIZES:
-            fio_out_fpath = os.path.join(opts.outdir, '{}_{}.fio'.format(io_size_str, queue_size))
-            cmd = ['fio',
-                   '--output={}'.format(fio_out_fpath),
-                   '--rw={}'.format(opts.io_pattern),
-                   '--bs={}'.format(io_size_bytes),
-                   '--numjobs=1',
-                   '--iodepth={}'.format(queue_size),
-                   '--runtime={}'.format(opts.runtime),
-                   '--time_based',
-                   '--size=100%',
-                   '--loops=1',
-                   '--ioengine=libaio',
-                   '--direct=1',
-                   '--invalidate=1',
-                   '--fsync_on_close=1',
-                   '--randrepeat=1',
-                   '--norandommap',
-                   '--group_reporting',
-                   '--exitall'
-                  ]
-            if opts.io_pattern in MIXED_RWS:
-                cmd.append('--rwmixread={}'.format(opts.readpct))
-            cmd.append('--name={}_{}'.format(io_size_str, queue_size))
-            cmd.append('--filename={}'.format(opts.bdev))
-
-            print('{}: IO size {}, queue depth {}'.format(opts.bdev, io_size_str, queue_size))
-            run_cmd_success(cmd)
+    if opts.steady_state is not None:
+        if STEADY_STATE_RE.match(opts.steady_state) is None:
+            error('Invalid steady state criterion {}'.format(opts.steady_state))
+        if not (0 < opts.ss_window <= opts.ss_min_runtime <= opts.runtime):
+            error('Steady state window and minimal runtime must be positive and up to runtime')
+
+    if opts.stall_intervals > 0 and opts.status_interval <= 0:
+        error('--stall-intervals needs --status-interval')
+
+    opts.collectors = [name for name in opts.collectors.split(',') if name] if opts.collectors else []
+    for name in opts.collectors:
+        if name not in COLLECTORS:
+            error('Unknown collector {}, known collectors: {}'.format(name, ', '.join(COLLECTORS)))
+    if opts.collect_interval <= 0:
+        # the samples line up with the intervals of fio
+        opts.collect_interval = opts.status_interval if opts.status_interval > 0 else 1
+
+    read_sweep(opts)
+
+    if len(opts.bdev) == 1 or opts.aggregate:
+        run_matrix(opts, opts.bdev, opts.outdir)
+        if len(opts.bdev) > 1:
+            runs_to_csv(os.path.join(opts.outdir, AGGREGATE_CSV), [(None, parse_run(opts.outdir, 0))])
+        return
+
+    # every device gets a subdirectory named after it
+    dirnames = [os.path.basename(os.path.normpath(bdev)) for bdev in opts.bdev]
+    if len(set(dirnames)) != len(dirnames):
+        error('Block device names are not unique: {}'.format(', '.join(dirnames)))
+    os.makedirs(opts.outdir, exist_ok=opts.resume)
+
+    concurrency = opts.max_concurrent if opts.max_concurrent > 0 else len(opts.bdev)
+    print('Running on {} devices, up to {} at a time'.format(len(opts.bdev), concurrency))
+    # threads are enough, they only wait for fio
+    stop = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_matrix, opts, [bdev], os.path.join(opts.outdir, dirname), stop)
+                   for bdev, dirname in zip(opts.bdev, dirnames)]
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                # a device failed, let the others finish their current cell and stop
+                stop.set()
+                for other in futures:
+                    other.cancel()
+                future.result()
+
+    runs_to_csv(os.path.join(opts.outdir, COMBINED_CSV),
+                [(dirname, parse_run(os.path.join(opts.outdir, dirname), 0)) for dirname in dirnames])
 
 ############################################################################
 
@@ -221,14 +891,61 @@ if __name__ == '__main__':
     sub_parser = subparsers.add_parser('dir_to_csv', help='Parse fio loop results and convert to csv')
     sub_parser.add_argument('--dir', required=True)
     sub_parser.add_argument('--outfile', required=True)
+    sub_parser.add_argument('-j', '--jobs', type=int, default=0, help='number of parsing processes, default is the number of CPUs')
     sub_parser.set_defaults(func=dir_to_csv)
 
+    sub_parser = subparsers.add_parser('compare', help='Compare the results of a candidate against a baseline, '
+                                       'exit with {} if any cell regressed beyond the noise'.format(REGRESSION_RC))
+    sub_parser.add_argument('--baseline', required=True, nargs='+', help='run_fio_loop output directories of the baseline, '
+                            'repeated runs give the noise of every cell')
+    sub_parser.add_argument('--candidate', required=True, nargs='+', help='run_fio_loop output directories of the candidate')
+    sub_parser.add_argument('--threshold-pct', type=float, default=5.0,
+                            help='a cell which got worse by less than this is never a regression')
+    sub_parser.add_argument('--noise-sigmas', type=float, default=3.0,
+                            help='a cell regressed if it got worse by more than this many standard errors of the difference')
+    sub_parser.add_argument('--outfile', help='also write the comparison to this csv')
+    sub_parser.add_argument('-j', '--jobs', type=int, default=0, help='number of parsing processes, default is the number of CPUs')
+    sub_parser.set_defaults(func=compare)
+
     sub_parser = subparsers.add_parser('run_fio_loop', help='Run fio with different sizes/queue depth and parse the results')
     sub_parser.add_argument('--io-pattern', choices=('read', 'write', 'randread', 'randwrite', 'rw', 'readwrite', 'randrw'), default='write')
     sub_parser.add_argument('--readpct', type=int, default=50)
-    sub_parser.add_argument('--runtime', default=72)
-    sub_parser.add_argument('--bdev', required=True)
+    sub_parser.add_argument('--runtime', type=int, default=72, help='seconds, the maximal runtime with --steady-state')
+    sub_parser.add_argument('--steady-state', metavar='CRITERION',
+                            help='end every cell once fio sees steady state, like iops_slope:0.3%% or bw:2%%; '
+                                 'whether it did is in the steady state column of the csv')
+    sub_parser.add_argument('--ss-window', type=int, default=10, help='seconds over which steady state is checked')
+    sub_parser.add_argument('--ss-min-runtime', type=int, default=15, help='seconds every cell runs at least with --steady-state')
+    sub_parser.add_argument('--bdev', required=True, nargs='+',
+                            help='with several, every device runs the matrix in its own subdirectory of outdir, and '
+                                 'rd_/wr_{} has the results of all of them'.format(COMBINED_CSV))
+    sub_parser.add_argument('--max-concurrent', type=int, default=0,
+                            help='number of devices which run the matrix at the same time, default is all of them')
+    sub_parser.add_argument('--aggregate', action='store_true',
+                            help='run every cell on all the devices at once, as a single fio with a job per device, '
+                                 'to measure their aggregate throughput (rd_/wr_{})'.format(AGGREGATE_CSV))
     sub_parser.add_argument('--outdir', required=True)
+    sub_parser.add_argument('--status-interval', type=int, default=0,
+                            help='seconds; follow every cell as it runs and write its per-interval IOPS, bandwidth and latency '
+                                 'to <cell>{}'.format(INTERVALS_EXT))
+    sub_parser.add_argument('--stall-intervals', type=int, default=0,
+                            help='with --status-interval, abort a cell which completed no IO for this many intervals in a row')
+    sub_parser.add_argument('--collectors', help='comma-separated, out of: {}; run around every cell, their output goes to '
+                            '<cell>.<collector>, and the device and CPU summaries to the csv'.format(', '.join(COLLECTORS)))
+    sub_parser.add_argument('--collect-interval', type=int, default=0,
+                            help='seconds between collector samples, default is --status-interval, or 1')
+    sub_parser.add_argument('--sweep', help='json file with the {} and {} to run, default is the full matrix'.format(
+                            SWEEP_IO_SIZES, SWEEP_QUEUE_DEPTHS))
+    sub_parser.add_argument('--io-sizes', help='comma-separated, like 4k,64k,1m; overrides the sweep file')
+    sub_parser.add_argument('--queue-depths', help='comma-separated; overrides the sweep file')
+    sub_parser.add_argument('--saturation-search', action='store_true',
+                            help='for every IO size, go up the queue depths (by default {}) and stop once the IOPS grow by less than '
+                                 '--min-gain-pct; the saturation points go to {}'.format(
+                                     ','.join(str(queue_size) for queue_size in SATURATION_QUEUE_SIZES), SATURATION_CSV))
+    sub_parser.add_argument('--min-gain-pct', type=float, default=5.0)
+    sub_parser.add_argument('--resume', action='store_true',
+                            help='continue the run in an existing outdir: skip the cells which its journal has as finished, '
+                                 'rerun the rest; the other options have to be the same')
     sub_parser.set_defaults(func=run_fio_loop)
 
     opts = parser.parse_args()
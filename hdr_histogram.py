@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+# Fixed-memory histograms with a bounded relative error, laid out like HDR histograms:
+# values are counted in power-of-2 buckets, each one split into the same number of linear
+# sub-buckets, so a value is off by at most 1 / 2^(sub-bucket magnitude) of itself.
+# Histograms of the same layout are merged by adding their counts, so summaries of several
+# logs or hosts can be combined without the raw samples.
+
+# Values are recorded in multiples of the unit; iostat prints 2 decimal digits
+DEFAULT_UNIT = 0.01
+# Larger values are counted as this one (the exact max is still kept)
+DEFAULT_HIGHEST = 1e9
+DEFAULT_SIGNIFICANT_DIGITS = 2
+
+
+class HdrHistogram(object):
+    """Histogram of non-negative values, with the count, mean, stddev, min and max kept exactly."""
+
+    def __init__(self, unit=DEFAULT_UNIT, highest=DEFAULT_HIGHEST, significant_digits=DEFAULT_SIGNIFICANT_DIGITS):
+        self.unit = unit
+        self.highest = highest
+        self.significant_digits = significant_digits
+
+        # smallest power of 2 sub-buckets that tells apart 2 * 10^digits values
+        self.sub_bucket_count = 1 << int(np.ceil(np.log2(2 * 10 ** significant_digits)))
+        self.sub_bucket_half_count = self.sub_bucket_count // 2
+        self.sub_bucket_half_count_magnitude = self.sub_bucket_half_count.bit_length() - 1
+        self.sub_bucket_mask = self.sub_bucket_count - 1
+        self.highest_int = int(np.ceil(highest / unit))
+        self.counts = np.zeros(self._counts_index(np.array([self.highest_int]))[0] + 1, dtype=np.int64)
+
+        # count, mean and sum of squared differences from the mean, merged with Chan's formula
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+
+    def _counts_index(self, int_values):
+        # bit length of value | mask, through the float exponent; exact for the range of the values
+        bit_length = np.frexp((int_values | self.sub_bucket_mask).astype(np.float64))[1]
+        bucket_idx = np.maximum(bit_length - (self.sub_bucket_half_count_magnitude + 1), 0)
+        sub_bucket_idx = int_values >> bucket_idx
+        return ((bucket_idx + 1) << self.sub_bucket_half_count_magnitude) + sub_bucket_idx - self.sub_bucket_half_count
+
+    def _highest_equivalent(self, index):
+        # largest value counted at index, in units
+        bucket_idx = (index >> self.sub_bucket_half_count_magnitude) - 1
+        sub_bucket_idx = (index & (self.sub_bucket_half_count - 1)) + self.sub_bucket_half_count
+        if bucket_idx < 0:
+            sub_bucket_idx -= self.sub_bucket_half_count
+            bucket_idx = 0
+        return ((sub_bucket_idx + 1) << bucket_idx) - 1
+
+    def same_layout(self, other):
+        return (self.unit, self.highest_int, self.sub_bucket_count) == (other.unit, other.highest_int, other.sub_bucket_count)
+
+    def record(self, values):
+        # values: array of values; NaN (not reported) is skipped, negative values are counted as 0
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        int_values = np.clip(np.rint(values / self.unit), 0, self.highest_int).astype(np.int64)
+        self.counts += np.bincount(self._counts_index(int_values), minlength=len(self.counts))
+        self._merge_stats(len(values), values.mean(), ((values - values.mean()) ** 2).sum(), values.min(), values.max())
+
+    def _merge_stats(self, count, mean, m2, vmin, vmax):
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+        self.min = vmin if self.min != self.min else min(self.min, vmin)
+        self.max = vmax if self.max != self.max else max(self.max, vmax)
+
+    def merge(self, other):
+        # add the values of another histogram of the same layout
+        assert self.same_layout(other)
+        if other.count == 0:
+            return
+        self.counts += other.counts
+        self._merge_stats(other.count, other.mean, other.m2, other.min, other.max)
+
+    def stddev(self):
+        return np.sqrt(self.m2 / self.count) if self.count > 0 else np.nan
+
+    def percentile(self, percentile):
+        # the value below or at which percentile% of the values are, within the relative error; NaN if empty
+        if self.count == 0:
+            return np.nan
+        count_at = max(1, int(percentile / 100.0 * self.count + 0.5))
+        index = int(np.searchsorted(np.cumsum(self.counts), count_at))
+        value = self._highest_equivalent(index) * self.unit
+        return min(max(value, self.min), self.max)
+
+    def to_arrays(self):
+        return {'layout': np.array([self.unit, self.highest, self.significant_digits]), 'counts': self.counts,
+                'stats': np.array([self.count, self.mean, self.m2, self.min, self.max])}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        unit, highest, significant_digits = arrays['layout'].tolist()
+        hist = cls(unit, highest, int(significant_digits))
+        hist.counts = arrays['counts']
+        count, hist.mean, hist.m2, hist.min, hist.max = arrays['stats'].tolist()
+        hist.count = int(count)
+        return hist
+
+
+# A set of histograms is a dict of (entity, metric) -> HdrHistogram, like per (block device, metric);
+# all of them have the same layout.
+
+def histograms_to_arrays(histograms):
+    keys = list(histograms)
+    first = histograms[keys[0]] if keys else HdrHistogram()
+    return {'entities': np.array([entity for entity, _ in keys], dtype=str),
+            'metrics': np.array([metric for _, metric in keys], dtype=str),
+            'layout': first.to_arrays()['layout'],
+            'counts': np.array([histograms[key].counts for key in keys], dtype=np.int64).reshape(len(keys), len(first.counts)),
+            'stats': np.array([histograms[key].to_arrays()['stats'] for key in keys]).reshape(len(keys), 5)}
+
+
+def histograms_from_arrays(arrays):
+    histograms = {}
+    for idx, key in enumerate(zip(arrays['entities'].tolist(), arrays['metrics'].tolist())):
+        histograms[key] = HdrHistogram.from_arrays({'layout': arrays['layout'], 'counts': arrays['counts'][idx],
+                                                    'stats': arrays['stats'][idx]})
+    return histograms
+
+
+def merge_histograms(histograms, other):
+    # adds the histograms of other into histograms, keys missing from histograms are added
+    for key, hist in other.items():
+        if key in histograms:
+            histograms[key].merge(hist)
+        else:
+            histograms[key] = hist
+
+
+def save_histograms(fname, histograms):
+    with open(fname, 'wb') as f:
+        np.savez(f, **histograms_to_arrays(histograms))
+
+
+def load_histograms(fname):
+    with np.load(fname, allow_pickle=False) as npz:
+        return histograms_from_arrays({name: npz[name] for name in npz.files})
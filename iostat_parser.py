@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import re
+import mmap
+import concurrent.futures
+import numpy as np
+
+from sample_store import SampleStore
+from parse_cache import cached_parse
+from log_open import open_log, is_compressed
+
+
+def bug(msg):
+    print('ERROR: {}'.format(msg), file=sys.stderr)
+    assert False
+
+
+# The log is parsed as bytes. The headers are looked for in the memory-mapped file, the lines are read
+# through a buffer, so that the mapped pages of a large log do not add up in the RSS.
+
+# 10/12/20 19:51:43
+HEADER = re.compile(rb'^(\d+/\d+/\d+\s+\d+:\d+:\d+)', re.MULTILINE)
+
+
+# The device lines are read by the columns of the "Device" header line before them, whose order
+# depends on the sysstat version:
+# sysstat 11:
+# Device            r/s     w/s     rkB/s     wkB/s   rrqm/s   wrqm/s  %rrqm  %wrqm r_await w_await aqu-sz rareq-sz wareq-sz  svctm  %util
+# sysstat 12 and later:
+# Device            r/s     rkB/s   rrqm/s  %rrqm r_await rareq-sz     w/s     wkB/s   wrqm/s  %wrqm w_await wareq-sz     d/s     dkB/s   drqm/s  %drqm d_await dareq-sz     f/s f_await  aqu-sz  %util
+DEVICE_HEADER = b'Device'
+
+
+class IostatFormatError(Exception):
+    pass
+
+
+RD_PER_SEC = "rd_per_sec"
+RD_MB_SEC = "rd_mb_sec"
+RD_LAT_MS = "rd_lat_ms"
+
+WR_PER_SEC = "wr_per_sec"
+WR_MB_SEC = "wr_mb_sec"
+WR_LAT_MS = "wr_lat_ms"
+
+QU_SZ = 'qu_sz'
+RA_REQ_SZ = 'ra_req_sz'
+WA_REQ_SZ = 'wa_req_sz'
+UTIL = 'util'
+
+# Order of the metrics in the sample store
+ALL_METRICS = (RD_PER_SEC, WR_PER_SEC, RD_MB_SEC, WR_MB_SEC,
+               RD_LAT_MS, WR_LAT_MS, QU_SZ,
+               RA_REQ_SZ, WA_REQ_SZ, UTIL)
+
+# header column -> (metric, divisor of the printed value)
+IOSTAT_COLUMNS = {
+    b'r/s': (RD_PER_SEC, 1),
+    b'w/s': (WR_PER_SEC, 1),
+    b'rkB/s': (RD_MB_SEC, 1024),
+    b'rMB/s': (RD_MB_SEC, 1),
+    b'wkB/s': (WR_MB_SEC, 1024),
+    b'wMB/s': (WR_MB_SEC, 1),
+    b'r_await': (RD_LAT_MS, 1),
+    b'w_await': (WR_LAT_MS, 1),
+    b'aqu-sz': (QU_SZ, 1),
+    b'avgqu-sz': (QU_SZ, 1),
+    b'rareq-sz': (RA_REQ_SZ, 1),
+    b'wareq-sz': (WA_REQ_SZ, 1),
+    b'%util': (UTIL, 1),
+}
+# a header without these columns is not recognised; the other metrics are NaN when their columns are missing
+REQUIRED_METRICS = (RD_PER_SEC, WR_PER_SEC, RD_MB_SEC, WR_MB_SEC, RD_LAT_MS, WR_LAT_MS, QU_SZ)
+
+# Bump when the parsing changes, to invalidate cached samples
+PARSER_VERSION = 2
+
+# Files smaller than this are parsed by the calling process
+MIN_PARALLEL_SIZE = 64 * 1024 * 1024
+# Every worker process gets several chunks, so that a slow chunk does not hold the others back
+CHUNKS_PER_JOB = 4
+MIN_CHUNK_SIZE = 16 * 1024 * 1024
+# Samples per store yielded by iter_iostat() for a compressed log; a plain log is yielded in chunks
+# of MIN_CHUNK_SIZE bytes
+BATCH_SAMPLES = 4096
+# Initial size of the window at the end of the file, in which headers are looked for
+TAIL_WINDOW_SIZE = 1024 * 1024
+
+
+def _header_columns(line):
+    # Returns the number of fields of the device lines under the "Device" header line and,
+    # per metric of ALL_METRICS, the (field index, divisor) of its column or None
+    names = line.split()
+    columns = [None] * len(ALL_METRICS)
+    # the first field is the device name
+    for field_idx, name in enumerate(names[1:], 1):
+        col = IOSTAT_COLUMNS.get(name)
+        if col is not None:
+            metric, divisor = col
+            columns[ALL_METRICS.index(metric)] = (field_idx, divisor)
+
+    missing = [metric for metric in REQUIRED_METRICS if columns[ALL_METRICS.index(metric)] is None]
+    if missing:
+        raise IostatFormatError('Unrecognised iostat header, no columns for {}:\n{}'.format(
+            ', '.join(missing), line.decode(errors='replace').rstrip()))
+    return len(names), columns
+
+
+def _parse_lines(lines, store, max_samples=0):
+    # lines: iterable of bytes lines; stops before the (max_samples + 1)-th header, if max_samples is set
+    blkdev_idx = {blkdev.encode(): idx for blkdev, idx in store.entity_idx.items()}
+    sample_idx = None
+    nr_fields = None
+    columns = None
+    nan = float('nan')
+
+    for line in lines:
+        m = HEADER.match(line)
+        if m is not None:
+            if max_samples > 0 and len(store) >= max_samples:
+                break
+            sample_idx = store.new_sample(m.group(1).decode())
+            continue
+
+        if line.startswith(DEVICE_HEADER):
+            nr_fields, columns = _header_columns(line)
+            continue
+
+        if columns is None:
+            continue
+        fields = line.split()
+        if len(fields) != nr_fields:
+            continue
+
+        idx = blkdev_idx.get(fields[0])
+        if idx is None:
+            continue
+        if sample_idx is None:
+            bug('Did not see a timestamp header before line:\n{}'.format(line.decode(errors='replace')))
+
+        store.set_values(sample_idx, idx,
+                         [nan if col is None else float(fields[col[0]]) / col[1] for col in columns])
+
+
+def _file_lines(fin, start, end):
+    # the lines of [start, end) of a file opened in binary mode
+    fin.seek(start)
+    pos = start
+    for line in fin:
+        if pos >= end:
+            break
+        yield line
+        pos += len(line)
+
+
+def _parse_chunk(args):
+    # runs in a worker process: opens the file by itself and parses [start, end), which starts at a header
+    infile, start, end, blkdevs, dtype, max_samples = args
+
+    store = SampleStore(blkdevs, ALL_METRICS, dtype=dtype)
+    with open(infile, 'rb') as fin:
+        _parse_lines(_file_lines(fin, start, end), store, max_samples)
+
+    # drop the spare room, so that it is not sent back to the parent
+    store.truncate(0, len(store))
+    return store
+
+
+def _tail_offset(mm, nr_samples):
+    # Returns the offset of the nr_samples-th header from the end of the file, looking only at the end of it.
+    # Returns None if the file does not have more than nr_samples headers, i.e. the tail includes the first sample.
+    size = len(mm)
+    window = TAIL_WINDOW_SIZE
+    while True:
+        pos = max(0, size - window)
+        offsets = [m.start() for m in HEADER.finditer(mm, pos)]
+        if len(offsets) > nr_samples:
+            return offsets[-nr_samples]
+        if pos == 0:
+            return None
+        window = window * 2
+
+
+def _last_header(mm, start):
+    # offset of the last header at or after start, or None; looks only at the end of the file
+    size = len(mm)
+    window = TAIL_WINDOW_SIZE
+    while True:
+        pos = max(start, size - window)
+        last = None
+        for m in HEADER.finditer(mm, pos):
+            last = m.start()
+        if last is not None or pos == start:
+            return last
+        window = window * 2
+
+
+def _split_points(mm, start, end, nr_chunks):
+    # split [start, end) into up to nr_chunks ranges, each one starting at a header
+    points = [start]
+    for idx in range(1, nr_chunks):
+        target = start + (end - start) * idx // nr_chunks
+        if target <= points[-1]:
+            continue
+        m = HEADER.search(mm, target, end)
+        if m is None:
+            break
+        if m.start() > points[-1]:
+            points.append(m.start())
+    points.append(end)
+    return points
+
+
+def _parse_range(opts, mm, start, end, dtype, verbose=True):
+    jobs = opts.jobs if opts.jobs > 0 else os.cpu_count()
+    size = end - start
+    if jobs <= 1 or size < MIN_PARALLEL_SIZE:
+        return _parse_chunk((opts.infile, start, end, opts.blkdevs, dtype, 0))
+
+    nr_chunks = max(1, min(jobs * CHUNKS_PER_JOB, size // MIN_CHUNK_SIZE))
+    points = _split_points(mm, start, end, nr_chunks)
+    chunks = [(opts.infile, chunk_start, chunk_end, opts.blkdevs, dtype, 0)
+              for chunk_start, chunk_end in zip(points[:-1], points[1:])]
+    if verbose:
+        print('Parsing {} chunks with {} processes'.format(len(chunks), jobs))
+
+    store = None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # map() returns the chunks in order
+        for chunk_store in executor.map(_parse_chunk, chunks):
+            if store is None:
+                store = chunk_store
+            else:
+                store.extend(chunk_store)
+    return store
+
+
+def parse_iostat_cached(opts, tool, dtype=np.float32):
+    # parse_iostat() through the parsed samples cache of the given tool
+    params = {'blkdevs': opts.blkdevs, 'dont_cut_first_line': opts.dont_cut_first_line,
+              'max_samples': opts.max_samples, 'samples_from_end': opts.samples_from_end,
+              'dtype': np.dtype(dtype).name}
+    return cached_parse(opts.infile, tool, PARSER_VERSION, params,
+                        lambda: parse_iostat(opts, dtype), SampleStore.to_arrays, SampleStore.from_arrays,
+                        enabled=not opts.no_cache)
+
+
+def parse_iostat(opts, dtype=np.float32, verbose=True):
+    # verbose: print the progress of the parsing
+    if verbose:
+        print('Parsing iostat log...')
+
+    # First line in iostat output contains bogus values, cut it
+    cut_first_line = not opts.dont_cut_first_line
+
+    # set when only the needed tail of the file was parsed
+    tail_only = False
+
+    if is_compressed(opts.infile):
+        # a compressed log cannot be mapped, parse the decompressed stream sequentially
+        store = SampleStore(opts.blkdevs, ALL_METRICS, dtype=dtype)
+        max_samples = 0
+        if opts.max_samples > 0 and not opts.samples_from_end:
+            max_samples = opts.max_samples + (1 if cut_first_line else 0)
+        with open_log(opts.infile, 'rb') as fin:
+            _parse_lines(fin, store, max_samples)
+        mm = None
+    else:
+        with open(opts.infile, 'rb') as fin:
+            size = os.fstat(fin.fileno()).st_size
+            # the mapping stays valid after the file is closed
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        if mm is None:
+            store = SampleStore(opts.blkdevs, ALL_METRICS, dtype=dtype)
+
+    if mm is not None:
+        try:
+            if opts.max_samples > 0 and opts.samples_from_end:
+                # look for the first needed header near the end, instead of parsing the whole file
+                offset = _tail_offset(mm, opts.max_samples)
+                if offset is not None:
+                    tail_only = True
+                    store = _parse_range(opts, mm, offset, size, dtype, verbose)
+                else:
+                    store = _parse_range(opts, mm, 0, size, dtype, verbose)
+            elif opts.max_samples > 0:
+                # stop as soon as we have enough samples
+                max_samples = opts.max_samples + (1 if cut_first_line else 0)
+                store = _parse_chunk((opts.infile, 0, size, opts.blkdevs, dtype, max_samples))
+            else:
+                store = _parse_range(opts, mm, 0, size, dtype, verbose)
+        finally:
+            mm.close()
+
+    if verbose:
+        print('Total {} samples'.format(len(store)))
+
+    start = 0
+    stop = len(store)
+
+    # the tail does not include the first sample
+    if cut_first_line and not tail_only:
+        if verbose:
+            print('Cutting first line of iostat output')
+        start = 1
+
+    # Limit to max_samples
+    if opts.max_samples > 0:
+        if verbose:
+            print('Limiting to {} samples{}'.format(opts.max_samples, ' (from end)' if opts.samples_from_end else ''))
+        if opts.samples_from_end:
+            start = max(start, stop - opts.max_samples)
+        else:
+            stop = min(stop, start + opts.max_samples)
+
+    store.truncate(start, stop)
+
+    return store
+
+
+def _line_batches(lines, batch_samples):
+    # groups the lines into lists of batch_samples samples, every list but the first one starts at a header
+    batch = []
+    nr_samples = 0
+    for line in lines:
+        if HEADER.match(line) is not None:
+            if nr_samples == batch_samples:
+                yield batch
+                batch = []
+                nr_samples = 0
+            nr_samples += 1
+        batch.append(line)
+    if batch:
+        yield batch
+
+
+def _iter_chunks(opts, dtype):
+    if is_compressed(opts.infile):
+        with open_log(opts.infile, 'rb') as fin:
+            for lines in _line_batches(fin, BATCH_SAMPLES):
+                store = SampleStore(opts.blkdevs, ALL_METRICS, dtype=dtype)
+                _parse_lines(lines, store)
+                yield store
+        return
+
+    with open(opts.infile, 'rb') as fin:
+        size = os.fstat(fin.fileno()).st_size
+        if size == 0:
+            return
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        points = _split_points(mm, 0, size, max(1, size // MIN_CHUNK_SIZE))
+    finally:
+        mm.close()
+    chunks = [(opts.infile, chunk_start, chunk_end, opts.blkdevs, dtype, 0)
+              for chunk_start, chunk_end in zip(points[:-1], points[1:])]
+
+    jobs = opts.jobs if opts.jobs > 0 else os.cpu_count()
+    if jobs <= 1 or len(chunks) == 1:
+        for chunk in chunks:
+            yield _parse_chunk(chunk)
+        return
+
+    print('Parsing {} chunks with {} processes'.format(len(chunks), jobs))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # a window of chunks at a time, so that parsed chunks do not pile up in the parent
+        for idx in range(0, len(chunks), jobs):
+            for store in executor.map(_parse_chunk, chunks[idx:idx + jobs]):
+                yield store
+
+
+def iter_iostat(opts, dtype=np.float32):
+    # Parses the whole log like parse_iostat(), but yields the samples in order, a store of a chunk of
+    # the log at a time, so that the memory does not depend on the log length. max_samples is not supported.
+    print('Parsing iostat log...')
+
+    cut_first_line = not opts.dont_cut_first_line
+    nr_samples = 0
+    for store in _iter_chunks(opts, dtype):
+        if cut_first_line and len(store) > 0:
+            print('Cutting first line of iostat output')
+            store.truncate(1, len(store))
+            cut_first_line = False
+        nr_samples += len(store)
+        yield store
+
+    print('Total {} samples'.format(nr_samples))
+
+
+def find_tail_offset(infile, nr_samples):
+    # offset to start parsing from to get the last nr_samples samples, 0 if the file has no more than that
+    with open(infile, 'rb') as fin:
+        if os.fstat(fin.fileno()).st_size == 0:
+            return 0
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = _tail_offset(mm, nr_samples)
+    finally:
+        mm.close()
+    return 0 if offset is None else offset
+
+
+def parse_iostat_appended(opts, offset, dtype=np.float32):
+    # Parses the samples appended to the log since offset, which is 0 or a value returned by a previous call.
+    # The last sample is complete only when the next header shows up, so it is left for the next call.
+    # Returns the new samples and the offset to continue from; cutting the first line is up to the caller.
+    store = SampleStore(opts.blkdevs, ALL_METRICS, dtype=dtype)
+
+    with open(opts.infile, 'rb') as fin:
+        size = os.fstat(fin.fileno()).st_size
+        if size <= offset:
+            return store, offset
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        last = _last_header(mm, offset)
+        if last is not None and last > offset:
+            store = _parse_range(opts, mm, offset, last, dtype)
+            offset = last
+    finally:
+        mm.close()
+
+    return store, offset
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+import sys
+import re
+import argparse
+import csv
+import numpy as np
+from plotly.subplots import make_subplots
+
+from parse_cache import cached_parse
+from sample_store import SampleStore
+from log_open import open_log
+from log_timestamps import iostat_ts, syslog_ts, date_ns, TimeOfDayClock, NSEC_PER_SEC
+from iostat_parser import parse_iostat_cached, ALL_METRICS as IOSTAT_METRICS, RD_LAT_MS, WR_LAT_MS
+from zstat_parser import parse_zstat_files, rows_matcher, COUNTERS as ZSTAT_COUNTERS, AVG_MS
+from plot_lines import line_trace
+import plot_mpstat
+import plot_top
+
+
+# Joins the samples of iostat, mpstat, top and ZSTAT logs of the same time frame on a common time grid,
+# into one wide table (CSV) or one figure with a panel per source, all sharing the time axis:
+#   join_stats.py --iostat iostat.log --blkdevs sdb,sdc --mpstat mpstat.log --zstat zadara_osm.log* --rows 'io_mgr_put_*'
+#
+# Every source becomes a sorted array of epoch timestamps and a (sample, column) matrix. Every grid point takes
+# the latest sample of every source at or before it, unless that sample is older than the sampling interval
+# of its source (the column is NaN then). This is a merge-join of the sorted grid with the sorted timestamps
+# of every source, done by np.searchsorted.
+
+def bug(msg):
+    print('ERROR: {}'.format(msg), file=sys.stderr)
+    assert False
+
+
+HTML = 'html'
+JPEG = 'jpeg'
+CSV = 'csv'
+
+# Height of a single source panel
+PANEL_HEIGHT = 300
+
+# Linux 4.15.0-112-generic (host1)    10/12/20    _x86_64_    (8 CPU)
+MPSTAT_HEADER_DATE = re.compile(r'^Linux\s.*\s(\d\d/\d\d/\d\d(?:\d\d)?|\d{4}-\d\d-\d\d)\s')
+
+
+def validate_opts(opts):
+    if opts.iostat is None and opts.mpstat is None and opts.top is None and opts.zstat is None:
+        bug('No input logs specified')
+
+    opts.blkdevs = [blkdev[5:] if blkdev.startswith('/dev/') else blkdev for blkdev in opts.blkdevs.split(',') if blkdev]
+    if opts.iostat is not None and not opts.blkdevs:
+        bug('--iostat needs --blkdevs')
+    opts.iostat_metrics = opts.iostat_metrics.split(',')
+    for metric in opts.iostat_metrics:
+        if metric not in IOSTAT_METRICS:
+            bug('Unknown iostat metric: {}'.format(metric))
+
+    opts.mpstat_metrics = opts.mpstat_metrics.split(',')
+    for metric in opts.mpstat_metrics:
+        if metric not in plot_mpstat.METRICS:
+            bug('Unknown mpstat metric: {}'.format(metric))
+
+    if opts.top is not None and not opts.commands:
+        bug('--top needs --commands')
+
+    opts.rows = [glob for glob in opts.rows.split(',') if glob]
+    opts.counters = opts.counters.split(',')
+    for counter in opts.counters:
+        if counter not in ZSTAT_COUNTERS:
+            bug('Unknown ZSTAT counter: {}'.format(counter))
+
+    if opts.date is not None:
+        opts.date = parse_date(opts.date)
+        if opts.date is None:
+            bug('Invalid date, expected YYYY-MM-DD or MM/DD/YY')
+
+    if opts.interval is not None and opts.interval <= 0:
+        bug('interval should be positive')
+
+
+def parse_date(date):
+    # 'YYYY-MM-DD', 'MM/DD/YY' or 'MM/DD/YYYY' -> nanoseconds at midnight, None if invalid
+    try:
+        if '-' in date:
+            year, month, day = date.split('-')
+            return date_ns(int(year), int(month), int(day))
+        return iostat_ts(date + ' 00:00:00')
+    except ValueError:
+        return None
+
+
+def year_of(midnight_ns):
+    return int(np.datetime64(midnight_ns, 'ns').astype('datetime64[Y]').astype(np.int64)) + 1970
+
+
+def iostat_source(opts):
+    ns = argparse.Namespace(infile=opts.iostat, blkdevs=opts.blkdevs, dont_cut_first_line=False,
+                            max_samples=0, samples_from_end=False, jobs=opts.jobs, no_cache=opts.no_cache)
+    # the same parsed samples cache as plot_iostat
+    store = parse_iostat_cached(ns, 'plot_iostat')
+    timestamps = np.array([iostat_ts(label) for label in store.labels], dtype=np.int64)
+
+    names = []
+    columns = []
+    for blkdev in opts.blkdevs:
+        for metric in opts.iostat_metrics:
+            names.append('{} {}'.format(blkdev, metric))
+            columns.append(store.column(blkdev, metric))
+    return 'iostat', timestamps, names, columns
+
+
+def mpstat_date(infile):
+    # the date at the top of an mpstat log, None if it is not there
+    with open_log(infile) as fin:
+        for line in fin:
+            m = MPSTAT_HEADER_DATE.match(line)
+            if m is not None:
+                return parse_date(m.group(1))
+            if line.strip():
+                return None
+    return None
+
+
+def mpstat_source(opts, date):
+    ns = argparse.Namespace(infile=opts.mpstat)
+    # the same parsed samples cache as plot_mpstat
+    store = cached_parse(opts.mpstat, 'plot_mpstat', plot_mpstat.PARSER_VERSION, {},
+                         lambda: plot_mpstat.parse_mpstat(ns), SampleStore.to_arrays, SampleStore.from_arrays,
+                         enabled=not opts.no_cache)
+    clock = TimeOfDayClock(date)
+    timestamps = np.array([clock(label) for label in store.labels], dtype=np.int64)
+
+    if opts.cpu == 'each':
+        cpus = [cpu for cpu in store.entities if cpu != 'all']
+    else:
+        cpus = [opts.cpu]
+    names = []
+    columns = []
+    for cpu in cpus:
+        if cpu not in store.entity_idx:
+            bug('CPU {} is not in {}'.format(cpu, opts.mpstat))
+        for metric in opts.mpstat_metrics:
+            if metric == plot_mpstat.CPU_USAGE:
+                values = 100 - store.column(cpu, plot_mpstat.IDLE)
+            else:
+                values = store.column(cpu, metric)
+            names.append('cpu {} {}'.format(cpu, metric))
+            columns.append(values)
+    return 'mpstat', timestamps, names, columns
+
+
+def top_source(opts, date):
+    ns = argparse.Namespace(infile=opts.top, commands=opts.commands, max_samples=0)
+    # the same parsed samples cache as plot_top
+    store = cached_parse(opts.top, 'plot_top', plot_top.PARSER_VERSION,
+                         {'commands': list(opts.commands), 'max_samples': 0},
+                         lambda: plot_top.parse_top(ns), SampleStore.to_arrays, SampleStore.from_arrays,
+                         enabled=not opts.no_cache)
+    clock = TimeOfDayClock(date)
+    timestamps = np.array([clock(label) for label in store.labels], dtype=np.int64)
+
+    names = ['{} cpu %'.format(cmd) for cmd in opts.commands] + ['mem_used (mb)']
+    columns = [store.column(cmd, plot_top.VALUE) for cmd in opts.commands] + [plot_top.mem_mb(store, plot_top.MEM_USED)]
+    return 'top', timestamps, names, columns
+
+
+def zstat_source(opts, date):
+    # the same parsed samples cache as plot_zstat
+    store = parse_zstat_files(opts.zstat, jobs=opts.jobs, use_cache=not opts.no_cache)
+    year = year_of(date)
+    timestamps = np.array([syslog_ts(label, year) for label in store.labels], dtype=np.int64)
+
+    row_wanted = rows_matcher(opts.rows)
+    rows = [row for row in store.entities if row_wanted(row)]
+    if not rows:
+        bug('No rows match {}'.format(','.join(opts.rows)))
+    names = []
+    columns = []
+    for row in rows:
+        for counter in opts.counters:
+            names.append('{} {}'.format(row, counter))
+            columns.append(store.column(row, counter))
+    return 'zstat', timestamps, names, columns
+
+
+def load_sources(opts):
+    # list of (source name, timestamps, column names, columns)
+    sources = []
+    if opts.iostat is not None:
+        sources.append(iostat_source(opts))
+
+    # the date of the logs which print only the time of day (or no year): --date, else the date
+    # at the top of the mpstat log, else the date of the first iostat sample
+    date = opts.date
+    mpstat_log_date = mpstat_date(opts.mpstat) if opts.mpstat is not None else None
+    if date is None:
+        date = mpstat_log_date
+    if date is None and sources and len(sources[0][1]) > 0:
+        date = sources[0][1][0] // (86400 * NSEC_PER_SEC) * (86400 * NSEC_PER_SEC)
+    if date is None and (opts.mpstat is not None or opts.top is not None or opts.zstat is not None):
+        bug('Cannot tell the date of the logs, specify --date')
+
+    if opts.mpstat is not None:
+        sources.append(mpstat_source(opts, date if mpstat_log_date is None else mpstat_log_date))
+    if opts.top is not None:
+        sources.append(top_source(opts, date))
+    if opts.zstat is not None:
+        sources.append(zstat_source(opts, date))
+
+    for name, timestamps, _, _ in sources:
+        if len(timestamps) == 0:
+            bug('No samples in the {} log'.format(name))
+        if np.any(np.diff(timestamps) < 0):
+            bug('Timestamps of the {} log are not in order'.format(name))
+    return sources
+
+
+def sampling_interval(timestamps):
+    # median distance between samples, at least a second
+    if len(timestamps) < 2:
+        return NSEC_PER_SEC
+    return max(int(np.median(np.diff(timestamps))), NSEC_PER_SEC)
+
+
+def time_grid(opts, sources):
+    # from the first sample of any source to the last one, every interval (default: the shortest sampling interval)
+    if opts.interval is not None:
+        step = int(opts.interval * NSEC_PER_SEC)
+    else:
+        step = min(sampling_interval(timestamps) for _, timestamps, _, _ in sources)
+    start = min(timestamps[0] for _, timestamps, _, _ in sources)
+    stop = max(timestamps[-1] for _, timestamps, _, _ in sources)
+    return np.arange(start, stop + 1, step, dtype=np.int64)
+
+
+def align(grid, timestamps, columns):
+    # (grid point, column) matrix: the latest sample at or before every grid point, not older than the sampling interval
+    idx = np.searchsorted(timestamps, grid, side='right') - 1
+    valid = idx >= 0
+    idx = np.maximum(idx, 0)
+    valid &= grid - timestamps[idx] < sampling_interval(timestamps)
+
+    aligned = np.full((len(grid), len(columns)), np.nan)
+    for col_idx, column in enumerate(columns):
+        aligned[valid, col_idx] = np.asarray(column, dtype=np.float64)[idx[valid]]
+    return aligned
+
+
+def do_csv(opts, outfile, grid, sources, aligned):
+    header_row = ['timestamp']
+    for name, _, col_names, _ in sources:
+        header_row.extend('{} {}'.format(name, col_name) for col_name in col_names)
+    values = np.hstack(aligned)
+    times = np.datetime_as_string(grid.astype('datetime64[ns]').astype('datetime64[s]'))
+
+    with open(outfile, 'w') as outf:
+        csv_writer = csv.writer(outf)
+        csv_writer.writerow(header_row)
+        for timestamp, row_values in zip(times.tolist(), values.tolist()):
+            csv_writer.writerow([timestamp.replace('T', ' ')] +
+                                ['' if value != value else '{:.2f}'.format(value) for value in row_values])
+
+
+def do_plotly(opts, outfile, grid, sources, aligned):
+    # a panel per source, zooming one zooms them all
+    x = grid.astype('datetime64[ns]')
+    fig = make_subplots(rows=len(sources), cols=1, shared_xaxes=True, vertical_spacing=0.03,
+                        subplot_titles=[name for name, _, _, _ in sources])
+    for row, ((name, _, col_names, _), values) in enumerate(zip(sources, aligned), start=1):
+        for col_idx, col_name in enumerate(col_names):
+            fig.add_trace(line_trace(x, values[:, col_idx], '{} {}'.format(name, col_name), opts.target_points,
+                                     legendgroup=name),
+                          row=row, col=1)
+    fig.update_layout(title='joined stats' if opts.fig_title is None else opts.fig_title,
+                      height=PANEL_HEIGHT * len(sources))
+    fig.update_xaxes(title_text='timestamp', row=len(sources), col=1)
+
+    if opts.output_format == HTML:
+        fig.write_html(outfile)
+    elif opts.output_format == JPEG:
+        fig.write_image(outfile)
+    else:
+        bug('Unsupported output format [{}]'.format(opts.output_format))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Join iostat, mpstat, top and ZSTAT samples on a common time grid')
+    parser.add_argument('--iostat', help='iostat -x log')
+    parser.add_argument('--blkdevs', default='', help='comma-separated block devices of the iostat log')
+    parser.add_argument('--iostat-metrics', default=RD_LAT_MS + ',' + WR_LAT_MS)
+    parser.add_argument('--mpstat', help='mpstat log')
+    parser.add_argument('--cpu', default='all', help='CPU of the mpstat log: all, each or a CPU id')
+    parser.add_argument('--mpstat-metrics', default=plot_mpstat.CPU_USAGE)
+    parser.add_argument('--top', help='top -b log')
+    parser.add_argument('--commands', nargs='+', help='commands of the top log, their CPU %% is summed')
+    parser.add_argument('--zstat', nargs='+', help='zadara_osm log, with its rotations')
+    parser.add_argument('--rows', default='*', help='comma-separated globs of the ZSTAT-GROUP rows')
+    parser.add_argument('--counters', default=AVG_MS, help='comma-separated ZSTAT-GROUP counters')
+    parser.add_argument('--date', help='date of the logs without one (YYYY-MM-DD), if it cannot be taken from the other logs')
+    parser.add_argument('--interval', type=float, help='grid interval in seconds, default is the shortest sampling interval')
+    parser.add_argument('-o', '--outfile', required=True)
+    parser.add_argument('--fig-title')
+    parser.add_argument('--target-points', type=int, default=0,
+                        help='decimate every line to this many points (LTTB, keeps the peaks), default is to plot all samples')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or write the parsed samples cache')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='number of parsing processes, default is the number of CPUs')
+    parser.add_argument('-f', '--output-format', choices=(HTML, JPEG, CSV), default=HTML)
+
+    opts = parser.parse_args()
+    validate_opts(opts)
+
+    sources = load_sources(opts)
+    grid = time_grid(opts, sources)
+    print('Joining {} sources on {} grid points'.format(len(sources), len(grid)))
+    aligned = [align(grid, timestamps, columns) for _, timestamps, _, columns in sources]
+
+    outfile = '{}.{}'.format(opts.outfile, opts.output_format)
+    if opts.output_format in (HTML, JPEG):
+        do_plotly(opts, outfile, grid, sources, aligned)
+    elif opts.output_format == CSV:
+        do_csv(opts, outfile, grid, sources, aligned)
+    else:
+        bug('Invalid output format {}'.format(opts.output_format))
+    print('Wrote {}'.format(outfile))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import io
+import gzip
+import lzma
+import shutil
+import subprocess
+
+
+# Compressed logs are detected by their magic bytes, not by the file name
+GZIP = 'gzip'
+XZ = 'xz'
+ZSTD = 'zstd'
+MAGICS = ((b'\x1f\x8b', GZIP),
+          (b'\xfd7zXZ\x00', XZ),
+          (b'\x28\xb5\x2f\xfd', ZSTD))
+MAX_MAGIC_LEN = 6
+
+# External decompressors, in order of preference: they run in parallel with the parsing,
+# so that reading a compressed log costs about the same as reading an uncompressed one
+DECOMPRESSORS = {
+    GZIP: (('pigz', '-dc'), ('gzip', '-dc')),
+    XZ: (('xz', '-dc', '-T0'),),
+    ZSTD: (('zstd', '-dcq'),),
+}
+
+# Usual suffixes of compressed logs
+COMPRESSED_SUFFIXES = ('.gz', '.xz', '.zst')
+
+# Decompressed data is read through a buffer of this size
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+def compression(fname):
+    # returns GZIP, XZ, ZSTD or None
+    with open(fname, 'rb') as f:
+        head = f.read(MAX_MAGIC_LEN)
+    for magic, name in MAGICS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def is_compressed(fname):
+    return compression(fname) is not None
+
+
+def strip_compressed_suffix(fname):
+    for suffix in COMPRESSED_SUFFIXES:
+        if fname.endswith(suffix):
+            return fname[:-len(suffix)]
+    return fname
+
+
+class _ProcessReader(io.RawIOBase):
+    # stdout of an external decompressor, which is reaped on close
+
+    def __init__(self, fname, cmd):
+        io.RawIOBase.__init__(self)
+        self._cmd = cmd
+        self._fname = fname
+        self._proc = subprocess.Popen(list(cmd) + [fname], stdout=subprocess.PIPE, bufsize=0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        nr_bytes = self._proc.stdout.readinto(b)
+        if nr_bytes == 0 and self._proc.wait() != 0:
+            raise IOError('{} {} failed with rc {}'.format(' '.join(self._cmd), self._fname, self._proc.returncode))
+        return nr_bytes
+
+    def close(self):
+        if not self.closed:
+            self._proc.stdout.close()
+            if self._proc.poll() is None:
+                # stopped reading before the end
+                self._proc.kill()
+            self._proc.wait()
+        io.RawIOBase.close(self)
+
+
+def _open_zstd_module(fname):
+    try:
+        import zstandard
+    except ImportError:
+        raise IOError('{} is zstd-compressed: install the zstd command or the zstandard python package'.format(fname))
+    return zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'), closefd=True)
+
+
+def _open_decompressed(fname, comp):
+    for cmd in DECOMPRESSORS[comp]:
+        if shutil.which(cmd[0]) is not None:
+            return _ProcessReader(fname, cmd)
+
+    # no external decompressor, decompress in this process
+    if comp == GZIP:
+        return gzip.GzipFile(fname, 'rb')
+    if comp == XZ:
+        return lzma.LZMAFile(fname, 'rb')
+    return _open_zstd_module(fname)
+
+
+def open_log(fname, mode='r'):
+    # Opens a log for reading, in text ('r') or binary ('rb') mode, decompressing it on the fly if needed
+    assert mode in ('r', 'rb')
+
+    comp = compression(fname)
+    if comp is None:
+        return open(fname, mode)
+
+    f = io.BufferedReader(_open_decompressed(fname, comp), READ_BUFFER_SIZE)
+    if mode == 'rb':
+        return f
+    return io.TextIOWrapper(f)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import datetime
+
+
+# Fast parsing of the fixed timestamp layouts of our logs into int64 nanoseconds since the epoch (UTC).
+# The fields are sliced by hand instead of going through strptime, and the date part, which repeats
+# on every line of a log, is converted to nanoseconds once and cached.
+
+NSEC_PER_SEC = 1000000000
+NSEC_PER_DAY = 86400 * NSEC_PER_SEC
+
+# Year of logs which do not have one (syslog), same as strptime
+DEFAULT_YEAR = 1900
+
+MONTHS = {name: idx for idx, name in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def date_ns(year, month, day):
+    # nanoseconds at midnight of the date
+    return (datetime.date(year, month, day).toordinal() - _EPOCH_ORDINAL) * NSEC_PER_DAY
+
+
+def _time_ns(hms):
+    # 'HH:MM:SS', anything after it is ignored
+    return (int(hms[0:2]) * 3600 + int(hms[3:5]) * 60 + int(hms[6:8])) * NSEC_PER_SEC
+
+
+def _frac_ns(frac):
+    # digits after the decimal point of the seconds, like '999984'
+    return int(frac) * 10 ** (9 - len(frac)) if frac else 0
+
+
+# date part of a timestamp, as it appears in the log -> nanoseconds at midnight
+_iostat_dates = {}
+_syslog_dates = {}
+_date_cmd_dates = {}
+
+
+def iostat_ts(ts):
+    # '10/12/20 19:51:43' (MM/DD/YY, or MM/DD/YYYY with some locales)
+    date, _, hms = ts.rpartition(' ')
+    ns = _iostat_dates.get(date)
+    if ns is None:
+        month, day, year = date.split('/')
+        year = int(year)
+        if year < 100:
+            year += 2000
+        ns = date_ns(year, int(month), int(day))
+        _iostat_dates[date] = ns
+    return ns + _time_ns(hms)
+
+
+def syslog_ts(ts, year=DEFAULT_YEAR):
+    # 'Jul 23 15:29:15.999984' or 'Jul 23 15:29:15'; syslog does not print the year
+    date, _, tod = ts.rpartition(' ')
+    key = (date, year)
+    ns = _syslog_dates.get(key)
+    if ns is None:
+        month, day = date.split()
+        ns = date_ns(year, MONTHS[month], int(day))
+        _syslog_dates[key] = ns
+    return ns + _time_ns(tod) + _frac_ns(tod[9:])
+
+
+def date_cmd_ts(ts):
+    # 'Thu Oct 22 10:49:59 UTC 2020', the output of date(1); the weekday and the zone are not looked at
+    fields = ts.split()
+    key = (fields[1], fields[2], fields[5])
+    ns = _date_cmd_dates.get(key)
+    if ns is None:
+        ns = date_ns(int(fields[5]), MONTHS[fields[1]], int(fields[2]))
+        _date_cmd_dates[key] = ns
+    return ns + _time_ns(fields[3])
+
+
+class TimeOfDayClock(object):
+    """Converts the 'HH:MM:SS' timestamps of mpstat, which do not have a date, to nanoseconds.
+
+    The timestamps are expected in log order: when the time of day goes backwards, the log
+    crossed midnight, and the following timestamps belong to the next day.
+    """
+
+    def __init__(self, start_ns=0):
+        # start_ns: midnight of the first day of the log, if known
+        self.day_ns = start_ns
+        self.prev_ns = None
+
+    def __call__(self, hms):
+        ns = _time_ns(hms)
+        if self.prev_ns is not None and ns < self.prev_ns:
+            self.day_ns += NSEC_PER_DAY
+        self.prev_ns = ns
+        return self.day_ns + ns
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import zipfile
+import numpy as np
+
+
+# Parsed samples are cached in a sidecar file next to the log, like iostat.log.plot_iostat.cache.npz.
+# The cache is valid as long as the log path, size and mtime, the parser version and the parser
+# parameters did not change.
+CACHE_SUFFIX = 'cache.npz'
+CACHE_KEY = '__cache_key__'
+
+
+def cache_fname(infile, tool):
+    return '{}.{}.{}'.format(infile, tool, CACHE_SUFFIX)
+
+
+def _cache_key(infile, tool, version, params):
+    st = os.stat(infile)
+    return json.dumps({'path': os.path.realpath(infile), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                       'tool': tool, 'version': version, 'params': params}, sort_keys=True)
+
+
+def _load(fname, key):
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with np.load(fname, allow_pickle=False) as npz:
+            if str(npz[CACHE_KEY]) != key:
+                print('Cache {} is stale'.format(fname))
+                return None
+            arrays = {name: npz[name] for name in npz.files if name != CACHE_KEY}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        print('Ignoring unreadable cache {}: {}'.format(fname, e))
+        return None
+    print('Loaded parsed samples from {}'.format(fname))
+    return arrays
+
+
+def _save(fname, key, arrays):
+    tmpfname = fname + '.tmp'
+    try:
+        with open(tmpfname, 'wb') as f:
+            np.savez(f, **{CACHE_KEY: np.array(key)}, **arrays)
+        os.replace(tmpfname, fname)
+    except OSError as e:
+        print('WARNING: cannot write cache {}: {}'.format(fname, e))
+        if os.path.exists(tmpfname):
+            os.unlink(tmpfname)
+
+
+def cached_parse(infile, tool, version, params, parse, to_arrays, from_arrays, enabled=True):
+    # Returns parse() result, loading it from the cache instead when possible.
+    # to_arrays() converts the result to a dict of numpy arrays and from_arrays() converts it back;
+    # params holds everything, other than the log itself, that affects the result (JSON-serializable).
+    if not enabled:
+        return parse()
+
+    fname = cache_fname(infile, tool)
+    # the key is taken before parsing, so that a log appended meanwhile does not look cached
+    key = _cache_key(infile, tool, version, params)
+    arrays = _load(fname, key)
+    if arrays is not None:
+        return from_arrays(arrays)
+
+    res = parse()
+    _save(fname, key, to_arrays(res))
+    return res
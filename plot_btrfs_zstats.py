@@ -4,7 +4,9 @@ import argparse
 import re
 import sys
 import os
-import plotly.express as px
+
+from log_open import open_log
+from plot_lines import line_figure
 
 
 # COW_UNMAPPED:   0/1808 0%
@@ -57,7 +59,7 @@ def parse_zstats(opts):
     samples = []
     curr_sample = None
 
-    with open(opts.infile, 'r') as fin:
+    with open_log(opts.infile) as fin:
         for line in fin:
             m = COW_UNMAPPED_RE.match(line)
             if m is not None:
@@ -129,8 +131,8 @@ def do_plotly(opts, in_dir_name, out_name, samples):
 
     print('Producing {} plot for metrics [{}]...'.format(opts.output_format, ', '.join(opts.metrics)))
 
-    fig = px.line(data, x='sample_idx', y=y,
-                  title='BTRFS zstats' if opts.fig_title is None else '{}'.format(opts.fig_title))
+    fig = line_figure(data['sample_idx'], [(name, data[name]) for name in y],
+                      'BTRFS zstats' if opts.fig_title is None else '{}'.format(opts.fig_title), opts.target_points, x_title='sample_idx')
 
     outfile = os.path.join(in_dir_name, '{}_stats.{}'.format(out_name, opts.output_format))
     if opts.output_format == HTML:
@@ -148,6 +150,8 @@ if __name__ == '__main__':
     parser.add_argument('--metrics', default=COW_TOTAL_PC)
     parser.add_argument('--max-samples', type=int, default=0)
     parser.add_argument('--fig-title')
+    parser.add_argument('--target-points', type=int, default=0,
+                        help='decimate every line to this many points (LTTB, keeps the peaks), default is to plot all samples')
     parser.add_argument('-f', '--output-format', choices=(HTML, JPEG), default=HTML)
 
     opts = parser.parse_args()
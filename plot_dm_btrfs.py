@@ -4,9 +4,14 @@ import os
 import sys
 import re
 import argparse
-import datetime
 import csv
-import plotly.express as px
+import heapq
+import numpy as np
+
+from parse_cache import cached_parse
+from log_open import open_log, strip_compressed_suffix
+from log_timestamps import date_cmd_ts
+from plot_lines import line_figure
 
 
 def error(msg):
@@ -14,6 +19,9 @@ def error(msg):
     sys.exit(1)
 
 
+# Bump when the parsing changes, to invalidate cached samples
+PARSER_VERSION = 3
+
 HTML = 'html'
 JPEG = 'jpeg'
 CSV = 'csv'
@@ -21,47 +29,32 @@ CSV = 'csv'
 # Thu Oct 22 10:49:59 UTC 2020
 TIMESTAMP_RE = re.compile(r'^(\S+\s+\S+\s+\d+\s+\d\d:\d\d:\d\d\s+\w+\s+\d\d\d\d)$')
 
-METRICS = (
-    'resolve_write_locked',
-    'migr_compl_s',
-    # 'migr_compl_a',
-    'unmap_chunk_s',
-    # 'unmap_chunk_a',
-    'upd_jrnl',
-    'wait_locked',
-    'remapped',
-    'migr',
-    'cow_rd',
-    'delay_rd',
-    'delay_wr',
-    'resolve_read',
-    'read',
-    'read_zeros')
-
-RES = (
-    ('resolve_write_locked', re.compile(r'^(resolve_write_locked):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('migr_compl_s', re.compile(r'^(migr_compl_s):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    # 'migr_compl_a', re.compile(r'^(migr_compl_a):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('unmap_chunk_s', re.compile(r'^(unmap_chunk_s):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    # 'unmap_chunk_a', re.compile(r'^(unmap_chunk_a):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('upd_jrnl', re.compile(r'^(upd_jrnl):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('wait_locked', re.compile(r'^(wait_locked):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('remapped', re.compile(r'^(remapped):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('migr', re.compile(r'^(migr):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('cow_rd', re.compile(r'^(cow_rd):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('delay_rd', re.compile(r'^(delay_rd):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('delay_wr', re.compile(r'^(delay_wr):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('resolve_read', re.compile(r'^(resolve_read):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('read', re.compile(r'^(read):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-    ('read_zeros', re.compile(r'^(read_zeros):\s+n:\s+(\d+)\s+a:\s+(\d+)us')),
-)
+# read:   n: 1523  a: 312us
+# the text before the first ':' is the metric name; names are discovered from the files
+LAT_COUNT_FIELD = 'n:'
+LAT_AVG_FIELD = 'a:'
+LAT_AVG_UNIT = 'us'
+
+ALL = 'ALL'
+
+# Samples a file may be out of time order by, unless given
+REORDER_WINDOW = 1024
+# The samples of a figure are held in an array which grows by this many
+PLOT_CHUNK_SAMPLES = 4096
+
+# what to produce for each metric
+AVG = 'avg'            # average latency (ms), a column per file
+COUNT = 'count'        # number of operations, a column per file
+WEIGHTED = 'weighted'  # average latency (ms) over all files, weighted by the number of operations
+VALUES = (AVG, COUNT, WEIGHTED)
 
 
 def validate_opts(opts):
     basenames = []
     for fname in opts.infile:
         realname = os.path.realpath(fname)
-        basename = os.path.basename(realname)
+        # the same columns for a compressed and an uncompressed file
+        basename = strip_compressed_suffix(os.path.basename(realname))
         if basename in basenames:
             error('Basename {} appears more than once'.format(basename))
         basenames.append(basename)
@@ -69,20 +62,29 @@ def validate_opts(opts):
     metrics = opts.metrics.split(',')
     if not metrics:
         error('No metrics specified')
-    have_all = False
-    for metric in metrics:
-        if metric == 'ALL':
-            have_all = True
-            break
-        if metric not in METRICS:
-            error('Invalid metric {}'.format(metric))
-    if have_all:
-        opts.metrics = METRICS
+    if ALL in metrics:
+        opts.metrics = None
     else:
         opts.metrics = metrics
 
     if opts.max_samples_per_file < 0:
         error('max_samples_per_file shoule be zero or positive')
+    if opts.reorder_window < 0:
+        error('reorder_window should be zero or positive')
+
+    return basenames
+
+
+def resolve_metrics(opts, discovered_metrics):
+    # called after parsing, when we know which metrics the files have
+    if opts.metrics is None:
+        if not discovered_metrics:
+            error('No metrics found in the input files')
+        opts.metrics = discovered_metrics
+    else:
+        for metric in opts.metrics:
+            if metric not in discovered_metrics:
+                error('Invalid metric {}'.format(metric))
 
     if opts.outfile_basename is None:
         if len(opts.metrics) == 1:
@@ -96,195 +98,305 @@ def validate_opts(opts):
         else:
             opts.fig_title = 'dm-btrfs Stats'
 
-    return basenames
-
 
 def produce_key(basename, metric):
     return '{}_{}'.format(basename, metric)
 
 
-def parse_dmbtrfs_stats(opts, fname, basename, samples):
-    curr_timestamp = None
+def parse_lat_fields(rest):
+    # rest of the line after 'name:', like 'n: 1523  a: 312us'
+    # returns (count, average latency in ms) or None, if this is not a latency line
+    fields = rest.split()
+    if len(fields) < 4 or fields[0] != LAT_COUNT_FIELD or fields[2] != LAT_AVG_FIELD or not fields[3].endswith(LAT_AVG_UNIT):
+        return None
+    try:
+        return int(fields[1]), float(fields[3][:-len(LAT_AVG_UNIT)]) / 1000
+    except ValueError:
+        return None
+
+
+def parse_dmbtrfs_stats(fname):
+    # Yields the samples of a file in the order they appear: (timestamp, {metric: (count, average latency in ms)})
+    curr_ts = None
     curr_sample = None
 
-    with open(fname, 'r') as f:
+    with open_log(fname) as f:
         for line in f:
-            m = TIMESTAMP_RE.search(line)
-            if m is not None:
-                new_timestamp = datetime.datetime.strptime(m.group(1), '%a %b %d %H:%M:%S UTC %Y')
-
-                assert curr_timestamp is None or curr_timestamp != new_timestamp
-                # we move to new timestamp
-                curr_timestamp = new_timestamp
-                curr_sample = samples.get(curr_timestamp)
-                if curr_sample is None:
-                    curr_sample = {}
-                    samples[curr_timestamp] = curr_sample
+            name, sep, rest = line.partition(':')
+            if not sep:
                 continue
 
-            for _field, regexp in RES:
-                m = regexp.search(line)
+            if ' ' in name:
+                # metric names have no spaces, this could be the timestamp
+                m = TIMESTAMP_RE.match(line)
                 if m is not None:
-                    # check if we should collect this metric
-                    metric = m.group(1)
-                    need_this = metric in opts.metrics
-                    if need_this:
-                        key = produce_key(basename, metric)
-                        if curr_sample.get(key) is not None:
-                            error('duplicate key {}'.format(key))
-                        curr_sample[key] = float(m.group(3)) / 1000
+                    if curr_sample is not None:
+                        yield curr_ts, curr_sample
+                    # we move to new timestamp
+                    curr_ts = date_cmd_ts(m.group(1))
+                    curr_sample = {}
+                continue
 
+            lat = parse_lat_fields(rest)
+            if lat is None:
+                continue
+            if curr_sample is None:
+                error('{}: did not see a timestamp before line:\n{}'.format(fname, line))
+            if name in curr_sample:
+                error('{}: duplicate {} at {}'.format(fname, name, curr_ts))
+            curr_sample[name] = lat
 
-def do_csv(opts, in_dirname, basenames, samples):
-    file_nr = 1
-    need_new_file = True
-    printed_samples = 0
-    outf = None
-    csv_writer = None
+    if curr_sample is not None:
+        yield curr_ts, curr_sample
 
-    # produce all samples sorted by timestamp (Datetime objec)
-    for dt in sorted(samples.keys()):
-        sample = samples[dt]
 
-        if need_new_file:
-            if opts.max_samples_per_file == 0 or len(samples) <= opts.max_samples_per_file:
-                outfile = os.path.join(in_dirname, '{}.{}'.format(opts.outfile_basename, 'csv'))
-            else:
-                outfile = os.path.join(in_dirname, '{}.{:04d}.{}'.format(opts.outfile_basename, file_nr, 'csv'))
-            outf = open(outfile, 'w')
+def discover_metrics(fname):
+    # the metrics of a file, in the order they first appear
+    metrics = []
+    for _ts, sample in parse_dmbtrfs_stats(fname):
+        metrics.extend(metric for metric in sample if metric not in metrics)
+    return metrics
 
-            csv_writer = csv.writer(outf)
 
-            header_row = ['timestamp']
-            for basename in basenames:
-                for metric in opts.metrics:
-                    header_row.append(produce_key(basename, metric))
-            csv_writer.writerow(header_row)
+def metrics_to_arrays(metrics):
+    return {'metrics': np.array(metrics, dtype=str)}
 
-            need_new_file = False
 
-        # print the current sample
-        row = [dt]
-        for basename in basenames:
-            for metric in opts.metrics:
-                key = produce_key(basename, metric)
-                val = sample.get(key)
-                if val is None:
-                    val = ' '
-                row.append(val)
-        csv_writer.writerow(row)
-
-        printed_samples = printed_samples + 1
-        if opts.max_samples_per_file > 0 and printed_samples >= opts.max_samples_per_file:
-            file_nr = file_nr + 1
-            need_new_file = True
-            printed_samples = 0
-            outf.close()
-            outf = None
-            csv_writer = None
+def metrics_from_arrays(arrays):
+    return arrays['metrics'].tolist()
 
-    if outf is not None:
-        outf.close()
 
+def add_discovered_metrics(file_metrics, discovered_metrics):
+    for metric in file_metrics:
+        if metric not in discovered_metrics:
+            discovered_metrics.append(metric)
 
-def do_plotly(opts, in_dirname, basenames, samples):
-    total_samples = len(samples)
-    total_added_samples = 0
 
-    file_nr = 1
-    need_new_file = True
-    added_samples = 0
+def produce_columns(opts, basenames):
+    # list of (column name, basenames the column is computed from, metric)
+    columns = []
+    if opts.value == WEIGHTED:
+        for metric in opts.metrics:
+            columns.append((produce_key(WEIGHTED, metric), basenames, metric))
+    else:
+        for basename in basenames:
+            for metric in opts.metrics:
+                columns.append((produce_key(basename, metric), (basename,), metric))
+    return columns
+
+
+def file_columns(opts, basenames):
+    # Returns the column names and, per file, {metric: indices of the columns the metric of the file goes to}
+    col_names = []
+    file_cols = [{} for _ in basenames]
+    for col_idx, (col_name, col_basenames, metric) in enumerate(produce_columns(opts, basenames)):
+        col_names.append(col_name)
+        for file_idx, basename in enumerate(basenames):
+            if basename in col_basenames:
+                file_cols[file_idx].setdefault(metric, []).append(col_idx)
+    return col_names, file_cols
+
+
+def sorted_samples(fname, file_idx, window):
+    # Yields (timestamp, file index, sample number, sample) of a file in time order. A sample may show up
+    # after up to window samples of later timestamps; only those are held, in a heap.
+    heap = []
+    last_ts = None
+    for sample_nr, (ts, sample) in enumerate(parse_dmbtrfs_stats(fname)):
+        if last_ts is not None and ts < last_ts:
+            error('{}: sample of {} is out of order by more than {} samples, see --reorder-window'.format(
+                fname, format_ts(ts), window))
+        # the sample number tells apart samples of the same timestamp, the samples are not compared
+        heapq.heappush(heap, (ts, file_idx, sample_nr, sample))
+        if len(heap) > window:
+            item = heapq.heappop(heap)
+            last_ts = item[0]
+            yield item
+    while heap:
+        yield heapq.heappop(heap)
+
+
+def sample_values(opts, counts, lats, avgs):
+    # values of a merged sample from the per-column sums; a value is None if no file reported the metric
+    values = []
+    for count, lat, avg in zip(counts, lats, avgs):
+        if avg is None:
+            values.append(None)
+        elif opts.value == COUNT:
+            values.append(count)
+        elif opts.value == AVG:
+            # single file
+            values.append(avg)
+        else:
+            values.append(lat / count if count > 0 else 0.0)
+    return values
+
+
+def merged_samples(opts, basenames, file_cols, nr_columns):
+    # Yields (timestamp, values) of all files in time order, merging the samples of the same timestamp.
+    # Every file is a sorted stream of samples, and the streams are combined with a heap,
+    # so only the samples of the reorder windows are held.
+    streams = [sorted_samples(fname, file_idx, opts.reorder_window) for file_idx, fname in enumerate(opts.infile)]
+
+    curr_ts = None
+    merged_files = counts = lats = avgs = None
+    for ts, file_idx, _sample_nr, sample in heapq.merge(*streams):
+        if ts != curr_ts:
+            if curr_ts is not None:
+                yield curr_ts, sample_values(opts, counts, lats, avgs)
+            curr_ts = ts
+            merged_files = []
+            # per column: total count, total latency (count * average) and the average of the last file
+            counts = [0] * nr_columns
+            lats = [0.0] * nr_columns
+            avgs = [None] * nr_columns
+        if file_idx in merged_files:
+            error('{}: duplicate timestamp {}'.format(basenames[file_idx], format_ts(ts)))
+        merged_files.append(file_idx)
+
+        cols = file_cols[file_idx]
+        for metric, (count, avg) in sample.items():
+            for col_idx in cols.get(metric, ()):
+                counts[col_idx] += count
+                lats[col_idx] += count * avg
+                avgs[col_idx] = avg
+
+    if curr_ts is not None:
+        yield curr_ts, sample_values(opts, counts, lats, avgs)
+
+
+def format_ts(ts):
+    # like str() of a datetime
+    return str(np.datetime64(ts, 'ns').astype('datetime64[s]').item())
+
+
+def format_value(opts, value):
+    # the latencies in the files are in us, the weighted averages are printed to the us as well
+    if opts.value == WEIGHTED:
+        return '{:.3f}'.format(value)
+    return value
+
+
+def output_fname(opts, in_dirname, file_nr, ext):
+    if file_nr is None:
+        return os.path.join(in_dirname, '{}.{}'.format(opts.outfile_basename, ext))
+    return os.path.join(in_dirname, '{}.{:04d}.{}'.format(opts.outfile_basename, file_nr, ext))
+
+
+def do_csv(opts, in_dirname, basenames):
+    # The rows are written as they are merged, up to max_samples_per_file per file. The first file is
+    # renamed to a numbered one once the samples turn out not to fit in it.
+    col_names, file_cols = file_columns(opts, basenames)
+    header_row = ['timestamp'] + col_names
 
-    timestamps = None
-    data = None
-    y = None
+    outf = None
+    file_nr = 0
+    nr_samples = 0
+    try:
+        for ts, values in merged_samples(opts, basenames, file_cols, len(col_names)):
+            if outf is None or nr_samples == opts.max_samples_per_file:
+                if outf is not None:
+                    outf.close()
+                    if file_nr == 1:
+                        os.rename(output_fname(opts, in_dirname, None, 'csv'), output_fname(opts, in_dirname, 1, 'csv'))
+                file_nr += 1
+                outf = open(output_fname(opts, in_dirname, file_nr if file_nr > 1 else None, 'csv'), 'w')
+                csv_writer = csv.writer(outf)
+                csv_writer.writerow(header_row)
+                nr_samples = 0
+            csv_writer.writerow([format_ts(ts)] + [' ' if val is None else format_value(opts, val) for val in values])
+            nr_samples += 1
+
+        if outf is None and opts.max_samples_per_file == 0:
+            # no samples, only the header
+            outf = open(output_fname(opts, in_dirname, None, 'csv'), 'w')
+            csv.writer(outf).writerow(header_row)
+    finally:
+        if outf is not None:
+            outf.close()
 
-    # produce all samples sorted by timestamp (Datetime objec)
-    for dt in sorted(samples.keys()):
-        sample = samples[dt]
 
-        if need_new_file:
-            # Prepare an input for plotly: produce a column for the X-axis (timestamp) and a column for each metric
-            timestamps = []
-            data = {'timestamp': timestamps}
-            y = []
-            for basename in basenames:
-                for metric in opts.metrics:
-                    key = produce_key(basename, metric)
-                    data[key] = []
-                    y.append(key)
+def write_figure(opts, in_dirname, file_nr, x_start, col_names, values):
+    # instead of real timestamp, use sample index; with timestamps the graph looks messy
+    x = np.arange(x_start, x_start + len(values))
+    fig = line_figure(x, [(col_name, values[:, col_idx]) for col_idx, col_name in enumerate(col_names)],
+                      opts.fig_title, opts.target_points)
 
-            need_new_file = False
+    outfile = output_fname(opts, in_dirname, file_nr, opts.output_format)
+    if opts.output_format == HTML:
+        fig.write_html(outfile)
+    elif opts.output_format == JPEG:
+        fig.write_image(outfile)
+    else:
+        error('Unsupported output format [{}]'.format(opts.output_format))
 
-        # instead of real timestamp, append sample index; with timestamps the graph looks messy
-        timestamps.append(total_added_samples)
 
-        for basename in basenames:
-            for metric in opts.metrics:
-                key = produce_key(basename, metric)
-                val = sample.get(key)
-                if val is None:
-                    val = 0
-                data[key].append(val)
-
-        added_samples += 1
-        total_added_samples += 1
-
-        # we need to flush the current content if:
-        # - this is the last sample OR
-        # - we have max_samples_per_file limit and we are about to cross it
-        if total_added_samples == total_samples or (opts.max_samples_per_file > 0 and added_samples >= opts.max_samples_per_file):
-            fig = px.line(data, x='timestamp', y=y, title=opts.fig_title)
-
-            # figure out the file name
-            if opts.max_samples_per_file == 0 or total_samples <= opts.max_samples_per_file:
-                # single file
-                outfile = os.path.join(in_dirname, '{}.{}'.format(opts.outfile_basename, opts.output_format))
-            else:
-                # multiple files
-                outfile = os.path.join(in_dirname, '{}.{:04d}.{}'.format(opts.outfile_basename, file_nr, opts.output_format))
-
-            if opts.output_format == HTML:
-                fig.write_html(outfile)
-            elif opts.output_format == JPEG:
-                fig.write_image(outfile)
-            else:
-                error('Unsupported output format [{}]'.format(opts.output_format))
-
-            # reset stuff
-            file_nr = file_nr + 1
-            need_new_file = True
-            added_samples = 0
-            timestamps = None
-            data = None
-            y = None
+def do_plotly(opts, in_dirname, basenames):
+    # The samples of a figure are held until it is full, max_samples_per_file of them if set
+    col_names, file_cols = file_columns(opts, basenames)
+
+    max_samples = opts.max_samples_per_file
+    values = np.empty((min(max_samples, PLOT_CHUNK_SAMPLES) if max_samples > 0 else PLOT_CHUNK_SAMPLES, len(col_names)))
+    file_nr = 1
+    x_start = 0
+    nr_samples = 0
+    for _ts, sample_values in merged_samples(opts, basenames, file_cols, len(col_names)):
+        if nr_samples == max_samples:
+            # there are more samples than fit in one file
+            write_figure(opts, in_dirname, file_nr, x_start, col_names, values[:nr_samples])
+            file_nr += 1
+            x_start += nr_samples
+            nr_samples = 0
+        if nr_samples == len(values):
+            new_len = 2 * len(values) if max_samples == 0 else min(2 * len(values), max_samples)
+            values = np.concatenate([values, np.empty((new_len - len(values), len(col_names)))])
+        # a metric missing from a sample is plotted as 0
+        values[nr_samples] = [0 if val is None else val for val in sample_values]
+        nr_samples += 1
+
+    if nr_samples > 0 or max_samples == 0:
+        write_figure(opts, in_dirname, file_nr if file_nr > 1 else None, x_start, col_names, values[:nr_samples])
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('--infile', required=True, nargs='+', help='dmbtrfs latency breakdown files')
     parser.add_argument('-o', '--outfile-basename', required=False)
-    parser.add_argument('--metrics', default='ALL')
+    parser.add_argument('--metrics', default=ALL, help='comma-separated metric names, as they appear in the files, or ALL')
+    parser.add_argument('--value', choices=VALUES, default=AVG,
+                        help='avg: average latency per file, count: number of operations per file, '
+                             'weighted: average latency over all files, weighted by the number of operations')
     parser.add_argument('--max-samples-per-file', type=int, default=0)
+    parser.add_argument('--reorder-window', type=int, default=REORDER_WINDOW,
+                        help='number of samples a sample of a file may show up after, though its timestamp is earlier')
     parser.add_argument('--fig-title')
+    parser.add_argument('--target-points', type=int, default=0,
+                        help='decimate every line to this many points (LTTB, keeps the peaks), default is to plot all samples')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or write the cache of the metrics of the files')
     parser.add_argument('-f', '--output-format', choices=(HTML, JPEG, CSV), default=HTML)
 
     opts = parser.parse_args()
 
     basenames = validate_opts(opts)
 
-    samples = {}
-    for fname, basename in zip(opts.infile, basenames):
+    # the samples are parsed as they are merged, here only the metrics of every file are collected
+    discovered_metrics = []
+    for fname in opts.infile:
         print('Parsing {}...'.format(fname))
-        parse_dmbtrfs_stats(opts, fname, basename, samples)
+        metrics = cached_parse(fname, 'plot_dm_btrfs', PARSER_VERSION, {},
+                               lambda: discover_metrics(fname), metrics_to_arrays, metrics_from_arrays,
+                               enabled=not opts.no_cache)
+        add_discovered_metrics(metrics, discovered_metrics)
+
+    resolve_metrics(opts, discovered_metrics)
 
     # take the directory name from the first input file
     in_realname = os.path.realpath(opts.infile[0])
     in_dirname = os.path.dirname(in_realname)
 
     if opts.output_format in (HTML, JPEG):
-        do_plotly(opts, in_dirname, basenames, samples)
+        do_plotly(opts, in_dirname, basenames)
     elif opts.output_format == CSV:
-        do_csv(opts, in_dirname, basenames, samples)
+        do_csv(opts, in_dirname, basenames)
     else:
         error('Invalid output format {}'.format(opts.output_format))
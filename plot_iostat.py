@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
 import sys
-import re
 import argparse
 import os
+import time
+import numpy as np
 import plotly.express as px
+from plotly.subplots import make_subplots
+
+from log_open import is_compressed
+from iostat_parser import parse_iostat_cached, parse_iostat_appended, find_tail_offset, ALL_METRICS, RD_PER_SEC, RD_MB_SEC, RD_LAT_MS, WR_PER_SEC, WR_MB_SEC, WR_LAT_MS
+from plot_lines import line_figure, line_trace
 
 
 def bug(msg):
@@ -12,31 +18,6 @@ def bug(msg):
     assert False
 
 
-# 10/12/20 19:51:43
-HEADER = re.compile(r'^(\d+/\d+/\d+\s+\d+:\d+:\d+)')
-
-
-# Device            r/s     w/s     rkB/s     wkB/s   rrqm/s   wrqm/s  %rrqm  %wrqm r_await w_await aqu-sz rareq-sz wareq-sz  svctm  %util
-# vda              0.00    2.00      0.00      8.00     0.00     0.00   0.00   0.00    0.00    0.50   0.00     0.00     4.00   0.00   0.00
-IOSTAT = re.compile(r'([\w-]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+[\d.]+\s+[\d.]+\s+[\d.]+\s+[\d.]+\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+[\d.]+\s+([\d.]+)')
-
-RD_PER_SEC = "rd_per_sec"
-RD_MB_SEC = "rd_mb_sec"
-RD_LAT_MS = "rd_lat_ms"
-
-WR_PER_SEC = "wr_per_sec"
-WR_MB_SEC = "wr_mb_sec"
-WR_LAT_MS = "wr_lat_ms"
-
-QU_SZ = 'qu_sz'
-RA_REQ_SZ = 'ra_req_sz'
-WA_REQ_SZ = 'wa_req_sz'
-UTIL = 'util'
-
-ALL_METRICS = (RD_PER_SEC, RD_MB_SEC, RD_LAT_MS,
-               WR_PER_SEC, WR_MB_SEC, WR_LAT_MS,
-               QU_SZ, UTIL, RA_REQ_SZ, WA_REQ_SZ)
-
 HTML = 'html'
 JPEG = 'jpeg'
 
@@ -56,62 +37,132 @@ def validate_opts(opts):
         if opts.blkdevs[idx].startswith('/dev/'):
             opts.blkdevs[idx] = opts.blkdevs[idx][5:]
 
+    for blkdev in opts.blkdevs:
+        if blkdev == 'timestamp':
+            bug('Invalid name for a block device: {}'.format(blkdev))
+
+    if opts.follow and is_compressed(opts.infile):
+        bug('Follow mode is not supported for compressed logs')
+    if opts.follow and opts.max_samples > 0 and not opts.samples_from_end:
+        bug('In follow mode, --max-samples requires --samples-from-end')
+    if opts.refresh_interval <= 0:
+        bug('refresh_interval should be positive')
+
+
+def write_fig(opts, fig, outfile):
+    # write to a temporary file and rename it, so that the output is never seen half-written in follow mode
+    tmpfile = outfile + '.tmp'
+    if opts.output_format == HTML:
+        fig.write_html(tmpfile)
+    elif opts.output_format == JPEG:
+        fig.write_image(tmpfile, format=JPEG)
+    else:
+        bug('Unsupported output format [{}]'.format(opts.output_format))
+    os.replace(tmpfile, outfile)
+
 
-def parse_iostat(opts):
-    print('Parsing iostat log...')
+# Height of a single metric panel in --single-figure mode
+PANEL_HEIGHT = 300
 
-    samples = []
 
-    curr_header = None
-    curr_sample = {}
+def x_axis(opts, store):
+    if opts.real_timestamp:
+        return [label.split()[-1] for label in store.labels]
+    return np.arange(len(store))
 
-    with open(opts.infile, 'r') as fin:
-        for line in fin:
-            m = HEADER.match(line)
-            if m is not None:
-                if curr_header is not None:
-                    # new header found, finalize the previous sample, before starting the new one
-                    samples.append((curr_header, curr_sample))
-                curr_header = m.group(1)
-                curr_sample = {}
-                continue
 
-            m = IOSTAT.match(line)
-            if m is not None:
-                if curr_header is None:
-                    bug('Did not see a timestamp header before line:\n{}'.format(line))
+def do_plotly_single_figure(opts, in_dir_name, out_name, store):
+    # One figure with a panel per metric, all sharing (and zooming) the same time axis
+    metrics = [metric for metric in ALL_METRICS if metric in opts.metrics]
+    timestamps = x_axis(opts, store)
+    # block devices missing from a sample are plotted as 0
+    values = np.nan_to_num(store.values)
+    colors = px.colors.qualitative.Plotly
 
-                blkdev = m.group(1)
-                if blkdev not in opts.blkdevs:
-                    continue
+    fig = make_subplots(rows=len(metrics), cols=1, shared_xaxes=True, vertical_spacing=0.02,
+                        subplot_titles=metrics)
+    for row, metric in enumerate(metrics, start=1):
+        metric_idx = store.metric_idx[metric]
+        for blkdev_nr, blkdev in enumerate(opts.blkdevs):
+            fig.add_trace(line_trace(timestamps, values[:, store.entity_idx[blkdev], metric_idx], blkdev,
+                                     opts.target_points, legendgroup=blkdev, showlegend=(row == 1),
+                                     line={'color': colors[blkdev_nr % len(colors)]}),
+                          row=row, col=1)
+    fig.update_layout(title='iostat' if opts.fig_title is None else opts.fig_title,
+                      height=PANEL_HEIGHT * len(metrics))
+    fig.update_xaxes(title_text='timestamp', row=len(metrics), col=1)
 
-                curr_sample[blkdev] = {RD_PER_SEC: float(m.group(2)), WR_PER_SEC: float(m.group(3)),
-                                       RD_MB_SEC: float(m.group(4)) / 1024, WR_MB_SEC: float(m.group(5)) / 1024,
-                                       RD_LAT_MS: float(m.group(6)), WR_LAT_MS: float(m.group(7)),
-                                       QU_SZ: float(m.group(8)),
-                                       RA_REQ_SZ: float(m.group(9)), WA_REQ_SZ: float(m.group(10)),
-                                       UTIL: float(m.group(11))}
+    print('Producing {} plot for metrics [{}]...'.format(opts.output_format, ', '.join(metrics)))
 
-    if curr_header is not None:
-        samples.append((curr_header, curr_sample))
+    outfile = os.path.join(in_dir_name, '{}_{}.{}'.format(out_name, 'iostat', opts.output_format))
+    write_fig(opts, fig, outfile)
 
-    print('Total {} samples'.format(len(samples)))
 
-    # First line in iostat output contains bogus values, cut it
-    cut_first_line = not opts.dont_cut_first_line
-    if cut_first_line:
-        print('Cutting first line of iostat output')
-        samples = samples[1:]
+def do_plotly(opts, in_dir_name, out_name, store):
+    if opts.single_figure:
+        do_plotly_single_figure(opts, in_dir_name, out_name, store)
+        return
+
+    timestamps = x_axis(opts, store)
+
+    # For each metric, produce a separate graph
+    for metric in opts.metrics:
+        # Prepare an input for plotly:
+        # produce a column for the X-axis (timestamp) and a column for each requested block device
+        data = {'timestamp': timestamps}
+        y = []
+        for blkdev in opts.blkdevs:
+            # block devices missing from a sample are plotted as 0
+            data[blkdev] = np.nan_to_num(store.column(blkdev, metric))
+            y.append(blkdev)
+
+        print('Producing {} plot for metric [{}]...'.format(opts.output_format, metric))
+
+        fig = line_figure(data['timestamp'], [(name, data[name]) for name in y],
+                          metric if opts.fig_title is None else '{},{}'.format(opts.fig_title, metric), opts.target_points)
 
-    # Limit to max_samples
+        outfile = os.path.join(in_dir_name, '{}_{}.{}'.format(out_name, metric, opts.output_format))
+        write_fig(opts, fig, outfile)
+
+
+def follow_iostat(opts, in_dir_name, out_name):
+    # Parse only what was appended to the log since the previous refresh, and re-render
+    cut_first_line = not opts.dont_cut_first_line
+    store = None
+    offset = 0
+    st = os.stat(opts.infile)
+    # a rotated log is replaced by another file, or truncated in place (copytruncate)
+    file_id = (st.st_dev, st.st_ino)
     if opts.max_samples > 0:
-        print('Limiting to {} samples{}'.format(opts.max_samples, ' (from end)' if opts.samples_from_end else ''))
-        if opts.samples_from_end:
-            samples = samples[len(samples) - opts.max_samples:]
-        else:
-            samples = samples[:opts.max_samples]
+        # No need to parse what is already out of the window. The last sample is parsed only once the next
+        # header shows up, and the first one of the log is cut if the window reaches it.
+        offset = find_tail_offset(opts.infile, opts.max_samples + 1 + (1 if cut_first_line else 0))
+    while True:
+        st = os.stat(opts.infile)
+        if (st.st_dev, st.st_ino) != file_id or st.st_size < offset:
+            print('{} was rotated or truncated, starting over'.format(opts.infile))
+            file_id = (st.st_dev, st.st_ino)
+            store = None
+            offset = 0
+
+        first_offset = offset
+        new_samples, offset = parse_iostat_appended(opts, offset)
+        if len(new_samples) > 0:
+            print('{} new samples'.format(len(new_samples)))
+            if store is None:
+                # First line in iostat output contains bogus values, cut it
+                if cut_first_line and first_offset == 0:
+                    new_samples.truncate(1, len(new_samples))
+                store = new_samples
+            else:
+                store.extend(new_samples)
+
+            if opts.max_samples > 0 and len(store) > opts.max_samples:
+                store.truncate(len(store) - opts.max_samples, len(store))
 
-    return samples
+            do_plotly(opts, in_dir_name, out_name, store)
+
+        time.sleep(opts.refresh_interval)
 
 
 if __name__ == '__main__':
@@ -122,15 +173,24 @@ if __name__ == '__main__':
     parser.add_argument('--max-samples', type=int, default=0)
     parser.add_argument('--samples-from-end', action='store_true')
     parser.add_argument('--dont-cut-first-line', action='store_true')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or write the parsed samples cache')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='number of parsing processes, default is the number of CPUs')
     parser.add_argument('--real-timestamp', action='store_true')
     parser.add_argument('--fig-title')
+    parser.add_argument('--target-points', type=int, default=0,
+                        help='decimate every line to this many points (LTTB, keeps the peaks), default is to plot all samples')
+    parser.add_argument('--single-figure', action='store_true',
+                        help='produce a single figure, with a panel per metric and a shared time axis')
     parser.add_argument('-f', '--output-format', choices=(HTML, JPEG), default=HTML)
+    parser.add_argument('--follow', action='store_true', help='keep parsing samples appended to the log and refresh the output')
+    parser.add_argument('--refresh-interval', type=float, default=10, help='seconds between refreshes in follow mode, default is 10')
     parser.add_argument('blkdevs', nargs='+')
 
     opts = parser.parse_args()
     validate_opts(opts)
 
-    samples = parse_iostat(opts)
+    if not opts.follow:
+        store = parse_iostat_cached(opts, 'plot_iostat')
 
     in_proper_name = os.path.realpath(opts.infile)
     in_dir_name = os.path.dirname(in_proper_name)
@@ -140,42 +200,12 @@ if __name__ == '__main__':
     else:
         out_name = in_base_name
 
-    # For each metric, produce a separate graph
-    for metric in opts.metrics:
-        # Prepare an input for plotly:
-        # produce a column for the X-axis (timestamp) and a column for each requested block device
-        timestamps = []
-        data = {'timestamp': timestamps}
-        y = []
-        for blkdev in opts.blkdevs:
-            if blkdev == 'timestamp':
-                bug('Invalid name for a block device: {}'.format(blkdev))
-            data[blkdev] = []
-            y.append(blkdev)
-
-        sample_idx = 0
-        for sample in samples:
-            if opts.real_timestamp:
-                timestamps.append(sample[0].split()[-1])
-            else:
-                timestamps.append(sample_idx)
-            sample_idx += 1
-
-            for blkdev in opts.blkdevs:
-                sample_for_blkdev = sample[1].get(blkdev)
-                data[blkdev].append(0 if sample_for_blkdev is None else sample_for_blkdev[metric])
-
-        print('Producing {} plot for metric [{}]...'.format(opts.output_format, metric))
-
-        fig = px.line(data, x='timestamp', y=y,
-                      title=metric if opts.fig_title is None else '{},{}'.format(opts.fig_title, metric))
-
-        outfile = os.path.join(in_dir_name, '{}_{}.{}'.format(out_name, metric, opts.output_format))
-        if opts.output_format == HTML:
-            fig.write_html(outfile)
-        elif opts.output_format == JPEG:
-            fig.write_image(outfile)
-        else:
-            bug('Unsupported output format [{}]'.format(opts.output_format))
+    if opts.follow:
+        try:
+            follow_iostat(opts, in_dir_name, out_name)
+        except KeyboardInterrupt:
+            pass
+    else:
+        do_plotly(opts, in_dir_name, out_name, store)
 
     print('Done.')
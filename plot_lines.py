@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import plotly.graph_objects as go
+
+
+def lttb_indices(y, nr_points):
+    # Largest-Triangle-Three-Buckets: indices of nr_points samples of y, which keep the visual shape of the
+    # series, peaks included. Samples are taken as equally spaced, the first and the last one are always kept.
+    nr_samples = len(y)
+    if nr_points >= nr_samples or nr_points < 3:
+        return np.arange(nr_samples)
+
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+    x = np.arange(nr_samples, dtype=np.float64)
+
+    indices = np.empty(nr_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = nr_samples - 1
+
+    # nr_points - 2 buckets over the samples between the first and the last one
+    edges = np.linspace(1, nr_samples - 1, nr_points - 1).astype(np.int64)
+
+    prev = 0
+    for bucket in range(nr_points - 2):
+        start = edges[bucket]
+        end = edges[bucket + 1]
+
+        # the third point of the triangle is the average of the next bucket, or the last sample
+        if bucket + 2 < len(edges):
+            next_x = x[end:edges[bucket + 2]].mean()
+            next_y = y[end:edges[bucket + 2]].mean()
+        else:
+            next_x = x[-1]
+            next_y = y[-1]
+
+        # twice the triangle area, for each candidate in the bucket
+        areas = np.abs((x[prev] - next_x) * (y[start:end] - y[prev]) -
+                       (x[prev] - x[start:end]) * (next_y - y[prev]))
+        prev = start + int(np.argmax(areas))
+        indices[bucket + 1] = prev
+
+    return indices
+
+
+def line_trace(x, y, name, target_points=0, **kwargs):
+    # WebGL line trace, decimated with LTTB to target_points, if set
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if target_points > 0 and len(y) > target_points:
+        indices = lttb_indices(y, target_points)
+        x = x[indices]
+        y = y[indices]
+    return go.Scattergl(x=x, y=y, name=name, mode='lines', **kwargs)
+
+
+def line_figure(x, series, title, target_points=0, x_title='timestamp'):
+    # A line per (name, values) pair in series, all against x; looks like the wide-form px.line() output
+    fig = go.Figure()
+    for name, y in series:
+        fig.add_trace(line_trace(x, y, name, target_points))
+    fig.update_layout(title=title, xaxis_title=x_title, yaxis_title='value', legend_title_text='variable')
+    return fig
+
+
+def bucket_max(values, nr_points):
+    # (sample, series) values -> (start index, per-series max) of nr_points equal buckets of samples;
+    # unlike LTTB, this works for all the series at once, and a short peak still shows up
+    nr_samples = values.shape[0]
+    if nr_points >= nr_samples or nr_points < 1:
+        return np.arange(nr_samples), values
+    starts = np.linspace(0, nr_samples, nr_points, endpoint=False).astype(np.int64)
+    # fmax ignores NaN, unless all the bucket is NaN
+    return starts, np.fmax.reduceat(values, starts, axis=0)
+
+
+def heatmap_figure(x, names, values, title, target_points=0, x_title='timestamp'):
+    # values: (sample, series); a row per series, a column per sample (or per bucket of target_points)
+    x = np.asarray(x)
+    values = np.asarray(values)
+    if target_points > 0:
+        starts, values = bucket_max(values, target_points)
+        x = x[starts]
+    fig = go.Figure(go.Heatmap(x=x, y=[str(name) for name in names], z=values.T, colorscale='Hot', reversescale=True))
+    fig.update_layout(title=title, xaxis_title=x_title, yaxis_type='category')
+    return fig
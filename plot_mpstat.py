@@ -5,8 +5,12 @@ import sys
 import argparse
 import re
 import csv
-import datetime
-import plotly.express as px
+import numpy as np
+
+from sample_store import SampleStore
+from parse_cache import cached_parse
+from log_open import open_log
+from plot_lines import line_figure, heatmap_figure
 
 
 def bug(msg):
@@ -14,45 +18,32 @@ def bug(msg):
     assert False
 
 
-FLOAT_STR = r'[0-9\.]+'
+FLOAT_STR = r'([0-9\.]+)'
 
 # 14:32:33     CPU    %usr   %nice    %sys %iowait    %irq   %soft  %steal  %guest  %gnice   %idle
 # 14:32:34     all    0.34    0.34    0.67    0.34    0.00    0.00    0.00    0.00    0.00   98.32
-MPSTAT_ALL = re.compile(r'^(\d\d:\d\d:\d\d)\s+(all)\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     r'(' + FLOAT_STR + r')' + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     r'(' + FLOAT_STR + r')')
-
-MPSTAT_EACH = re.compile(r'^(\d\d:\d\d:\d\d)\s+(\d+)\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     r'(' + FLOAT_STR + r')' + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     FLOAT_STR + r'\s+' +
-                     r'(' + FLOAT_STR + r')')
-
-MPSTAT_CPU_STR = r'^(\d\d:\d\d:\d\d)\s+({})\s+' +\
-                     FLOAT_STR + r'\s+' +\
-                     FLOAT_STR + r'\s+' +\
-                     FLOAT_STR + r'\s+' +\
-                     r'(' + FLOAT_STR + r')' + r'\s+' +\
-                     FLOAT_STR + r'\s+' +\
-                     FLOAT_STR + r'\s+' +\
-                     FLOAT_STR + r'\s+' +\
-                     FLOAT_STR + r'\s+' +\
-                     FLOAT_STR + r'\s+' +\
-                     r'(' + FLOAT_STR + r')'
+# 14:32:34       0    0.00    0.00    1.01    0.00    0.00    0.00    0.00    0.00    0.00   98.99
+MPSTAT_LINE = re.compile(r'^(\d\d:\d\d:\d\d)\s+(all|\d+)' + r'\s+' .join([''] + [FLOAT_STR] * 10))
+
+# All the columns, in the order they appear
+USR = 'usr'
+NICE = 'nice'
+SYS = 'sys'
+IOWAIT = 'iowait'
+IRQ = 'irq'
+SOFT = 'soft'
+STEAL = 'steal'
+GUEST = 'guest'
+GNICE = 'gnice'
+IDLE = 'idle'
+COLUMNS = (USR, NICE, SYS, IOWAIT, IRQ, SOFT, STEAL, GUEST, GNICE, IDLE)
+
+# 100 - idle
+CPU_USAGE = 'cpu_usage'
+METRICS = (CPU_USAGE,) + COLUMNS
+
+# Bump when the parsing changes, to invalidate cached samples
+PARSER_VERSION = 3
 
 HTML = 'html'
 JPEG = 'jpeg'
@@ -66,6 +57,12 @@ def validate_opts(opts):
         cpu_int = int(opts.cpu)
         opts.cpu = cpu_int
 
+    if opts.numa_map is not None and opts.cpu != 'each':
+        bug('NUMA node rollups need --cpu each')
+
+    if opts.heatmap and opts.output_format == CSV:
+        bug('Heatmap is not available in {} format'.format(CSV))
+
     if opts.max_samples_per_file < 0:
         bug('max_samples_per_file should be 0 or positive')
 
@@ -73,169 +70,164 @@ def validate_opts(opts):
         opts.fig_title = opts.metric
 
 
-def parse_mpstat(opts):
-    regexp = None
-    if opts.cpu == 'all':
-        regexp = MPSTAT_ALL
-    elif opts.cpu == 'each':
-        regexp = MPSTAT_EACH
-    else:
-        regexp = re.compile(MPSTAT_CPU_STR.format(opts.cpu))
-
-    samples = []
-    curr_sample = None
+def parse_mpstat(opts, verbose=True):
+    # All the columns of all the CPUs, 'all' included, go into an (interval, cpu, column) cube;
+    # CPUs are added in the order they show up
+    store = SampleStore([], COLUMNS, dtype=np.float64)
+    cpu_idx = store.entity_idx
+    sample_idx = None
+    curr_ts = None
 
-    with open(opts.infile, 'r') as fin:
+    with open_log(opts.infile) as fin:
         for line in fin:
-            m = regexp.match(line)
+            m = MPSTAT_LINE.match(line)
             if m is not None:
-                curr_ts = curr_sample['ts'] if curr_sample is not None else None
-                ts = datetime.datetime.strptime(m.group(1), '%H:%M:%S')
+                # all CPU lines of an interval have the same timestamp, a new one starts a new interval
+                ts = m.group(1)
                 if ts != curr_ts:
-                    curr_sample = {'ts': ts, 'cpus': []}
-                    samples.append(curr_sample)
+                    sample_idx = store.new_sample(ts)
                     curr_ts = ts
 
                 cpu = m.group(2)
-
-                if opts.metric == 'cpu_usage':
-                    value = 100 - float(m.group(4))
-                elif opts.metric == 'iowait':
-                    value = float(m.group(3))
-                else:
-                    bug('Unsupported metric: {}'.format(opts.metric))
-                new_tpl = (cpu, value)
+                idx = cpu_idx.get(cpu)
+                if idx is None:
+                    idx = store.add_entity(cpu)
 
                 # In some cases mpstat produces two lines with the same timestamp for the same CPU.
-                # In this case, replace the previous one.
-                cpus_list = curr_sample['cpus']
-                idx = 0
-                dup_found = False
-                for tpl in cpus_list:
-                    if tpl[0] == cpu:
-                        dup_found = True
-                        break
-                    idx = idx + 1
-                if dup_found:
-                    cpus_list[idx] = new_tpl
-                else:
-                    cpus_list.append(new_tpl)
-
-    print('Total {} samples'.format(len(samples)))
-    return samples
-
-
-def do_csv(in_dir_name, out_name, samples):
-    file_nr = 1
-    need_new_file = True
-    printed_samples = 0
-    outf = None
-    csv_writer = None
-
-    for sample in samples:
-        if need_new_file:
-            if opts.max_samples_per_file == 0 or len(samples) <= opts.max_samples_per_file:
-                outfile = os.path.join(in_dir_name, '{}.{}'.format(out_name, 'csv'))
-            else:
-                outfile = os.path.join(in_dir_name, '{}.{:04d}.{}'.format(out_name, file_nr, 'csv'))
-            outf = open(outfile, 'w')
+                # In this case, the later one overwrites the previous one.
+                store.set_values(sample_idx, idx, [float(val) for val in m.groups()[2:]])
+
+    if verbose:
+        print('Total {} samples'.format(len(store)))
+    return store
+
+
+def read_numa_map(path):
+    # Returns {cpu id string: node}. path is either a directory like /sys/devices/system/node
+    # (or a copy of it taken on the node the log comes from), with a nodeN/cpulist file per node,
+    # or a file with a '<node> <cpulist>' line per node. cpulist is like '0-23,48-71'.
+    node_cpulists = []
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            m = re.match(r'^node(\d+)$', name)
+            if m is not None:
+                with open(os.path.join(path, name, 'cpulist')) as f:
+                    node_cpulists.append((int(m.group(1)), f.read().strip()))
+    else:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                if len(fields) != 2:
+                    bug('Invalid line in NUMA map {}: {}'.format(path, line.strip()))
+                node_cpulists.append((int(fields[0]), fields[1]))
+
+    if not node_cpulists:
+        bug('No NUMA nodes found in {}'.format(path))
+
+    cpu_node = {}
+    for node, cpulist in node_cpulists:
+        for cpu_range in cpulist.split(','):
+            if not cpu_range:
+                continue
+            first, _, last = cpu_range.partition('-')
+            for cpu in range(int(first), int(last or first) + 1):
+                cpu_node[str(cpu)] = node
+    return cpu_node
+
+
+def metric_values(opts, store):
+    # (interval, cpu) matrix of the requested metric
+    if opts.metric == CPU_USAGE:
+        return 100 - store.values[:, :, store.metric_idx[IDLE]]
+    return store.values[:, :, store.metric_idx[opts.metric]]
+
+
+def select_series(opts, store):
+    # Returns names of the series to output, their CSV column names and the (interval, series) matrix
+    values = metric_values(opts, store)
 
+    if opts.cpu == 'all':
+        cpus = ['all']
+    elif opts.cpu == 'each':
+        cpus = [cpu for cpu in store.entities if cpu != 'all']
+    else:
+        cpus = [str(opts.cpu)]
+    cpus = [cpu for cpu in cpus if cpu in store.entity_idx]
+    values = values[:, [store.entity_idx[cpu] for cpu in cpus]]
+
+    if opts.numa_map is None:
+        return cpus, ['cpu_{}'.format(cpu) for cpu in cpus], values
+
+    # average of the CPUs of every node, a CPU missing from an interval does not count
+    cpu_node = read_numa_map(opts.numa_map)
+    missing = [cpu for cpu in cpus if cpu not in cpu_node]
+    if missing:
+        bug('CPUs {} are not in NUMA map {}'.format(','.join(missing), opts.numa_map))
+    nodes = sorted(set(cpu_node[cpu] for cpu in cpus))
+    # (cpu, node) membership matrix
+    membership = np.zeros((len(cpus), len(nodes)))
+    for idx, cpu in enumerate(cpus):
+        membership[idx, nodes.index(cpu_node[cpu])] = 1
+    reported = ~np.isnan(values)
+    totals = np.where(reported, values, 0).dot(membership)
+    counts = reported.astype(np.float64).dot(membership)
+    with np.errstate(invalid='ignore'):
+        node_values = totals / counts
+    names = ['node{}'.format(node) for node in nodes]
+    return names, names, node_values
+
+
+def output_ranges(nr_samples):
+    # [start, stop) of the samples that go to each output file
+    if opts.max_samples_per_file == 0:
+        return [(0, nr_samples)]
+    return [(start, min(start + opts.max_samples_per_file, nr_samples))
+            for start in range(0, nr_samples, opts.max_samples_per_file)]
+
+
+def output_fname(in_dir_name, out_name, file_nr, nr_files, ext):
+    if nr_files == 1:
+        return os.path.join(in_dir_name, '{}.{}'.format(out_name, ext))
+    return os.path.join(in_dir_name, '{}.{:04d}.{}'.format(out_name, file_nr, ext))
+
+
+def do_csv(in_dir_name, out_name, store):
+    names, col_names, values = select_series(opts, store)
+    header_row = ['timestamp'] + col_names
+
+    ranges = output_ranges(len(store))
+    for file_nr, (start, stop) in enumerate(ranges, 1):
+        outfile = output_fname(in_dir_name, out_name, file_nr, len(ranges), 'csv')
+        with open(outfile, 'w') as outf:
             csv_writer = csv.writer(outf)
-
-            header_row = ['timestamp']
-            # use the first sample to produce list of CPUs
-            list_of_tuples = samples[0]['cpus']
-            for t in list_of_tuples:
-                header_row.append('cpu_{}'.format(t[0]))
             csv_writer.writerow(header_row)
+            for ts, row_values in zip(store.labels[start:stop], values[start:stop].tolist()):
+                # a CPU missing from an interval leaves an empty cell
+                csv_writer.writerow([ts] + ['' if value != value else '{:.2f}'.format(value) for value in row_values])
 
-            need_new_file = False
-
-        # print the current sample
-        row = [sample['ts'].strftime('%H:%M:%S')]
-        list_of_tuples = sample['cpus']
-        for t in list_of_tuples:
-            row.append('{:.2f}'.format(t[1]))
-        csv_writer.writerow(row)
-
-        printed_samples = printed_samples + 1
-        if opts.max_samples_per_file > 0 and printed_samples >= opts.max_samples_per_file:
-            file_nr = file_nr + 1
-            need_new_file = True
-            printed_samples = 0
-            outf.close()
-            outf = None
-            csv_writer = None
-
-    if outf is not None:
-        outf.close()
-
-
-def do_plotly(in_dir_name, out_name, samples):
-    total_samples = len(samples)
-    total_added_samples = 0
-
-    file_nr = 1
-    need_new_file = True
-    added_samples = 0
-
-    timestamps = None
-    data = None
-    y = None
-
-    for sample in samples:
-        if need_new_file:
-            # Prepare an input for plotly: produce a column for the X-axis (timestamp) and a column for each metric
-            timestamps = []
-            data = {'timestamp': timestamps}
-            y = []
-            # use the first sample to produce list of CPUs
-            list_of_tuples = samples[0]['cpus']
-            for t in list_of_tuples:
-                cpu = t[0]
-                data[cpu] = []
-                y.append(cpu)
-
-            need_new_file = False
-
-        # instead of real timestamp, append sample index; with timestamps the graph looks messy
-        timestamps.append(total_added_samples)
-
-        list_of_tuples = sample['cpus']
-        for t in list_of_tuples:
-            data[t[0]].append(t[1])
-
-        added_samples += 1
-        total_added_samples += 1
-
-        # we need to flush the current content if:
-        # - this is the last sample OR
-        # - we have max_samples_per_file limit and we are about to cross it
-        if total_added_samples == total_samples or (opts.max_samples_per_file > 0 and added_samples >= opts.max_samples_per_file):
-            fig = px.line(data, x='timestamp', y=y, title=opts.fig_title)
-
-            # figure out the file name
-            if opts.max_samples_per_file == 0 or total_samples <= opts.max_samples_per_file:
-                # single file
-                outfile = os.path.join(in_dir_name, '{}.{}'.format(out_name, opts.output_format))
-            else:
-                # multiple files
-                outfile = os.path.join(in_dir_name, '{}.{:04d}.{}'.format(out_name, file_nr, opts.output_format))
-
-            if opts.output_format == HTML:
-                fig.write_html(outfile)
-            elif opts.output_format == JPEG:
-                fig.write_image(outfile)
-            else:
-                bug('Unsupported output format [{}]'.format(opts.output_format))
-
-            # reset stuff
-            file_nr = file_nr + 1
-            need_new_file = True
-            added_samples = 0
-            timestamps = None
-            data = None
-            y = None
+
+def do_plotly(in_dir_name, out_name, store):
+    names, _col_names, values = select_series(opts, store)
+
+    ranges = output_ranges(len(store))
+    for file_nr, (start, stop) in enumerate(ranges, 1):
+        # instead of real timestamp, use sample index; with timestamps the graph looks messy
+        x = np.arange(start, stop)
+        if opts.heatmap:
+            fig = heatmap_figure(x, names, values[start:stop], opts.fig_title, opts.target_points)
+        else:
+            fig = line_figure(x, [(name, values[start:stop, idx]) for idx, name in enumerate(names)],
+                              opts.fig_title, opts.target_points)
+
+        outfile = output_fname(in_dir_name, out_name, file_nr, len(ranges), opts.output_format)
+        if opts.output_format == HTML:
+            fig.write_html(outfile)
+        elif opts.output_format == JPEG:
+            fig.write_image(outfile)
+        else:
+            bug('Unsupported output format [{}]'.format(opts.output_format))
 
 
 if __name__ == '__main__':
@@ -243,17 +235,29 @@ if __name__ == '__main__':
     parser.add_argument('--infile', required=True)
     parser.add_argument('-o', '--outfile-prefix', required=False)
     parser.add_argument('--cpu', type=str, default='all')
-    parser.add_argument('--metric', choices=('cpu_usage', 'iowait'), default='cpu_usage')
+    parser.add_argument('--metric', choices=METRICS, default=CPU_USAGE)
+    parser.add_argument('--numa-map',
+                        help='average the CPUs of each NUMA node (needs --cpu each): a sysfs node directory, like '
+                             '/sys/devices/system/node, or a file with a "<node> <cpulist>" line per node')
+    parser.add_argument('--heatmap', action='store_true',
+                        help='plot a time x CPU (or node) heatmap instead of a line per CPU; '
+                             'with --target-points, every cell is the max of its bucket of samples')
     parser.add_argument('--max-samples-per-file', type=int, default=0)
     parser.add_argument('--fig-title')
+    parser.add_argument('--target-points', type=int, default=0,
+                        help='decimate every line to this many points (LTTB, keeps the peaks), default is to plot all samples')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or write the parsed samples cache')
     parser.add_argument('-f', '--output-format', choices=(HTML, JPEG, CSV), default=HTML)
 
     opts = parser.parse_args()
 
     validate_opts(opts)
 
-    samples = parse_mpstat(opts)
-    if samples:
+    # all the columns of all the CPUs are parsed, so the cache does not depend on the options
+    store = cached_parse(opts.infile, 'plot_mpstat', PARSER_VERSION, {},
+                         lambda: parse_mpstat(opts), SampleStore.to_arrays, SampleStore.from_arrays,
+                         enabled=not opts.no_cache)
+    if store:
         in_proper_name = os.path.realpath(opts.infile)
         in_dir_name = os.path.dirname(in_proper_name)
         in_base_name = os.path.basename(in_proper_name)
@@ -263,8 +267,8 @@ if __name__ == '__main__':
             out_name = in_base_name
 
         if opts.output_format in (HTML, JPEG):
-            do_plotly(in_dir_name, out_name, samples)
+            do_plotly(in_dir_name, out_name, store)
         elif opts.output_format == CSV:
-            do_csv(in_dir_name, out_name, samples)
+            do_csv(in_dir_name, out_name, store)
         else:
             bug('Invalid output format {}'.format(opts.output_format))
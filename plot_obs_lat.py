@@ -3,11 +3,13 @@
 from __future__ import print_function
 
 import argparse
-import re
 import sys
 import os
 import csv
-import plotly.express as px
+import numpy as np
+
+from plot_lines import line_figure
+from zstat_parser import parse_zstat_files, counter_column, format_value, TOTAL_COUNT, TOTAL_MB, AVG_MS
 
 
 def bug(msg):
@@ -15,15 +17,17 @@ def bug(msg):
     assert False
 
 
-# Aug  8 16:55:15.632378 [30033] [oba  ] : ZSTAT-GROUP____________________ actv max-actv total-count total-mb__ avg-ms____ max-ms_____
-NEW_SAMPLE_RE = re.compile(r'^(\S+\s+\d+\s+\d{2}:\d{2}:\d{2}).+ZSTAT-GROUP____________________')
-
 # Aug  8 16:55:17.674978 [30033] [oba  ] : src-datamover:PUT:curl            56       64         210        420    284.804         406
-PUT_RE = re.compile(r'^(\S+\s+\d+\s+\d{2}:\d{2}:\d{2}).+src-datamover:PUT:curl\s+\d+\s+\d+\s+(\d+)\s+(\d+)\s+(\d+\.\d+)')
+PUT_ROW = 'src-datamover:PUT:curl'
 PUT_IOPS = 'put_iops'
 PUT_MBPS = 'put_mbps'
 PUT_LAT = 'put_lat'
 
+# (ZSTAT-GROUP row, counter) of every metric
+METRIC_SOURCES = {PUT_IOPS: (PUT_ROW, TOTAL_COUNT),
+                  PUT_MBPS: (PUT_ROW, TOTAL_MB),
+                  PUT_LAT: (PUT_ROW, AVG_MS)}
+
 ALL_METRICS = (PUT_IOPS, PUT_MBPS, PUT_LAT)
 
 HTML = 'html'
@@ -43,70 +47,20 @@ def validate_opts(opts):
 
 
 def parse_obs(opts):
-    samples = []
-    curr_sample = None
-
-    with open(opts.infile, 'r') as fin:
-        for line in fin:
-            m = NEW_SAMPLE_RE.match(line)
-            if m is not None:
-                # Finalize the current sample, if any
-                if curr_sample is not None:
-                    for metric in ALL_METRICS:
-                        assert metric in curr_sample
-                # we need to create a new sample
-                if opts.max_samples > 0 and len(samples) >= opts.max_samples:
-                    print('Terminating parsing due to max_samples')
-                    break
-
-                timestamp = m.group(1)
-                curr_sample = {'timestamp': timestamp}
-                samples.append(curr_sample)
-                continue
-
-            m = PUT_RE.match(line)
-            if m is not None:
-                assert curr_sample is not None
-                assert PUT_IOPS not in curr_sample
-                curr_sample[PUT_IOPS] = int(m.group(2))
-                assert PUT_MBPS not in curr_sample
-                curr_sample[PUT_MBPS] = int(m.group(3))
-                assert PUT_LAT not in curr_sample
-                curr_sample[PUT_LAT] = float(m.group(4))
-                continue
-
-    if curr_sample is not None:
-        for metric in ALL_METRICS:
-            assert metric in curr_sample
-
-    print('Total {} samples collected'.format(len(samples)))
-
-    return samples
-
-
-def do_plotly(opts, in_dir_name, out_name, samples):
-    # Prepare an input for plotly: produce a column for the X-axis (timestamp) and a column for each metric
-    timestamps = []
-    data = {'timestamp': timestamps}
-    y = []
-    for metric in opts.metrics:
-        data[metric] = []
-        y.append(metric)
-
-    sample_idx = 0
-    for sample in samples:
-        # instead of real timestamp, append sample index; with timestamps the graph looks messy
-        timestamps.append(sample_idx)
-        sample_idx += 1
-
-        for metric in opts.metrics:
-            val = sample[metric]
-            data[metric].append(val)
+    return parse_zstat_files(opts.infile, rows=[PUT_ROW], max_samples=opts.max_samples,
+                             jobs=opts.jobs, use_cache=not opts.no_cache)
+
 
+def metric_column(store, metric):
+    return counter_column(store, *METRIC_SOURCES[metric])
+
+
+def do_plotly(opts, in_dir_name, out_name, store):
     print('Producing {} plot for metrics [{}]...'.format(opts.output_format, ', '.join(opts.metrics)))
 
-    fig = px.line(data, x='timestamp', y=y,
-                  title='OBS stats' if opts.fig_title is None else '{}'.format(opts.fig_title))
+    # instead of real timestamp, use sample index; with timestamps the graph looks messy
+    fig = line_figure(np.arange(len(store)), [(metric, metric_column(store, metric)) for metric in opts.metrics],
+                      'OBS stats' if opts.fig_title is None else '{}'.format(opts.fig_title), opts.target_points)
 
     outfile = os.path.join(in_dir_name, '{}_stats.{}'.format(out_name, opts.output_format))
     if opts.output_format == HTML:
@@ -117,38 +71,40 @@ def do_plotly(opts, in_dir_name, out_name, samples):
         bug('Unsupported output format [{}]'.format(opts.output_format))
 
 
-def do_csv(opts, in_dir_name, out_name, samples):
+def do_csv(opts, in_dir_name, out_name, store):
     outfile = os.path.join(in_dir_name, '{}.{}'.format(out_name, 'csv'))
+    metrics = list(opts.metrics)
+    counters = [METRIC_SOURCES[metric][1] for metric in metrics]
+    columns = [metric_column(store, metric).tolist() for metric in metrics]
     with open(outfile, 'w') as outf:
         csv_writer = csv.writer(outf)
-
-        header_row = ['timestamp']
-        for metric in opts.metrics:
-            header_row.append(metric)
-        csv_writer.writerow(header_row)
-
-        for sample in samples:
-            row = [sample['timestamp']]
-            for metric in opts.metrics:
-                row.append(sample[metric])
-            csv_writer.writerow(row)
+        csv_writer.writerow(['timestamp'] + metrics)
+        for timestamp, values in zip(store.labels, zip(*columns)):
+            csv_writer.writerow([timestamp] + [format_value(counter, value) for counter, value in zip(counters, values)])
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='')
-    parser.add_argument('--infile', required=True)
+    parser.add_argument('--infile', required=True, nargs='+',
+                        help='a log, or a log with its rotations (in any order), which are merged by time')
     parser.add_argument('-o', '--outfile-prefix', required=False)
     parser.add_argument('--metrics', default=PUT_LAT)
-    parser.add_argument('--max-samples', type=int, default=0)
+    parser.add_argument('--max-samples', type=int, default=0,
+                        help='the first time, a log is parsed in full into the cache anyway, unless --no-cache')
     parser.add_argument('--fig-title')
+    parser.add_argument('--target-points', type=int, default=0,
+                        help='decimate every line to this many points (LTTB, keeps the peaks), default is to plot all samples')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or write the parsed samples cache')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='number of parsing processes, default is the number of CPUs')
     parser.add_argument('-f', '--output-format', choices=(HTML, JPEG, CSV), default=HTML)
 
     opts = parser.parse_args()
     validate_opts(opts)
 
-    samples = parse_obs(opts)
+    store = parse_obs(opts)
 
-    in_proper_name = os.path.realpath(opts.infile)
+    # the output goes next to the first input file
+    in_proper_name = os.path.realpath(opts.infile[0])
     in_dir_name = os.path.dirname(in_proper_name)
     in_base_name = os.path.basename(in_proper_name)
     if opts.outfile_prefix is not None:
@@ -157,8 +113,8 @@ if __name__ == '__main__':
         out_name = in_base_name
 
     if opts.output_format in (HTML, JPEG):
-        do_plotly(opts, in_dir_name, out_name, samples)
+        do_plotly(opts, in_dir_name, out_name, store)
     elif opts.output_format == CSV:
-        do_csv(opts, in_dir_name, out_name, samples)
+        do_csv(opts, in_dir_name, out_name, store)
     else:
         bug('Invalid output format {}'.format(opts.output_format))
@@ -7,7 +7,12 @@ import re
 import sys
 import os
 import csv
-import plotly.express as px
+import numpy as np
+
+from sample_store import SampleStore
+from parse_cache import cached_parse
+from log_open import open_log
+from plot_lines import line_figure
 
 
 def bug(msg):
@@ -24,6 +29,11 @@ TOP_MEM_LINE = re.compile(r'^KiB\s+Mem\s+:\s+\d+\s+total,\s+(\d+)\s+free,\s+(\d+
 # 22300 root      20   0 22.788g 0.018t  38128 S 838.8 39.3 115:37.44 zadara_osm
 TOP_CPU_FOR_CMD_LINE = re.compile(r'^\s*\d+\s+\w+\s+\d+\s+\d+\s+[\w\.]+\s+[\w\.]+\s+\d+\s+\w+\s+([0-9\.]+)\s+[0-9\.]+\s+[0-9\.\:]+\s+(\w+)')
 
+#   PID USER      PR  NI    VIRT    RES    SHR S  %CPU %MEM     TIME+ COMMAND
+# The process table follows this line, up to the next frame
+TOP_TABLE_START = re.compile(r'^\s+PID\s+USER\s')
+TOP_START_PREFIX = 'top'
+
 CPU_PER_CMD = 'cpu_per_cmd'
 
 MEM_FREE = 'mem_free'
@@ -33,6 +43,12 @@ MEM_METRICS = (MEM_FREE, MEM_USED, MEM_BUFF_CACHE)
 
 ALL_METRICS = (CPU_PER_CMD, MEM_FREE, MEM_USED, MEM_BUFF_CACHE)
 
+# The sample store has a column per memory metric and per command
+VALUE = 'value'
+
+# Bump when the parsing changes, to invalidate cached samples
+PARSER_VERSION = 2
+
 HTML = 'html'
 JPEG = 'jpeg'
 CSV = 'csv'
@@ -52,85 +68,99 @@ def validate_opts(opts):
     for metric in metrics:
         if metric not in ALL_METRICS:
             bug('Unknown metric: {}'.format(metric))
+    for cmd in opts.commands:
+        if cmd in MEM_METRICS:
+            bug('Command name {} clashes with a memory metric'.format(cmd))
     opts.metrics = metrics
 
 
+def add_cmd_cpu(line, cmd_idx, cpu_per_cmd):
+    # adds the CPU % of a process line to its command, if the command is in cmd_idx;
+    # returns False if this is not a process line
+    m = TOP_CPU_FOR_CMD_LINE.match(line)
+    if m is None:
+        return False
+    command = m.group(2)
+    if command in cmd_idx:
+        cpu_per_cmd[command] = cpu_per_cmd.get(command, 0.0) + float(m.group(1))
+    return True
+
+
 def parse_top(opts):
     print('Parsing top...')
 
-    samples = []
-    curr_sample = None
+    # memory in KB and CPU % of every command, NaN if a command did not run in a sample
+    store = SampleStore(list(MEM_METRICS) + list(opts.commands), (VALUE,), dtype=np.float64)
+    mem_idx = [store.entity_idx[mem_metric] for mem_metric in MEM_METRICS]
+    cmd_idx = {cmd: store.entity_idx[cmd] for cmd in opts.commands}
+    cmd_prefixes = tuple(opts.commands)
+
+    sample_idx = None
+    # CPU % per command of the current sample, summed over its processes
+    cpu_per_cmd = {}
+    mem_seen = False
+    in_table = False
 
-    with open(opts.infile, 'r') as fin:
+    with open_log(opts.infile) as fin:
         for line in fin:
+            if in_table:
+                # most of the lines are processes; without commands to look for, the only
+                # interesting line is the start of the next frame, otherwise only the lines
+                # which end with one of the commands are worth a regex match
+                if not line.startswith(TOP_START_PREFIX):
+                    if cmd_idx and line.rstrip().rpartition(' ')[2].startswith(cmd_prefixes):
+                        add_cmd_cpu(line, cmd_idx, cpu_per_cmd)
+                    continue
+                in_table = False
+
             m = TOP_START.match(line)
             if m is not None:
-                if opts.max_samples > 0 and len(samples) >= opts.max_samples:
+                if sample_idx is not None:
+                    for command, cpu_pc in cpu_per_cmd.items():
+                        store.set_values(sample_idx, cmd_idx[command], cpu_pc)
+                    cpu_per_cmd = {}
+                if opts.max_samples > 0 and len(store) >= opts.max_samples:
                     print('Terminating parsing due to max_samples')
                     break
-                curr_sample = {'timestamp': m.group(1), 'cpu_per_cmd': {}}
-                samples.append(curr_sample)
+                sample_idx = store.new_sample(m.group(1))
+                mem_seen = False
                 continue
 
             m = TOP_MEM_LINE.match(line)
             if m is not None:
-                assert curr_sample is not None
-                curr_sample[MEM_FREE] = int(m.group(1))
-                curr_sample[MEM_USED] = int(m.group(2))
-                curr_sample[MEM_BUFF_CACHE] = int(m.group(3))
+                assert sample_idx is not None
+                for idx, group in zip(mem_idx, (1, 2, 3)):
+                    store.set_values(sample_idx, idx, int(m.group(group)))
+                mem_seen = True
                 continue
 
-            m = TOP_CPU_FOR_CMD_LINE.match(line)
-            if m is not None:
-                assert curr_sample is not None
-                command = m.group(2)
-                if command not in opts.commands:
-                    continue
-                cpu_pc = float(m.group(1))
-                cpu_per_cmd = curr_sample['cpu_per_cmd']
-                if cpu_per_cmd.get(command) is not None:
-                    cpu_per_cmd[command] = cpu_per_cmd[command] + cpu_pc
-                else:
-                    cpu_per_cmd[command] = cpu_pc
-
-    # Check whether the last sample has the 'mem' entries; it could be that top output was cut off
-    if samples:
-        last_sample = samples[-1]
-        if last_sample.get(MEM_FREE) is None:
-            del samples[-1]
+            if TOP_TABLE_START.match(line):
+                assert sample_idx is not None
+                in_table = True
+                continue
 
-    print('Total {} samples collected'.format(len(samples)))
+            # process lines of a capture without the table header
+            if cmd_idx and add_cmd_cpu(line, cmd_idx, cpu_per_cmd):
+                assert sample_idx is not None
 
-    return samples
+    if sample_idx is not None:
+        for command, cpu_pc in cpu_per_cmd.items():
+            store.set_values(sample_idx, cmd_idx[command], cpu_pc)
 
+    # Check whether the last sample has the 'mem' entries; it could be that top output was cut off
+    if len(store) > 0 and not mem_seen:
+        store.truncate(0, len(store) - 1)
 
-def do_plotly(opts, in_dir_name, out_name, samples):
-    # MEM-metrics #########################################
-    # Prepare an input for plotly: produce a column for the X-axis (timestamp) and a column for each MEM-metric
-    timestamps = []
-    data = {'timestamp': timestamps}
-    y = []
-    mem_metrics = set(MEM_METRICS) & opts.metrics
-    for mem_metric in mem_metrics:
-        data[mem_metric] = []
-        y.append(mem_metric)
+    print('Total {} samples collected'.format(len(store)))
 
-    sample_idx = 0
-    for sample in samples:
-        # instead of real timestamp, append sample index; with timestamps the graph looks messy
-        timestamps.append(sample_idx)
-        sample_idx += 1
+    return store
 
-        for mem_metric in mem_metrics:
-            val = sample[mem_metric] / 1024
-            data[mem_metric].append(val)
 
-    print('Producing {} plot for metrics [{}]...'.format(opts.output_format, ', '.join(mem_metrics)))
+def mem_mb(store, mem_metric):
+    return store.column(mem_metric, VALUE) / 1024
 
-    fig = px.line(data, x='timestamp', y=y,
-                  title='Memory (MB)' if opts.fig_title is None else '{}, memory (MB)'.format(opts.fig_title))
 
-    outfile = os.path.join(in_dir_name, '{}_{}.{}'.format(out_name, 'mem', opts.output_format))
+def write_fig(opts, fig, outfile):
     if opts.output_format == HTML:
         fig.write_html(outfile)
     elif opts.output_format == JPEG:
@@ -138,42 +168,53 @@ def do_plotly(opts, in_dir_name, out_name, samples):
     else:
         bug('Unsupported output format [{}]'.format(opts.output_format))
 
+
+def do_plotly(opts, in_dir_name, out_name, store):
+    # instead of real timestamp, use sample index; with timestamps the graph looks messy
+    x = np.arange(len(store))
+
+    # MEM-metrics #########################################
+    mem_metrics = set(MEM_METRICS) & opts.metrics
+    if mem_metrics:
+        print('Producing {} plot for metrics [{}]...'.format(opts.output_format, ', '.join(mem_metrics)))
+
+        fig = line_figure(x, [(mem_metric, mem_mb(store, mem_metric)) for mem_metric in mem_metrics],
+                          'Memory (MB)' if opts.fig_title is None else '{}, memory (MB)'.format(opts.fig_title),
+                          opts.target_points)
+        write_fig(opts, fig, os.path.join(in_dir_name, '{}_{}.{}'.format(out_name, 'mem', opts.output_format)))
+
     # CPU-metrics #########################################
     if CPU_PER_CMD in opts.metrics:
-        bug('CPU metrics plotting is not implemented yet')
+        print('Producing {} plot for commands [{}]...'.format(opts.output_format, ', '.join(opts.commands)))
+
+        # a gap where a command did not run
+        fig = line_figure(x, [(cmd, store.column(cmd, VALUE)) for cmd in opts.commands],
+                          'CPU (%)' if opts.fig_title is None else '{}, CPU (%)'.format(opts.fig_title),
+                          opts.target_points)
+        write_fig(opts, fig, os.path.join(in_dir_name, '{}_{}.{}'.format(out_name, 'cpu', opts.output_format)))
+
+
+def do_csv(opts, in_dir_name, out_name, store):
+    header_row = ['timestamp']
+    columns = []
+    for metric in opts.metrics:
+        if metric == CPU_PER_CMD:
+            for cmd in opts.commands:
+                header_row.append(cmd)
+                columns.append(store.column(cmd, VALUE).tolist())
+        elif metric in MEM_METRICS:
+            header_row.append('{} (mb)'.format(metric))
+            columns.append(mem_mb(store, metric).tolist())
+        else:
+            bug('Unknown metric {}'.format(metric))
 
-
-def do_csv(opts, in_dir_name, out_name, samples):
     outfile = os.path.join(in_dir_name, '{}.{}'.format(out_name, 'csv'))
     with open(outfile, 'w') as outf:
         csv_writer = csv.writer(outf)
-
-        header_row = ['timestamp']
-        for metric in opts.metrics:
-            if metric == CPU_PER_CMD:
-                for cmd in opts.commands:
-                    header_row.append(cmd)
-            elif metric in MEM_METRICS:
-                header_row.append('{} (mb)'.format(metric))
-            else:
-                bug('Unknown metric {}'.format(metric))
         csv_writer.writerow(header_row)
-
-        for sample in samples:
-            row = [sample['timestamp']]
-            for metric in opts.metrics:
-                if metric == CPU_PER_CMD:
-                    for cmd in opts.commands:
-                        val = sample['cpu_per_cmd'].get(cmd)
-                        if val is not None:
-                            row.append('{:.2f}'.format(val))
-                        else:
-                            row.append('-')
-                elif metric in MEM_METRICS:
-                    row.append('{:.2f}'.format(sample[metric] / 1024))
-                else:
-                    bug('Unknown metric {}'.format(metric))
-            csv_writer.writerow(row)
+        for timestamp, values in zip(store.labels, zip(*columns)):
+            # a command which did not run in a sample is '-'
+            csv_writer.writerow([timestamp] + ['-' if val != val else '{:.2f}'.format(val) for val in values])
 
 
 if __name__ == '__main__':
@@ -184,12 +225,18 @@ if __name__ == '__main__':
     parser.add_argument('--commands', nargs='+')
     parser.add_argument('--max-samples', type=int, default=0)
     parser.add_argument('--fig-title')
+    parser.add_argument('--target-points', type=int, default=0,
+                        help='decimate every line to this many points (LTTB, keeps the peaks), default is to plot all samples')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or write the parsed samples cache')
     parser.add_argument('-f', '--output-format', choices=(HTML, JPEG, CSV), default=HTML)
 
     opts = parser.parse_args()
     validate_opts(opts)
 
-    samples = parse_top(opts)
+    store = cached_parse(opts.infile, 'plot_top', PARSER_VERSION,
+                         {'commands': list(opts.commands), 'max_samples': opts.max_samples},
+                         lambda: parse_top(opts), SampleStore.to_arrays, SampleStore.from_arrays,
+                         enabled=not opts.no_cache)
 
     in_proper_name = os.path.realpath(opts.infile)
     in_dir_name = os.path.dirname(in_proper_name)
@@ -200,8 +247,8 @@ if __name__ == '__main__':
         out_name = in_base_name
 
     if opts.output_format in (HTML, JPEG):
-        do_plotly(opts, in_dir_name, out_name, samples)
+        do_plotly(opts, in_dir_name, out_name, store)
     elif opts.output_format == CSV:
-        do_csv(opts, in_dir_name, out_name, samples)
+        do_csv(opts, in_dir_name, out_name, store)
     else:
         bug('Invalid output format {}'.format(opts.output_format))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import os
+import csv
+import numpy as np
+
+from plot_lines import line_figure
+from zstat_parser import parse_zstat_files, rows_matcher, format_value, COUNTERS, AVG_MS
+
+
+# Plots (or writes to CSV) any counters of any rows of the zadara_osm ZSTAT-GROUP tables:
+#   plot_zstat.py --infile zadara_osm.log* --rows 'io_mgr_put_*,src-datamover:PUT:*' --counters total-count,avg-ms
+
+HTML = 'html'
+JPEG = 'jpeg'
+CSV = 'csv'
+
+
+def bug(msg):
+    print('ERROR: {}'.format(msg), file=sys.stderr)
+    assert False
+
+
+def validate_opts(opts):
+    opts.rows = [glob for glob in opts.rows.split(',') if glob]
+    if not opts.rows:
+        bug('No rows specified')
+
+    opts.counters = [counter for counter in opts.counters.split(',') if counter]
+    if not opts.counters:
+        bug('No counters specified')
+    for counter in opts.counters:
+        if counter not in COUNTERS:
+            bug('Unknown counter: {}, known counters: {}'.format(counter, ', '.join(COUNTERS)))
+
+
+def select_series(opts, store):
+    # (series name, counter, values) for every requested counter of every matching row
+    row_wanted = rows_matcher(opts.rows)
+    rows = [row for row in store.entities if row_wanted(row)]
+    if not rows:
+        bug('No rows match {}, the log has: {}'.format(','.join(opts.rows), ', '.join(store.entities)))
+
+    series = []
+    for row in rows:
+        for counter in opts.counters:
+            series.append(('{} {}'.format(row, counter), counter, store.column(row, counter)))
+    return series
+
+
+def do_plotly(opts, in_dir_name, out_name, store, series):
+    print('Producing {} plot for [{}]...'.format(opts.output_format, ', '.join(name for name, _, _ in series)))
+
+    # instead of real timestamp, use sample index; with timestamps the graph looks messy
+    fig = line_figure(np.arange(len(store)), [(name, values) for name, _, values in series],
+                      'ZSTAT' if opts.fig_title is None else opts.fig_title, opts.target_points)
+
+    outfile = os.path.join(in_dir_name, '{}_zstat.{}'.format(out_name, opts.output_format))
+    if opts.output_format == HTML:
+        fig.write_html(outfile)
+    elif opts.output_format == JPEG:
+        fig.write_image(outfile)
+    else:
+        bug('Unsupported output format [{}]'.format(opts.output_format))
+
+
+def do_csv(opts, in_dir_name, out_name, store, series):
+    outfile = os.path.join(in_dir_name, '{}.{}'.format(out_name, 'csv'))
+    counters = [counter for _, counter, _ in series]
+    with open(outfile, 'w') as outf:
+        csv_writer = csv.writer(outf)
+        csv_writer.writerow(['timestamp'] + [name for name, _, _ in series])
+        for timestamp, values in zip(store.labels, zip(*[values.tolist() for _, _, values in series])):
+            csv_writer.writerow([timestamp] + [format_value(counter, value) for counter, value in zip(counters, values)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plot counters of the ZSTAT-GROUP tables of zadara_osm logs')
+    parser.add_argument('--infile', required=True, nargs='+',
+                        help='a log, or a log with its rotations (in any order), which are merged by time')
+    parser.add_argument('-o', '--outfile-prefix', required=False)
+    parser.add_argument('--rows', default='*', help='comma-separated shell-style globs of the row names')
+    parser.add_argument('--counters', default=AVG_MS, help='comma-separated, out of: {}'.format(', '.join(COUNTERS)))
+    parser.add_argument('--max-samples', type=int, default=0,
+                        help='the first time, a log is parsed in full into the cache anyway, unless --no-cache')
+    parser.add_argument('--fig-title')
+    parser.add_argument('--target-points', type=int, default=0,
+                        help='decimate every line to this many points (LTTB, keeps the peaks), default is to plot all samples')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or write the parsed samples cache')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='number of parsing processes, default is the number of CPUs')
+    parser.add_argument('-f', '--output-format', choices=(HTML, JPEG, CSV), default=HTML)
+
+    opts = parser.parse_args()
+    validate_opts(opts)
+
+    # all the rows are parsed, so the cache does not depend on the selection
+    store = parse_zstat_files(opts.infile, max_samples=opts.max_samples, jobs=opts.jobs, use_cache=not opts.no_cache)
+
+    # the output goes next to the first input file
+    in_proper_name = os.path.realpath(opts.infile[0])
+    in_dir_name = os.path.dirname(in_proper_name)
+    in_base_name = os.path.basename(in_proper_name)
+    if opts.outfile_prefix is not None:
+        out_name = opts.outfile_prefix
+    else:
+        out_name = in_base_name
+
+    series = select_series(opts, store)
+
+    if opts.output_format in (HTML, JPEG):
+        do_plotly(opts, in_dir_name, out_name, store, series)
+    elif opts.output_format == CSV:
+        do_csv(opts, in_dir_name, out_name, store, series)
+    else:
+        bug('Invalid output format {}'.format(opts.output_format))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+# Minimal number of samples the store grows by when it runs out of room
+CHUNK_SAMPLES = 1024
+# Minimal number of entities the store grows by, when entities are added as they show up
+CHUNK_ENTITIES = 16
+
+
+class SampleStore(object):
+    """Columnar store for interval samples.
+
+    Keeps one timestamp label per sample and a (sample, entity, metric) block of values,
+    where entity is a block device, a CPU, a row name etc. Values not reported for a sample are NaN.
+    The block has room for more samples and entities than there are; the spare entities are NaN.
+    """
+
+    def __init__(self, entities, metrics, dtype=np.float32):
+        self.entities = list(entities)
+        self.metrics = list(metrics)
+        self.entity_idx = {entity: idx for idx, entity in enumerate(self.entities)}
+        self.metric_idx = {metric: idx for idx, metric in enumerate(self.metrics)}
+        self.labels = []
+        self._values = np.empty((CHUNK_SAMPLES, len(self.entities), len(self.metrics)), dtype=dtype)
+
+    def _resize(self, nr_samples):
+        # Resize in place when possible: realloc of a large block does not copy the data,
+        # so the peak memory stays close to the size of the store
+        try:
+            self._values.resize((nr_samples,) + self._values.shape[1:])
+        except ValueError:
+            # a view of the values is still referenced, have to copy
+            resized = np.empty((nr_samples,) + self._values.shape[1:], dtype=self._values.dtype)
+            nr_copy = min(nr_samples, self._values.shape[0])
+            resized[:nr_copy] = self._values[:nr_copy]
+            self._values = resized
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def dtype(self):
+        return self._values.dtype
+
+    @property
+    def values(self):
+        # (sample, entity, metric) view of the filled part
+        return self._values[:len(self.labels), :len(self.entities)]
+
+    def new_sample(self, label):
+        # start a new sample and return its index
+        idx = len(self.labels)
+        if idx == self._values.shape[0]:
+            self._resize(idx + max(idx // 4, CHUNK_SAMPLES))
+        self._values[idx] = np.nan
+        self.labels.append(label)
+        return idx
+
+    def add_entity(self, entity):
+        # add an entity not known when the store was created and return its index; its past samples are NaN
+        idx = len(self.entities)
+        if idx == self._values.shape[1]:
+            # grow by a chunk, rather than copying all the samples for every new entity
+            values = np.empty((self._values.shape[0], idx + max(idx // 4, CHUNK_ENTITIES), len(self.metrics)),
+                              dtype=self._values.dtype)
+            values[:, :idx] = self._values
+            values[:, idx:] = np.nan
+            self._values = values
+        self.entities.append(entity)
+        self.entity_idx[entity] = idx
+        return idx
+
+    def set_values(self, sample_idx, entity_idx, values):
+        # values: one value per metric, in self.metrics order
+        self._values[sample_idx, entity_idx] = values
+
+    def extend(self, other):
+        # append the samples of another store, which has the same entities and metrics
+        assert other.entities == self.entities and other.metrics == self.metrics
+        idx = len(self.labels)
+        nr_samples = idx + len(other)
+        if nr_samples > self._values.shape[0]:
+            self._resize(max(nr_samples, idx + max(idx // 4, CHUNK_SAMPLES)))
+        self._values[idx:nr_samples, :len(self.entities)] = other.values
+        self._values[idx:nr_samples, len(self.entities):] = np.nan
+        self.labels.extend(other.labels)
+
+    def column(self, entity, metric):
+        # all samples of a single (entity, metric) pair
+        return self._values[:len(self.labels), self.entity_idx[entity], self.metric_idx[metric]]
+
+    def select_entities(self, entities):
+        # a new store of the samples of only the given entities, in the given order
+        store = SampleStore(entities, self.metrics, dtype=self.dtype)
+        store._values = self.values[:, [self.entity_idx[entity] for entity in store.entities]]
+        store.labels = list(self.labels)
+        return store
+
+    def truncate(self, start, stop):
+        # keep only samples [start, stop), releasing the memory of the rest
+        start = max(0, start)
+        stop = max(start, min(len(self.labels), stop))
+        nr_samples = stop - start
+        if start > 0:
+            # move the samples down in chunks that do not overlap, to avoid a temporary copy of all of them
+            for dst in range(0, nr_samples, start):
+                nr_move = min(start, nr_samples - dst)
+                self._values[dst:dst + nr_move] = self._values[start + dst:start + dst + nr_move]
+        self._resize(max(nr_samples, 1))
+        if self._values.shape[1] > len(self.entities):
+            # drop the spare entities as well, like the spare samples; add_entity() grows the room again
+            self._values = self._values[:, :len(self.entities)].copy()
+        self.labels = self.labels[start:stop]
+
+    def to_arrays(self):
+        return {'labels': np.array(self.labels, dtype=str), 'values': self.values,
+                'entities': np.array(self.entities, dtype=str), 'metrics': np.array(self.metrics, dtype=str)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        values = arrays['values']
+        store = cls(arrays['entities'].tolist(), arrays['metrics'].tolist(), dtype=values.dtype)
+        store.labels = arrays['labels'].tolist()
+        store._values = values
+        return store
+
+
+def merge_sorted(stores, keys):
+    # Merges stores of the same metrics into a single one, ordered by keys (one int64 per sample of every store,
+    # usually a timestamp). Samples of equal keys are the same sample, like in the overlap of two rotated logs,
+    # and are merged into one: the values of the later store, in the order of the stores, and where it has
+    # none (NaN), those of the earlier ones.
+    metrics = stores[0].metrics
+    entities = []
+    for store in stores:
+        assert store.metrics == metrics
+        entities.extend(entity for entity in store.entities if entity not in entities)
+
+    nr_samples = sum(len(store) for store in stores)
+    values = np.full((nr_samples, len(entities), len(metrics)), np.nan, dtype=stores[0].dtype)
+    entity_idx = {entity: idx for idx, entity in enumerate(entities)}
+    labels = []
+    pos = 0
+    for store in stores:
+        values[pos:pos + len(store), [entity_idx[entity] for entity in store.entities]] = store.values
+        labels.extend(store.labels)
+        pos += len(store)
+
+    all_keys = np.concatenate([np.asarray(store_keys, dtype=np.int64) for store_keys in keys])
+    order = np.argsort(all_keys, kind='stable')
+    all_keys = all_keys[order]
+    values = values[order]
+
+    # the last sample of every key is kept, with the values of the samples of the key before it filled in
+    keep = np.ones(nr_samples, dtype=bool)
+    if nr_samples > 1:
+        keep[:-1] = all_keys[1:] != all_keys[:-1]
+        for idx in (np.nonzero(~keep[:-1])[0] + 1).tolist():
+            missing = np.isnan(values[idx])
+            values[idx][missing] = values[idx - 1][missing]
+
+    merged = SampleStore(entities, metrics, dtype=values.dtype)
+    merged._values = values[keep]
+    merged.labels = [labels[idx] for idx in order[keep].tolist()]
+    return merged
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+
+import pytest
+
+import fio_loop
+
+
+def compare_opts(threshold_pct=5.0, noise_sigmas=2.0):
+    return argparse.Namespace(threshold_pct=threshold_pct, noise_sigmas=noise_sigmas)
+
+
+def run_opts():
+    return argparse.Namespace(status_interval=0, io_pattern='randread', readpct=50, runtime=10, steady_state=None,
+                              collectors=[], collect_interval=1)
+
+
+def test_mean_and_rel_var():
+    assert fio_loop.mean_and_rel_var([10.0]) == (10.0, 0.0)
+    mean, rel_var = fio_loop.mean_and_rel_var([9.0, 11.0])
+    # variance 2, of the mean 1
+    assert mean == 10.0
+    assert rel_var == pytest.approx(0.01)
+
+
+@pytest.mark.parametrize('base, cand, higher_is_better, regressed', [
+    ([100.0], [90.0], True, True),
+    ([100.0], [90.0], False, False),
+    ([100.0], [104.0], False, False),
+    ([100.0], [110.0], False, True),
+    # 10% worse, but within the noise of the runs
+    ([80.0, 120.0], [70.0, 110.0], True, False),
+])
+def test_compare_cell(base, cand, higher_is_better, regressed):
+    assert fio_loop.compare_cell(compare_opts(), base, cand, higher_is_better)[4] == regressed
+
+
+def test_compare_cell_noise_threshold():
+    _base, _cand, delta, threshold, _regressed = fio_loop.compare_cell(compare_opts(), [80.0, 120.0], [70.0, 110.0], True)
+    assert delta == pytest.approx(-10.0)
+    # variance of the means 400, 2 sigmas of sqrt(400 / 100^2 + 400 / 90^2)
+    assert threshold == pytest.approx(2 * (0.04 + 400.0 / 8100) ** 0.5 * 100)
+    assert fio_loop.compare_cell(compare_opts(), [0.0], [1.0], True)[2:] == (None, 5.0, False)
+
+
+def test_journal(tmp_path):
+    outdir = str(tmp_path)
+    assert fio_loop.read_journal(outdir) == {}
+    fio_loop.append_journal(outdir, {'cell': '4k_1', 'rc': 1})
+    fio_loop.append_journal(outdir, {'cell': '4k_8', 'rc': 0})
+    fio_loop.append_journal(outdir, {'cell': '4k_1', 'rc': 0})
+    # the last line of an interrupted run
+    with open(os.path.join(outdir, fio_loop.JOURNAL), 'a') as fout:
+        fout.write('{"cell": "4k_1", "r')
+    assert fio_loop.read_journal(outdir) == {'4k_1': {'cell': '4k_1', 'rc': 0}, '4k_8': {'cell': '4k_8', 'rc': 0}}
+
+
+@pytest.fixture
+def fio_runs(monkeypatch):
+    # instead of running fio, write its output file and record the command
+    runs = []
+
+    def run_cmd(cmd, on_stdout_line=None):
+        runs.append(cmd)
+        output = [arg for arg in cmd if arg.startswith('--output=')][0].partition('=')[2]
+        with open(output, 'w') as fout:
+            fout.write('{}')
+        return 0, [], []
+
+    monkeypatch.setattr(fio_loop, 'run_cmd', run_cmd)
+    return runs
+
+
+def test_resume(tmp_path, fio_runs, capsys):
+    outdir = str(tmp_path)
+    opts = run_opts()
+    fpath = fio_loop.run_cell(opts, ['/dev/sdb'], outdir, {}, '4k', 4096, 8)
+    assert fpath == os.path.join(outdir, '4k_8' + fio_loop.JSON_EXT)
+    assert len(fio_runs) == 1
+    journal = fio_loop.read_journal(outdir)
+    assert journal['4k_8']['rc'] == 0
+    assert journal['4k_8']['params'] == fio_loop.fio_params(fio_runs[0])
+
+    # done already
+    assert fio_loop.run_cell(opts, ['/dev/sdb'], outdir, journal, '4k', 4096, 8) == fpath
+    assert len(fio_runs) == 1
+    assert 'done already' in capsys.readouterr().out
+
+    # the output file is gone, the cell runs again
+    os.unlink(fpath)
+    fio_loop.run_cell(opts, ['/dev/sdb'], outdir, journal, '4k', 4096, 8)
+    assert len(fio_runs) == 2
+
+    # the journal has the cell of other parameters
+    opts.runtime = 20
+    with pytest.raises(SystemExit):
+        fio_loop.run_cell(opts, ['/dev/sdb'], outdir, fio_loop.read_journal(outdir), '4k', 4096, 8)
+    assert 'was run with different parameters' in capsys.readouterr().err
+
+
+def test_resume_failed_cell(tmp_path, fio_runs):
+    outdir = str(tmp_path)
+    fpath = os.path.join(outdir, '4k_8' + fio_loop.JSON_EXT)
+    with open(fpath, 'w') as fout:
+        fout.write('cut')
+    journal = {'4k_8': {'cell': '4k_8', 'rc': 1, 'params': []}}
+    fio_loop.run_cell(run_opts(), ['/dev/sdb'], outdir, journal, '4k', 4096, 8)
+    assert len(fio_runs) == 1
+    with open(fpath) as fin:
+        assert json.load(fin) == {}
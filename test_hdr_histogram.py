@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from hdr_histogram import HdrHistogram, merge_histograms, save_histograms, load_histograms
+
+
+def test_merge_is_recording_all():
+    rng = np.random.RandomState(0)
+    parts = [rng.lognormal(2, 1, size) for size in (1000, 1, 5000)]
+    merged = HdrHistogram()
+    for part in parts:
+        hist = HdrHistogram()
+        hist.record(part)
+        merged.merge(hist)
+    merged.merge(HdrHistogram())
+
+    everything = HdrHistogram()
+    everything.record(np.concatenate(parts))
+    np.testing.assert_array_equal(merged.counts, everything.counts)
+    assert merged.count == everything.count == 6001
+    assert merged.mean == pytest.approx(everything.mean)
+    assert merged.stddev() == pytest.approx(everything.stddev())
+    assert (merged.min, merged.max) == (everything.min, everything.max)
+
+
+@pytest.mark.parametrize('percentile', [1, 50, 90, 99, 99.9, 100])
+def test_percentile_within_error(percentile):
+    values = np.random.RandomState(1).lognormal(3, 1.5, 20000)
+    hist = HdrHistogram()
+    hist.record(values)
+    expected = np.percentile(values, percentile, method='inverted_cdf')
+    # 2 significant digits, and the values are rounded to the unit
+    assert hist.percentile(percentile) == pytest.approx(expected, rel=0.01, abs=hist.unit)
+
+
+def test_nan_and_empty():
+    hist = HdrHistogram()
+    hist.record([np.nan, np.nan])
+    assert hist.count == 0
+    assert np.isnan(hist.percentile(50))
+    hist.record([np.nan, 5.0])
+    assert hist.count == 1
+    assert hist.percentile(50) == 5.0
+
+
+def test_merge_and_save_sets(tmp_path):
+    first = {('sda', 'r_await'): HdrHistogram(), ('sda', 'w_await'): HdrHistogram()}
+    first[('sda', 'r_await')].record([1.0, 2.0])
+    first[('sda', 'w_await')].record([3.0])
+    second = {('sda', 'r_await'): HdrHistogram(), ('sdb', 'r_await'): HdrHistogram()}
+    second[('sda', 'r_await')].record([4.0])
+    second[('sdb', 'r_await')].record([5.0])
+    merge_histograms(first, second)
+    assert sorted(first) == [('sda', 'r_await'), ('sda', 'w_await'), ('sdb', 'r_await')]
+    assert first[('sda', 'r_await')].count == 3
+
+    fname = str(tmp_path / 'hist.npz')
+    save_histograms(fname, first)
+    loaded = load_histograms(fname)
+    assert sorted(loaded) == sorted(first)
+    for key, hist in first.items():
+        np.testing.assert_array_equal(loaded[key].counts, hist.counts)
+        assert (loaded[key].count, loaded[key].mean, loaded[key].max) == (hist.count, hist.mean, hist.max)
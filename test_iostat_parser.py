@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import numpy as np
+import pytest
+
+import fio_loop
+from iostat_parser import parse_iostat, IostatFormatError, ALL_METRICS
+
+
+# Two reports of "iostat -d -x -t", the first one is cut by the parser
+
+SYSSTAT_11 = '''Linux 4.15.0-20-generic (host) 	10/16/26 	_x86_64_	(8 CPU)
+
+10/16/26 11:02:03
+Device            r/s     w/s     rkB/s     wkB/s   rrqm/s   wrqm/s  %rrqm  %wrqm r_await w_await aqu-sz rareq-sz wareq-sz  svctm  %util
+dm-0             9.00    9.00     90.00     90.00     0.00     0.00   0.00   0.00    9.00    9.00   9.00     9.00     9.00   0.00  99.00
+sda              7.00    7.00     70.00     70.00     0.00     0.00   0.00   0.00    7.00    7.00   7.00     7.00     7.00   0.00  77.00
+
+10/16/26 11:02:04
+Device            r/s     w/s     rkB/s     wkB/s   rrqm/s   wrqm/s  %rrqm  %wrqm r_await w_await aqu-sz rareq-sz wareq-sz  svctm  %util
+dm-0             1.00   10.00      4.00   2048.00     0.00     0.00   0.00   0.00    0.50    2.00   0.02     4.00   204.80   0.00  55.00
+sda              7.00    7.00     70.00     70.00     0.00     0.00   0.00   0.00    7.00    7.00   7.00     7.00     7.00   0.00  77.00
+
+'''
+
+SYSSTAT_12 = '''Linux 5.15.0-91-generic (host) 	10/16/2026 	_x86_64_	(8 CPU)
+
+10/16/2026 11:02:03 AM
+Device            r/s     rkB/s   rrqm/s  %rrqm r_await rareq-sz     w/s     wkB/s   wrqm/s  %wrqm w_await wareq-sz     d/s     dkB/s   drqm/s  %drqm d_await dareq-sz     f/s f_await  aqu-sz  %util
+dm-0             9.00     90.00     0.00   0.00    9.00     9.00    9.00     90.00     0.00   0.00    9.00     9.00    0.00      0.00     0.00   0.00    0.00     0.00    0.00    0.00    9.00  99.00
+sda              7.00     70.00     0.00   0.00    7.00     7.00    7.00     70.00     0.00   0.00    7.00     7.00    0.00      0.00     0.00   0.00    0.00     0.00    0.00    0.00    7.00  77.00
+
+10/16/2026 11:02:04 AM
+Device            r/s     rkB/s   rrqm/s  %rrqm r_await rareq-sz     w/s     wkB/s   wrqm/s  %wrqm w_await wareq-sz     d/s     dkB/s   drqm/s  %drqm d_await dareq-sz     f/s f_await  aqu-sz  %util
+dm-0             1.00      4.00     0.00   0.00    0.50     4.00   10.00   2048.00     0.00   0.00    2.00   204.80    0.00      0.00     0.00   0.00    0.00     0.00    0.00    0.00    0.02  55.00
+sda              7.00     70.00     0.00   0.00    7.00     7.00    7.00     70.00     0.00   0.00    7.00     7.00    0.00      0.00     0.00   0.00    0.00     0.00    0.00    0.00    7.00  77.00
+
+'''
+
+UNKNOWN = '''10/16/26 11:02:03
+Device            tps    kB_read/s    kB_wrtn/s    kB_read    kB_wrtn
+dm-0             1.00         4.00        40.00          4         40
+
+'''
+
+# dm-0 in the second report, in the order of ALL_METRICS
+EXPECTED = (1.0, 10.0, 4.0 / 1024, 2.0, 0.5, 2.0, 0.02, 4.0, 204.8, 55.0)
+
+
+def write_log(tmp_path, text):
+    fpath = tmp_path / 'iostat.log'
+    fpath.write_text(text)
+    return str(fpath)
+
+
+def parse(fpath, blkdevs):
+    return parse_iostat(argparse.Namespace(infile=fpath, blkdevs=blkdevs, dont_cut_first_line=False, max_samples=0,
+                                           samples_from_end=False, jobs=1), dtype=np.float64, verbose=False)
+
+
+@pytest.mark.parametrize('text', [SYSSTAT_11, SYSSTAT_12], ids=['sysstat-11', 'sysstat-12'])
+def test_columns_by_header(tmp_path, text):
+    store = parse(write_log(tmp_path, text), ['dm-0'])
+    assert len(store) == 1
+    assert store.metrics == list(ALL_METRICS)
+    np.testing.assert_allclose(store.values[0, 0], EXPECTED)
+
+
+def test_unknown_header(tmp_path):
+    with pytest.raises(IostatFormatError):
+        parse(write_log(tmp_path, UNKNOWN), ['dm-0'])
+
+
+def test_fio_loop_summary(tmp_path, capsys):
+    summary = fio_loop.iostat_summary(write_log(tmp_path, SYSSTAT_12))
+    # dm-0 and sda
+    assert summary == {'util': '66.00', 'rd_lat_ms': '3.75', 'wr_lat_ms': '4.50'}
+    assert capsys.readouterr().out == ''
+
+
+def test_fio_loop_summary_unknown_header(tmp_path, capsys):
+    assert fio_loop.iostat_summary(write_log(tmp_path, UNKNOWN)) == {}
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert 'Unrecognised iostat header' in err
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import pytest
+
+import plot_dm_btrfs
+from plot_dm_btrfs import AVG, COUNT, WEIGHTED
+
+
+# The samples of vol1 are out of order by one sample, those of vol2 are in order;
+# 10:00:02 is in both files, 10:00:03 only in vol1 and it has no write
+VOL1 = '''Thu Oct 22 10:00:02 UTC 2020
+read:	n: 100 a: 2000us
+write:	n: 10 a: 5000us
+junk: line
+Thu Oct 22 10:00:01 UTC 2020
+read:	n: 300 a: 1000us
+write:	n: 10 a: 3000us
+Thu Oct 22 10:00:03 UTC 2020
+read:	n: 1 a: 500us
+'''
+
+VOL2 = '''Thu Oct 22 10:00:02 UTC 2020
+read:	n: 300 a: 4000us
+write:	n: 30 a: 1000us
+Thu Oct 22 10:00:04 UTC 2020
+read:	n: 0 a: 0us
+write:	n: 5 a: 2000us
+'''
+
+
+def write_file(tmp_path, name, text):
+    fpath = tmp_path / name
+    fpath.write_text(text)
+    return str(fpath)
+
+
+def make_opts(infiles, value, metrics=('read', 'write'), reorder_window=1, max_samples_per_file=0):
+    return argparse.Namespace(infile=infiles, value=value, metrics=list(metrics), reorder_window=reorder_window,
+                              max_samples_per_file=max_samples_per_file, outfile_basename='out')
+
+
+def merge(opts):
+    basenames = [fpath.rpartition('/')[2] for fpath in opts.infile]
+    col_names, file_cols = plot_dm_btrfs.file_columns(opts, basenames)
+    samples = [(plot_dm_btrfs.format_ts(ts), values)
+               for ts, values in plot_dm_btrfs.merged_samples(opts, basenames, file_cols, len(col_names))]
+    return col_names, samples
+
+
+def test_parse_in_file_order(tmp_path):
+    samples = list(plot_dm_btrfs.parse_dmbtrfs_stats(write_file(tmp_path, 'vol1', VOL1)))
+    assert [plot_dm_btrfs.format_ts(ts) for ts, _ in samples] == [
+        '2020-10-22 10:00:02', '2020-10-22 10:00:01', '2020-10-22 10:00:03']
+    assert samples[0][1] == {'read': (100, 2.0), 'write': (10, 5.0)}
+    assert samples[2][1] == {'read': (1, 0.5)}
+
+
+def test_merge_weighted(tmp_path):
+    opts = make_opts([write_file(tmp_path, 'vol1', VOL1), write_file(tmp_path, 'vol2', VOL2)], WEIGHTED)
+    col_names, samples = merge(opts)
+    assert col_names == ['weighted_read', 'weighted_write']
+    assert samples == [
+        ('2020-10-22 10:00:01', [1.0, 3.0]),
+        # (100 * 2 + 300 * 4) / 400 and (10 * 5 + 30 * 1) / 40
+        ('2020-10-22 10:00:02', [3.5, 2.0]),
+        ('2020-10-22 10:00:03', [0.5, None]),
+        ('2020-10-22 10:00:04', [0.0, 2.0]),
+    ]
+
+
+@pytest.mark.parametrize('value, expected', [
+    (AVG, [[1.0, None], [2.0, 4.0], [0.5, None], [None, 0.0]]),
+    (COUNT, [[300, None], [100, 300], [1, None], [None, 0]]),
+])
+def test_merge_per_file(tmp_path, value, expected):
+    opts = make_opts([write_file(tmp_path, 'vol1', VOL1), write_file(tmp_path, 'vol2', VOL2)], value, metrics=['read'])
+    col_names, samples = merge(opts)
+    assert col_names == ['vol1_read', 'vol2_read']
+    assert [values for _, values in samples] == expected
+
+
+def test_out_of_order_beyond_window(tmp_path, capsys):
+    opts = make_opts([write_file(tmp_path, 'vol1', VOL1)], AVG, reorder_window=0)
+    with pytest.raises(SystemExit):
+        merge(opts)
+    assert 'out of order by more than 0 samples' in capsys.readouterr().err
+
+
+def test_duplicate_timestamp(tmp_path, capsys):
+    text = VOL2 + 'Thu Oct 22 10:00:02 UTC 2020\nread:	n: 1 a: 1us\n'
+    opts = make_opts([write_file(tmp_path, 'vol1', VOL1), write_file(tmp_path, 'vol2', text)], WEIGHTED, reorder_window=2)
+    with pytest.raises(SystemExit):
+        merge(opts)
+    assert 'vol2: duplicate timestamp 2020-10-22 10:00:02' in capsys.readouterr().err
+
+
+def test_duplicate_metric(tmp_path, capsys):
+    fpath = write_file(tmp_path, 'vol1', VOL1 + 'read:	n: 1 a: 1us\n')
+    with pytest.raises(SystemExit):
+        list(plot_dm_btrfs.parse_dmbtrfs_stats(fpath))
+    assert 'duplicate read' in capsys.readouterr().err
+
+
+def test_discover_metrics(tmp_path):
+    discovered = plot_dm_btrfs.discover_metrics(write_file(tmp_path, 'vol1', VOL1))
+    assert discovered == ['read', 'write']
+    plot_dm_btrfs.add_discovered_metrics(['cow_rd', 'read'], discovered)
+    assert discovered == ['read', 'write', 'cow_rd']
+
+
+def test_csv_split(tmp_path):
+    opts = make_opts([write_file(tmp_path, 'vol1', VOL1), write_file(tmp_path, 'vol2', VOL2)], WEIGHTED,
+                     metrics=['write'], max_samples_per_file=3)
+    plot_dm_btrfs.do_csv(opts, str(tmp_path), ['vol1', 'vol2'])
+    assert not (tmp_path / 'out.csv').exists()
+    assert (tmp_path / 'out.0001.csv').read_text().splitlines() == [
+        'timestamp,weighted_write', '2020-10-22 10:00:01,3.000', '2020-10-22 10:00:02,2.000', '2020-10-22 10:00:03, ']
+    assert (tmp_path / 'out.0002.csv').read_text().splitlines() == [
+        'timestamp,weighted_write', '2020-10-22 10:00:04,2.000']
+
+
+def test_csv_single_file(tmp_path):
+    opts = make_opts([write_file(tmp_path, 'vol2', VOL2)], COUNT, metrics=['write'], max_samples_per_file=2)
+    plot_dm_btrfs.do_csv(opts, str(tmp_path), ['vol2'])
+    assert (tmp_path / 'out.csv').read_text().splitlines() == [
+        'timestamp,vol2_write', '2020-10-22 10:00:02,30', '2020-10-22 10:00:04,5']
+    assert not (tmp_path / 'out.0001.csv').exists()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import numpy as np
+import pytest
+
+import plot_mpstat
+from plot_lines import heatmap_figure
+from sample_store import SampleStore
+
+
+def make_store(idle):
+    # idle: (interval, cpu) of %idle, NaN for a CPU missing from an interval; cpu 'all' is not in it
+    cpus = [str(cpu) for cpu in range(len(idle[0]))]
+    store = SampleStore(['all'] + cpus, plot_mpstat.COLUMNS, dtype=np.float64)
+    for interval, cpus_idle in enumerate(idle):
+        idx = store.new_sample('00:00:{:02d}'.format(interval))
+        store.set_values(idx, 0, [0] * (len(plot_mpstat.COLUMNS) - 1) + [50])
+        for cpu_idx, cpu_idle in enumerate(cpus_idle, 1):
+            store.set_values(idx, cpu_idx, [0] * (len(plot_mpstat.COLUMNS) - 1) + [cpu_idle])
+    return store
+
+
+def make_opts(numa_map, cpu='each'):
+    return argparse.Namespace(metric=plot_mpstat.CPU_USAGE, cpu=cpu, numa_map=numa_map)
+
+
+def test_numa_map_file(tmp_path):
+    fpath = tmp_path / 'numa'
+    fpath.write_text('# node cpulist\n0 0-1,4\n1 2-3\n')
+    assert plot_mpstat.read_numa_map(str(fpath)) == {'0': 0, '1': 0, '4': 0, '2': 1, '3': 1}
+
+
+def test_numa_map_sysfs(tmp_path):
+    for node, cpulist in ((0, '0,2'), (1, '1,3-5')):
+        (tmp_path / 'node{}'.format(node)).mkdir()
+        (tmp_path / 'node{}'.format(node) / 'cpulist').write_text(cpulist + '\n')
+    (tmp_path / 'possible').write_text('0-1\n')
+    assert plot_mpstat.read_numa_map(str(tmp_path)) == {'0': 0, '2': 0, '1': 1, '3': 1, '4': 1, '5': 1}
+
+
+def test_numa_rollup(tmp_path):
+    fpath = tmp_path / 'numa'
+    fpath.write_text('0 0,2\n1 1,3\n')
+    # cpu 2 is missing from the second interval, the average of node 0 is of cpu 0 alone
+    store = make_store([[90, 80, 70, 60], [50, 40, np.nan, 20]])
+    names, col_names, values = plot_mpstat.select_series(make_opts(str(fpath)), store)
+    assert names == col_names == ['node0', 'node1']
+    np.testing.assert_allclose(values, [[20, 30], [50, 70]])
+
+    fig = heatmap_figure(np.arange(len(store)), names, values, 'cpu_usage')
+    assert list(fig.data[0].y) == ['node0', 'node1']
+    np.testing.assert_allclose(fig.data[0].z, [[20, 50], [30, 70]])
+
+
+def test_numa_map_missing_cpu(tmp_path):
+    fpath = tmp_path / 'numa'
+    fpath.write_text('0 0-1\n')
+    with pytest.raises(AssertionError):
+        plot_mpstat.select_series(make_opts(str(fpath)), make_store([[90, 80, 70]]))
+
+
+def test_each_cpu():
+    names, col_names, values = plot_mpstat.select_series(make_opts(None), make_store([[90, 80], [70, np.nan]]))
+    assert names == ['0', '1']
+    assert col_names == ['cpu_0', 'cpu_1']
+    np.testing.assert_allclose(values, [[10, 20], [30, np.nan]])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from sample_store import SampleStore, merge_sorted, CHUNK_ENTITIES
+
+
+NAN = np.nan
+
+
+def make_store(entities, labels, values):
+    store = SampleStore(entities, ['m0', 'm1'], dtype=np.float64)
+    for label, sample in zip(labels, values):
+        idx = store.new_sample(label)
+        for entity_idx, entity_values in enumerate(sample):
+            store.set_values(idx, entity_idx, entity_values)
+    return store
+
+
+def test_add_entity_grows_in_chunks():
+    store = SampleStore([], ['m0', 'm1'], dtype=np.float64)
+    for sample_nr in range(3):
+        idx = store.new_sample(str(sample_nr))
+        # every sample shows a new entity, and all the entities seen so far
+        store.add_entity('e{}'.format(sample_nr))
+        for entity_idx in range(len(store.entities)):
+            store.set_values(idx, entity_idx, [sample_nr, entity_idx])
+    for entity_nr in range(3, CHUNK_ENTITIES * 2):
+        store.add_entity('e{}'.format(entity_nr))
+
+    assert store.values.shape == (3, CHUNK_ENTITIES * 2, 2)
+    np.testing.assert_array_equal(store.column('e0', 'm0'), [0, 1, 2])
+    np.testing.assert_array_equal(store.column('e2', 'm0'), [NAN, NAN, 2])
+    assert np.isnan(store.values[:, 3:]).all()
+
+
+def test_truncate_and_extend_with_spare_entities():
+    store = make_store(['a'], ['0', '1', '2'], [[[0, 0]], [[1, 1]], [[2, 2]]])
+    store.add_entity('b')
+    store.truncate(1, 3)
+    assert store.labels == ['1', '2']
+    assert store.values.shape == (2, 2, 2)
+    np.testing.assert_array_equal(store.column('a', 'm0'), [1, 2])
+    assert np.isnan(store.column('b', 'm0')).all()
+
+    other = make_store(['a', 'b'], ['3'], [[[3, 3], [4, 4]]])
+    store.extend(other)
+    store.add_entity('c')
+    np.testing.assert_array_equal(store.values[2], [[3, 3], [4, 4], [NAN, NAN]])
+    store.extend(make_store(['a', 'b', 'c'], ['4'], [[[5, 5], [6, 6], [7, 7]]]))
+    np.testing.assert_array_equal(store.column('c', 'm1'), [NAN, NAN, NAN, 7])
+
+    restored = SampleStore.from_arrays(store.to_arrays())
+    assert restored.labels == store.labels and restored.entities == store.entities
+    np.testing.assert_array_equal(restored.values, store.values)
+
+
+def test_select_entities():
+    store = make_store(['a', 'b', 'c'], ['0', '1'], [[[0, 0], [1, 1], [2, 2]], [[3, 3], [4, 4], [5, 5]]])
+    selected = store.select_entities(['c', 'a'])
+    assert selected.entities == ['c', 'a']
+    assert selected.labels == ['0', '1']
+    np.testing.assert_array_equal(selected.column('c', 'm0'), [2, 5])
+    np.testing.assert_array_equal(selected.column('a', 'm1'), [0, 3])
+
+
+def test_merge_sorted_orders_by_key():
+    first = make_store(['a'], ['t1', 't3'], [[[1, 1]], [[3, 3]]])
+    second = make_store(['b'], ['t0', 't2'], [[[0, 0]], [[2, 2]]])
+    merged = merge_sorted([first, second], [[1, 3], [0, 2]])
+    assert merged.labels == ['t0', 't1', 't2', 't3']
+    assert merged.entities == ['a', 'b']
+    np.testing.assert_array_equal(merged.column('a', 'm0'), [NAN, 1, NAN, 3])
+    np.testing.assert_array_equal(merged.column('b', 'm0'), [0, NAN, 2, NAN])
+
+
+def test_merge_sorted_key_only_duplicates():
+    # The samples of key 2 differ, like those of two logs which report different rows at the same time:
+    # the sample of the later store is kept, with what it is missing taken from the earlier ones
+    first = make_store(['a', 'b'], ['t1', 't2 first'], [[[1, 1], [1, 1]], [[2, 2], [NAN, 20]]])
+    second = make_store(['b', 'c'], ['t2 second', 't3'], [[[NAN, 21], [22, NAN]], [[3, 3], [3, 3]]])
+    third = make_store(['a'], ['t2 third'], [[[23, NAN]]])
+    merged = merge_sorted([first, second, third], [[1, 2], [2, 3], [2]])
+    assert merged.labels == ['t1', 't2 third', 't3']
+    np.testing.assert_array_equal(merged.values[1], [[23, 2], [NAN, 21], [22, NAN]])
+    np.testing.assert_array_equal(merged.values[2], [[NAN, NAN], [3, 3], [3, 3]])
+
+
+def test_merge_sorted_identical_overlap():
+    # the overlap of two rotations of a log
+    older = make_store(['a'], ['t0', 't1'], [[[0, 0]], [[1, 1]]])
+    newer = make_store(['a'], ['t1', 't2'], [[[1, 1]], [[2, 2]]])
+    merged = merge_sorted([newer, older], [[1, 2], [0, 1]])
+    assert merged.labels == ['t0', 't1', 't2']
+    np.testing.assert_array_equal(merged.column('a', 'm1'), [0, 1, 2])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from zstat_parser import parse_zstat_files, counter_column, TOTAL_COUNT, AVG_MS
+
+
+HEADER = '{} [2587] [     ] : ZSTAT-GROUP____________________ actv max-actv total-count total-mb__ avg-ms____ max-ms_____\n'
+ROW = '{} [2587] [     ] : {:<32} 1 2 {} 4 {:.3f} 6\n'
+OTHER = '{} [2587] [     ] : some other log line\n'
+
+
+def zstat_log(samples):
+    # samples: list of (timestamp, {row: total count}), the average latency is a tenth of the count
+    lines = []
+    for ts, rows in samples:
+        lines.append(HEADER.format(ts))
+        for row, count in rows.items():
+            lines.append(ROW.format(ts, row, count, count / 10.0))
+        lines.append(OTHER.format(ts))
+    return ''.join(lines)
+
+
+# Two rotations which overlap in the sample of 15:30:42.999984; zadara_osm.log has another sample in the
+# same second, and a new row
+OLDER = [('Jul 23 15:30:40.999984', {'src:PUT:curl': 10, 'src:GET:curl': 11}),
+         ('Jul 23 15:30:42.999984', {'src:PUT:curl': 20, 'src:GET:curl': 21})]
+NEWER = [('Jul 23 15:30:42.999984', {'src:PUT:curl': 20, 'src:GET:curl': 21}),
+         ('Jul 23 15:30:43.000100', {'src:PUT:curl': 30, 'dst:PUT:curl': 32}),
+         ('Jul 23 15:30:43.999984', {'src:PUT:curl': 40, 'src:GET:curl': 41, 'dst:PUT:curl': 42})]
+
+
+def write_logs(tmp_path):
+    newer = tmp_path / 'zadara_osm.log'
+    newer.write_text(zstat_log(NEWER))
+    older = tmp_path / 'zadara_osm.log.1'
+    older.write_text(zstat_log(OLDER))
+    return [str(newer), str(older)]
+
+
+@pytest.mark.parametrize('use_cache', [False, True], ids=['no-cache', 'cache'])
+def test_overlapping_rotations(tmp_path, use_cache):
+    store = parse_zstat_files(write_logs(tmp_path), jobs=1, use_cache=use_cache)
+    # the overlapping sample is taken once, the two samples of 15:30:43 are kept
+    assert store.labels == ['Jul 23 15:30:40', 'Jul 23 15:30:42', 'Jul 23 15:30:43', 'Jul 23 15:30:43']
+    assert sorted(store.entities) == ['dst:PUT:curl', 'src:GET:curl', 'src:PUT:curl']
+    np.testing.assert_array_equal(counter_column(store, 'src:PUT:curl', TOTAL_COUNT), [10, 20, 30, 40])
+    np.testing.assert_array_equal(counter_column(store, 'src:GET:curl', TOTAL_COUNT), [11, 21, np.nan, 41])
+    np.testing.assert_array_equal(counter_column(store, 'dst:PUT:curl', AVG_MS), [np.nan, np.nan, 3.2, 4.2])
+
+
+def test_same_timestamp_of_two_logs(tmp_path):
+    # logs of two processes with tables at the same time: one sample with the rows of both
+    first = tmp_path / 'osm.log'
+    first.write_text(zstat_log([('Jul 23 15:30:40.999984', {'src:PUT:curl': 10})]))
+    second = tmp_path / 'put.log'
+    second.write_text(zstat_log([('Jul 23 15:30:40.999984', {'dst:PUT:curl': 20})]))
+    store = parse_zstat_files([str(first), str(second)], jobs=1, use_cache=False)
+    assert store.labels == ['Jul 23 15:30:40']
+    np.testing.assert_array_equal(store.values[0, [store.entity_idx['src:PUT:curl'], store.entity_idx['dst:PUT:curl']],
+                                               store.metric_idx[TOTAL_COUNT]], [10, 20])
+
+
+@pytest.mark.parametrize('use_cache', [False, True], ids=['no-cache', 'cache'])
+def test_rows_and_max_samples(tmp_path, use_cache):
+    infiles = write_logs(tmp_path)
+    # a full parse first, so that the cached case takes the rows and samples from the cache
+    parse_zstat_files(infiles, jobs=1, use_cache=use_cache)
+    store = parse_zstat_files(infiles, rows=['*:PUT:*'], max_samples=3, jobs=1, use_cache=use_cache)
+    assert len(store) == 3
+    assert sorted(store.entities) == ['dst:PUT:curl', 'src:PUT:curl']
+    np.testing.assert_array_equal(counter_column(store, 'src:PUT:curl', TOTAL_COUNT), [10, 20, 30])
+
+    store = parse_zstat_files(infiles[:1], rows=['src:GET:*'], max_samples=2, jobs=1, use_cache=use_cache)
+    assert store.labels == ['Jul 23 15:30:42', 'Jul 23 15:30:43']
+    assert store.entities == ['src:GET:curl']
+    np.testing.assert_array_equal(counter_column(store, 'src:GET:curl', TOTAL_COUNT), [21, np.nan])
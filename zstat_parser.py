@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import re
+import fnmatch
+import concurrent.futures
+import numpy as np
+
+from sample_store import SampleStore, merge_sorted
+from parse_cache import cached_parse
+from log_open import open_log
+from log_timestamps import syslog_ts
+
+
+def bug(msg):
+    print('ERROR: {}'.format(msg), file=sys.stderr)
+    assert False
+
+
+# zadara_osm prints its counters as tables, every table starts with a header which names the columns:
+# Aug  8 16:55:15.632378 [30033] [oba  ] : ZSTAT-GROUP____________________ actv max-actv total-count total-mb__ avg-ms____ max-ms_____
+# Aug  8 16:55:17.674978 [30033] [oba  ] : src-datamover:PUT:curl            56       64         210        420    284.804         406
+# Every line is split once: the syslog prefix up to ' : ', then the fields of the message.
+MSG_SEP = ' : '
+TABLE_HEADER = 'ZSTAT-GROUP'
+
+# Counters, as the header names them without the '_' padding
+ACTV = 'actv'
+MAX_ACTV = 'max-actv'
+TOTAL_COUNT = 'total-count'
+TOTAL_MB = 'total-mb'
+AVG_MS = 'avg-ms'
+MAX_MS = 'max-ms'
+COUNTERS = (ACTV, MAX_ACTV, TOTAL_COUNT, TOTAL_MB, AVG_MS, MAX_MS)
+# all counters but the average are integers
+INT_COUNTERS = (ACTV, MAX_ACTV, TOTAL_COUNT, TOTAL_MB, MAX_MS)
+
+# Bump when the parsing changes, to invalidate cached samples
+PARSER_VERSION = 2
+
+
+def rows_matcher(globs):
+    # returns a function which tells whether a row name matches any of the shell-style globs
+    regexp = re.compile('|'.join('(?:{})'.format(fnmatch.translate(glob)) for glob in globs))
+    return lambda name: regexp.match(name) is not None
+
+
+def sample_label(prefix):
+    # 'Jul 23 15:29:15.999984 [2587] [     ]' -> 'Jul 23 15:29:15.999984'; the samples of several files are merged by it
+    return prefix.partition(' [')[0]
+
+
+def display_label(label):
+    # 'Jul 23 15:29:15.999984' -> 'Jul 23 15:29:15'
+    return label.partition('.')[0]
+
+
+def parse_zstat(infile, rows=None, max_samples=0):
+    # Parses all the ZSTAT-GROUP tables of a log into a (sample, row, counter) store; every table header
+    # starts a new sample. rows: globs of the row names to keep, None keeps all of them.
+    # A counter missing from a table, or a row missing from a sample, is NaN.
+    store = SampleStore([], COUNTERS, dtype=np.float64)
+    row_idx = store.entity_idx
+    row_wanted = rows_matcher(rows) if rows is not None else None
+    # names of rows which did not match, not to match them again
+    skipped_rows = set()
+
+    sample_idx = None
+    # store index of every column of the current table, None for unknown counters
+    columns = None
+    nr_fields = 0
+
+    with open_log(infile) as fin:
+        for line in fin:
+            prefix, sep, msg = line.partition(MSG_SEP)
+            if not sep:
+                continue
+            fields = msg.split()
+            if not fields:
+                continue
+
+            name = fields[0]
+            if name.startswith(TABLE_HEADER):
+                if max_samples > 0 and len(store) >= max_samples:
+                    print('Terminating parsing due to max_samples')
+                    break
+                sample_idx = store.new_sample(sample_label(prefix))
+                columns = [store.metric_idx.get(field.rstrip('_')) for field in fields[1:]]
+                nr_fields = len(fields)
+                continue
+
+            # a row has a value for every column of the table
+            if sample_idx is None or len(fields) != nr_fields or name in skipped_rows:
+                continue
+
+            if name not in row_idx and row_wanted is not None and not row_wanted(name):
+                skipped_rows.add(name)
+                continue
+            try:
+                values = [float(field) for field in fields[1:]]
+            except ValueError:
+                # not a row after all
+                continue
+
+            idx = row_idx.get(name)
+            if idx is None:
+                idx = store.add_entity(name)
+
+            row_values = store.values[sample_idx, idx]
+            if not np.isnan(row_values).all():
+                bug('Row {} appears twice in the table of {}'.format(name, store.labels[sample_idx]))
+            for metric_idx, value in zip(columns, values):
+                if metric_idx is not None:
+                    row_values[metric_idx] = value
+
+    print('Total {} samples collected, {} rows'.format(len(store), len(store.entities)))
+
+    return store
+
+
+def _parse_zstat_file(args):
+    # runs in a worker process when parsing several files
+    infile, rows, max_samples, use_cache = args
+    if not use_cache:
+        store = parse_zstat(infile, rows, max_samples)
+        # drop the spare room, so that it is not sent back to the parent
+        store.truncate(0, len(store))
+        return store
+
+    # The cache has all the rows of the whole log, whichever of them and however many samples the tools need:
+    # a log is parsed in full once, the first time, rather than once per set of rows or max_samples.
+    # Without the cache, the parsing stops at max_samples.
+    store = cached_parse(infile, 'zstat', PARSER_VERSION, {},
+                         lambda: parse_zstat(infile), SampleStore.to_arrays, SampleStore.from_arrays)
+    if rows is not None:
+        row_wanted = rows_matcher(rows)
+        store = store.select_entities([row for row in store.entities if row_wanted(row)])
+    if max_samples > 0:
+        store.truncate(0, max_samples)
+    return store
+
+
+def parse_zstat_files(infiles, rows=None, max_samples=0, jobs=0, use_cache=True):
+    # Parses a set of logs, like zadara_osm.log and its rotations (zadara_osm.log.1, zadara_osm.log.2.gz etc.),
+    # given in any order. Every file is parsed in its own process, then the samples are merged by time;
+    # the samples which appear in two files, where the rotations overlap, are taken once.
+    # Syslog timestamps have no year, so a set of logs should not cross a new year.
+    # The labels of the samples are their timestamps to the second.
+    if len(infiles) == 1:
+        store = _parse_zstat_file((infiles[0], rows, max_samples, use_cache))
+        store.labels = [display_label(label) for label in store.labels]
+        return store
+
+    jobs = min(jobs if jobs > 0 else os.cpu_count(), len(infiles))
+    print('Parsing {} files with {} processes'.format(len(infiles), jobs))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        stores = list(executor.map(_parse_zstat_file, [(infile, rows, 0, use_cache) for infile in infiles]))
+
+    store = merge_sorted(stores, [[syslog_ts(label) for label in store.labels] for store in stores])
+    print('Total {} samples after merging'.format(len(store)))
+
+    if max_samples > 0:
+        store.truncate(0, max_samples)
+    store.labels = [display_label(label) for label in store.labels]
+    return store
+
+
+def counter_column(store, row, counter):
+    # all samples of a counter of a row; NaN if the log does not have the row
+    if row not in store.entity_idx:
+        return np.full(len(store), np.nan)
+    return store.column(row, counter)
+
+
+def format_value(counter, value):
+    # as it appears in the log; empty if missing
+    if value != value:
+        return ''
+    if counter in INT_COUNTERS:
+        return str(int(value))
+    return str(value)